@@ -0,0 +1,70 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from app.storage import archive_completed_tasks
+from app.rollover import scheduler
+from app.lifecycle import tracked
+from app.monitor import monitored
+
+# Completed tasks older than this many days are moved out of the hot tasks
+# table into tasks_archive. History queries read both tables.
+archive_after_days = int(os.environ.get("TASKBAR_ARCHIVE_AFTER_DAYS", "30"))
+
+# Tasks moved per transaction and the pause between transactions, so the
+# compaction never holds the write lock for long.
+archive_batch_size = 500
+archive_batch_pause = 0.1
+
+
+def archive_cutoff():
+    """
+    Returns the completed_at before which tasks are archived. completed_at
+    is in the user's local time, so the cutoff is taken from the UTC day
+    one day earlier, which no timezone is ahead of, instead of the
+    server's local day.
+
+    :returns - string
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=archive_after_days + 1)
+    return cutoff.strftime("%Y-%m-%d 00:00:00")
+
+
+@tracked
+@monitored
+async def compact_tasks():
+    """
+    Moves old completed tasks to the archive in small batches until
+    there is nothing left to move.
+
+    :returns - int, the number of tasks moved
+    """
+    cutoff = archive_cutoff()
+    total = 0
+
+    while True:
+        was_archived, moved = await archive_completed_tasks(cutoff, archive_batch_size)
+        if not was_archived:
+            break
+
+        total += moved
+        if moved < archive_batch_size:
+            break
+
+        await asyncio.sleep(archive_batch_pause)
+
+    print(f"archived {total} tasks completed before {cutoff}")
+    return total
+
+
+def schedule_compaction():
+    """
+    Adds the nightly compaction job, away from the 23:59 rollovers
+    """
+    if scheduler.get_job("archive:compact") is None:
+        scheduler.add_job(
+            compact_tasks,
+            "cron",
+            hour="4",
+            minute="0",
+            id="archive:compact",
+        )
@@ -0,0 +1,175 @@
+from app.task_timers import compute_toggle, compute_complete, compute_create
+from app.utility import duration_str_to_int
+
+# Task batches, shared by the storage backends and the handlers, see
+# apply_task_batch in app/models.py and app/pg_models.py.
+
+# Fields each batch operation must carry, the same as the single task events.
+# Operations are applied in the order they were sent, see validate_task_batch.
+batch_operation_fields = {
+    "create": ("id", "title", "description", "created_at", "completed_at", "duration",
+               "category", "tags", "toggled_at", "is_active", "is_completed", "last_modified_at"),
+    "edit": ("id", "title", "description", "category", "tags", "last_modified_at"),
+    "toggle": ("uuid", "is_active", "toggled_at", "duration", "last_modified_at"),
+    "complete": ("id", "duration", "completed_at", "last_modified_at"),
+    "delete": ("id",),
+}
+batch_operation_statements = {
+    "create": "create_task",
+    "edit": "edit_task",
+    "toggle": "toggle_task",
+    "complete": "complete_task",
+    "delete": "delete_task",
+}
+# Statements of the operations on completed tasks that compaction moved
+# to tasks_archive, the other operations only apply to the tasks table.
+batch_archived_statements = {
+    "edit": "edit_archived_task",
+    "delete": "delete_archived_task",
+}
+
+
+def batch_task_id(operation):
+    """
+    Returns the id of the task a batch operation is about, None if the
+    operation is malformed or the id isn't a string
+    """
+    if not isinstance(operation, dict) or not isinstance(operation.get("data"), dict):
+        return None
+    data = operation["data"]
+    task_id = data.get("uuid") if operation.get("op") == "toggle" else data.get("id")
+    return task_id if isinstance(task_id, str) and task_id else None
+
+
+def timer_task_ids(operations: list):
+    """
+    Returns the ids of the tasks the toggles and completes of a batch are
+    about, to read their stored timers with
+    """
+    return [
+        task_id for operation in operations
+        if (task_id := batch_task_id(operation)) is not None
+        and operation.get("op") in ("toggle", "complete")
+    ]
+
+
+def compute_operation(op: str, data: dict, now: int, timers: dict):
+    """
+    Applies compute_toggle, compute_complete or compute_create to the data
+    of a valid batch operation and updates timers, so the next operation
+    of the batch sees the timer it started or stopped
+
+    :returns - dictionary, the data to save, or None if the task has no
+        stored timer to toggle or complete
+    """
+    if op == "toggle":
+        return compute_toggle(data, now, timers)
+    if op == "complete":
+        return compute_complete(data, now, timers)
+    if op == "delete":
+        timers.pop(data["id"], None)
+    elif op == "create":
+        data = compute_create(data, now)
+        try:
+            timers[data["id"]] = {
+                "is_active": bool(data["is_active"]),
+                "toggled_at": data["toggled_at"] or 0,
+                "duration_ms": duration_str_to_int(data["duration"]),
+            }
+        except (TypeError, ValueError, IndexError):
+            # not a duration, the task can't be toggled or completed
+            pass
+    return data
+
+
+def validate_task_batch(user_id, operations, owners, timers, now, archived_ids=frozenset()):
+    """
+    Checks every operation of a batch, computes the timers of the valid
+    ones in order and splits them into runs of consecutive operations that
+    use the same statement. Running the runs in order applies the
+    operations in the order they were sent, the order their timers were
+    computed in.
+
+    :params
+        user_id: string
+        operations: list of {op: string, data: dictionary}
+        owners: dictionary - task id to user id, for the ids in the batch
+        timers: dictionary - stored_timers of timer_task_ids(operations),
+            read in the transaction that applies the batch
+        now: int - epoch ms
+        archived_ids: set - the ids of owners that are in tasks_archive
+
+    :returns - tuple(list of per item results, the ok ones with the saved
+        data as task, list of (statement name, list of params))
+    """
+    results = []
+    runs = []
+    created_ids = set()
+    completed_ids = set()
+    deleted_ids = set()
+
+    for index, operation in enumerate(operations):
+        op = operation.get("op") if isinstance(operation, dict) else None
+        data = operation.get("data") if op else None
+        result = {"index": index, "op": op, "ok": False, "message": ""}
+        results.append(result)
+
+        if not isinstance(op, str) or op not in batch_operation_fields or not isinstance(data, dict):
+            result["message"] = "Unknown operation"
+            continue
+
+        missing = [f for f in batch_operation_fields[op] if f not in data]
+        if missing:
+            result["message"] = f"Missing fields: {', '.join(missing)}"
+            continue
+
+        task_id = batch_task_id(operation)
+        if task_id is None:
+            result["message"] = "Invalid task id"
+            continue
+        result["id"] = task_id
+
+        if op == "create":
+            if task_id in owners or task_id in created_ids:
+                result["message"] = "Task already exists"
+                continue
+            created_ids.add(task_id)
+            is_archived = False
+        else:
+            if owners.get(task_id) != user_id and task_id not in created_ids:
+                result["message"] = "Task not found"
+                continue
+            if task_id in deleted_ids or (op in ("toggle", "complete") and task_id in completed_ids):
+                # deleted or completed by an earlier operation of the batch
+                result["message"] = "Task not found"
+                continue
+            is_archived = task_id in archived_ids and task_id not in created_ids
+            if is_archived and op not in batch_archived_statements:
+                # archived tasks are completed, only edits and deletes apply
+                result["message"] = "Task not found"
+                continue
+
+        data = compute_operation(op, data, now, timers)
+        if data is None:
+            # not open, there is no timer to toggle or complete
+            result["message"] = "Task not found"
+            continue
+
+        params = {f: data[f] for f in batch_operation_fields[op]}
+        if op == "create":
+            params["user_id"] = user_id
+        elif op == "delete":
+            params = {"uuid": task_id}
+            deleted_ids.add(task_id)
+        elif op == "complete":
+            completed_ids.add(task_id)
+
+        name = batch_archived_statements[op] if is_archived else batch_operation_statements[op]
+        if runs and runs[-1][0] == name:
+            runs[-1][1].append(params)
+        else:
+            runs.append((name, [params]))
+        result["ok"] = True
+        result["task"] = data
+
+    return (results, runs)
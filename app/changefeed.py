@@ -0,0 +1,272 @@
+import asyncio
+import json
+import os
+import time
+from app.storage import get_last_change_seq, get_first_change_seq, get_changes, get_changes_by_seqs, prune_changes
+from app.realtime import get_user_sids, emitter_to_associated_sids, emit_to_user
+from app.outbound import resync_event
+
+# Every mutation writes a row to the changes table in its own transaction.
+# The dispatcher tails that table and pushes the committed changes to the
+# connected devices of each user, so fan-out follows commit order and also
+# covers changes made by rollover, the HTTP API or another worker.
+#
+# With concurrent writers a change can commit after a higher seq did
+# (Postgres hands out seqs before commit), and a write that rolls back
+# leaves its seq unused. The dispatcher never waits for a missing seq, it
+# asks for it again on every poll for up to gap_timeout. Each user also
+# numbers their own changes without holes (user_seq), so a change that
+# shows up after a later one of its user was pushed is caught, and that
+# user's devices get a resync instead.
+
+# Seconds between polls when nothing local woke the dispatcher up, this is
+# how fast changes written by other workers are picked up.
+poll_interval = float(os.environ.get("TASKBAR_CHANGEFEED_INTERVAL", "0.1"))
+# Most changes read per poll.
+batch_limit = 500
+# Changes are kept this long so devices can catch up after a reconnect.
+retention_ms = int(os.environ.get("TASKBAR_CHANGEFEED_RETENTION_HOURS", "24")) * 3600 * 1000
+# Seconds between prunes of the changes older than retention_ms.
+prune_interval = 600
+# Seconds a missing seq is looked for, after that its write rolled back.
+gap_timeout = 60.0
+
+feed_state = {
+    "last_seq": 0,
+    "task": None,
+    "wake": None,
+    "last_prune": 0.0,
+    # missing seq -> monotonic time it was first seen missing
+    "gaps": {},
+    # user id -> user_seq of the last change pushed to that user
+    "user_seqs": {},
+}
+feed_stats = {
+    "changes": 0,
+    "batches": 0,
+    "pruned": 0,
+    "skipped_gaps": 0,
+    "resyncs": 0,
+}
+
+
+def notify_changes():
+    """
+    Wakes the dispatcher up right away, call after a mutation committed
+    """
+    if feed_state["wake"] is not None:
+        feed_state["wake"].set()
+
+
+def change_to_dict(change):
+    seq, user_id, event, data, origin, user_seq = change
+    return {"seq": seq, "event": event, "data": json.loads(data)}
+
+
+async def dispatch_changes(sio, changes: list):
+    """
+    Pushes the given changes, in seq order, as one "changes" event per
+    connected device. A device doesn't get the changes it made itself,
+    it already applied them.
+
+    :params
+        sio: socketio.AsyncServer
+        changes: list of (seq, user_id, event, data, origin, user_seq)
+    """
+    batches = {}
+    for change in changes:
+        seq, user_id, event, data, origin, user_seq = change
+        for sid in get_user_sids(user_id, exclude_sid=origin, sio=sio):
+            batches.setdefault(sid, []).append(change_to_dict(change))
+
+    for sid, batch in batches.items():
+        await emitter_to_associated_sids("changes", [sid], {"changes": batch})
+        feed_stats["batches"] += 1
+
+    feed_stats["changes"] += len(changes)
+
+
+def track_gaps(changes: list, last_seq: int, now: float):
+    """
+    Records the seqs missing between last_seq and the given changes and
+    forgets the ones missing for longer than gap_timeout
+
+    :params
+        changes: list of changes after last_seq, in seq order
+        last_seq: int
+        now: float - monotonic time
+    """
+    gaps = feed_state["gaps"]
+    expected = last_seq + 1
+    for change in changes:
+        for missing_seq in range(expected, change[0]):
+            gaps[missing_seq] = now
+        expected = change[0] + 1
+
+    expired = [seq for seq, seen_at in gaps.items() if now - seen_at >= gap_timeout]
+    for seq in expired:
+        del gaps[seq]
+    if expired:
+        print(f"change feed gave up on {len(expired)} seqs, they never committed")
+        feed_stats["skipped_gaps"] += len(expired)
+
+
+def order_user_changes(changes: list):
+    """
+    Returns the changes to push, each user's in user_seq order, and the
+    users whose devices missed a change
+
+    :params - changes: list of (seq, user_id, event, data, origin, user_seq), in seq order
+
+    :returns - tuple(list of changes, set of user ids)
+    """
+    user_seqs = feed_state["user_seqs"]
+    ready = []
+    resync_user_ids = set()
+    for change in changes:
+        user_id, user_seq = change[1], change[5]
+        last_user_seq = user_seqs.get(user_id)
+        if last_user_seq is not None and user_seq <= last_user_seq:
+            # pushed already, or replaced by the resync below
+            continue
+        if last_user_seq is not None and user_seq > last_user_seq + 1:
+            resync_user_ids.add(user_id)
+        user_seqs[user_id] = user_seq
+        ready.append(change)
+
+    return (ready, resync_user_ids)
+
+
+async def send_resyncs(sio, user_ids: set):
+    """
+    Tells every device of the given users to catch up with a hard refresh
+    """
+    for user_id in user_ids:
+        print(f"change feed missed changes of user id {user_id}, resyncing")
+        await emit_to_user(user_id, resync_event, {"reason": "gap"}, sio=sio)
+        feed_stats["resyncs"] += 1
+
+
+async def dispatch_pending(sio):
+    """
+    Reads and pushes every change after the last one dispatched, and the
+    missing seqs that committed since the last poll
+
+    :returns - int, number of changes dispatched
+    """
+    changes = []
+    if feed_state["gaps"]:
+        were_fetched, late_changes = await get_changes_by_seqs(sorted(feed_state["gaps"]))
+        if were_fetched:
+            for change in late_changes:
+                del feed_state["gaps"][change[0]]
+            changes.extend(late_changes)
+
+    count = 0
+    while True:
+        were_fetched, new_changes = await get_changes(feed_state["last_seq"], batch_limit)
+        if not were_fetched:
+            return count
+
+        track_gaps(new_changes, feed_state["last_seq"], time.monotonic())
+        if new_changes:
+            feed_state["last_seq"] = new_changes[-1][0]
+        changes.extend(new_changes)
+
+        ready, resync_user_ids = order_user_changes(sorted(changes))
+        await dispatch_changes(sio, ready)
+        await send_resyncs(sio, resync_user_ids)
+        count += len(ready)
+        changes = []
+        if len(new_changes) < batch_limit:
+            return count
+
+
+async def prune_old_changes():
+    now = time.monotonic()
+    if now - feed_state["last_prune"] < prune_interval:
+        return
+
+    feed_state["last_prune"] = now
+    was_pruned, count = await prune_changes(int(time.time() * 1000) - retention_ms)
+    if was_pruned:
+        feed_stats["pruned"] += count
+
+
+async def run_dispatcher(sio):
+    wake = feed_state["wake"]
+    while True:
+        try:
+            await asyncio.wait_for(wake.wait(), poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+        try:
+            await dispatch_pending(sio)
+            await prune_old_changes()
+        except Exception as e:
+            print(f"change feed dispatch failed: {e}")
+
+
+async def start_dispatcher(sio):
+    """
+    Starts tailing the changes table from its current end, older changes
+    are part of the snapshot devices get when they connect
+    """
+    if feed_state["task"] is not None:
+        return
+
+    was_fetched, last_seq = await get_last_change_seq()
+    feed_state["last_seq"] = last_seq if was_fetched else 0
+    feed_state["wake"] = asyncio.Event()
+    feed_state["task"] = asyncio.get_running_loop().create_task(run_dispatcher(sio))
+
+
+async def stop_dispatcher(sio):
+    """
+    Pushes the changes still pending and stops the dispatcher
+    """
+    if feed_state["task"] is None:
+        return
+
+    feed_state["task"].cancel()
+    try:
+        await feed_state["task"]
+    except asyncio.CancelledError:
+        pass
+    feed_state["task"] = None
+
+    await dispatch_pending(sio)
+
+
+async def get_user_changes(user_id: str, after_seq: int):
+    """
+    Returns the changes of a user after the given seq, for devices
+    catching up after a reconnect. If changes after that seq were pruned
+    already, gap is True and the device needs a hard refresh instead.
+
+    :returns - tuple(boolean, {changes: list of {seq, event, data}, gap: boolean, more: boolean} | string)
+        more is True if there are changes after the last one returned
+    """
+    were_fetched, first_seq = await get_first_change_seq()
+    if not were_fetched:
+        return (False, first_seq)
+
+    were_fetched, changes = await get_changes(after_seq, batch_limit, user_id)
+    if not were_fetched:
+        return (False, changes)
+    return (True, {
+        "changes": [change_to_dict(change) for change in changes],
+        "gap": first_seq is not None and after_seq < first_seq - 1,
+        "more": len(changes) == batch_limit,
+    })
+
+
+def get_changefeed_stats():
+    return {
+        "last_seq": feed_state["last_seq"],
+        "running": feed_state["task"] is not None,
+        "gaps": len(feed_state["gaps"]),
+        **feed_stats,
+    }
@@ -0,0 +1,63 @@
+CREATE TABLE users (
+	id 				TEXT PRIMARY KEY,
+	first_name 		TEXT NOT NULL,
+	last_name 		TEXT NOT NULL,
+	email 			TEXT NOT NULL,
+	categories 		TEXT,
+	key_commands 	TEXT DEFAULT '{}',
+	timezone 		TEXT NOT NULL DEFAULT 'Europe/Bucharest',
+	last_rollover_day TEXT
+);
+
+CREATE TABLE tasks (
+	id 			TEXT PRIMARY KEY,
+	title		TEXT NOT NULL,
+	description TEXT NOT NULL,
+	created_at   TEXT NOT NULL,
+	completed_at TEXT,
+	duration 	TEXT NOT NULL,
+	category    TEXT NOT NULL,
+	tags 		TEXT,
+	toggled_at  BIGINT,
+	is_active   INTEGER NOT NULL,
+	is_completed INTEGER NOT NULL,
+	user_id 	TEXT NOT NULL REFERENCES users(id),
+	last_modified_at BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE tasks_archive (
+	id 			TEXT PRIMARY KEY,
+	title		TEXT NOT NULL,
+	description TEXT NOT NULL,
+	created_at   TEXT NOT NULL,
+	completed_at TEXT,
+	duration 	TEXT NOT NULL,
+	category    TEXT NOT NULL,
+	tags 		TEXT,
+	toggled_at  BIGINT,
+	is_active   INTEGER NOT NULL,
+	is_completed INTEGER NOT NULL,
+	user_id 	TEXT NOT NULL REFERENCES users(id),
+	last_modified_at BIGINT NOT NULL DEFAULT 0
+);
+
+-- no foreign key to tasks, the sessions stay when their task is archived
+
+CREATE TABLE task_sessions (
+	task_id 	TEXT NOT NULL,
+	day 		TEXT NOT NULL,
+	duration_s  INTEGER NOT NULL,
+	PRIMARY KEY(task_id, day)
+);
+
+-- open tasks are read per user on every connect and rollover
+CREATE INDEX tasks_user_id_open ON tasks (user_id) WHERE is_completed = 0;
+-- the completed tasks history
+CREATE INDEX tasks_user_id_completed_at ON tasks (user_id, completed_at) WHERE is_completed = 1;
+-- loading the running timers on startup
+CREATE INDEX tasks_running ON tasks (id) WHERE is_active = 1 AND is_completed = 0;
+-- compaction picks the oldest completed tasks
+CREATE INDEX tasks_completed_at ON tasks (completed_at) WHERE is_completed = 1;
+CREATE INDEX tasks_archive_user_completed_at ON tasks_archive (user_id, completed_at);
+CREATE INDEX task_sessions_day ON task_sessions (day);
+CREATE INDEX users_timezone ON users (timezone);
\ No newline at end of file
@@ -0,0 +1,11 @@
+CREATE TABLE changes (
+	seq 		BIGSERIAL PRIMARY KEY,
+	user_id 	TEXT NOT NULL,
+	event 		TEXT NOT NULL,
+	data 		TEXT NOT NULL,
+	origin 		TEXT,
+	created_at 	BIGINT NOT NULL
+);
+
+CREATE INDEX changes_user_id_seq ON changes (user_id, seq);
+CREATE INDEX changes_created_at ON changes (created_at);
\ No newline at end of file
@@ -0,0 +1,29 @@
+-- stored key_commands that aren't a JSON object start out empty, the raw
+-- value is kept under invalid_key_commands and in the key_commands column
+BEGIN;
+
+ALTER TABLE users ADD COLUMN settings JSONB NOT NULL DEFAULT '{"categories": [], "key_commands": {}}';
+
+ALTER TABLE users ADD COLUMN settings_version INTEGER NOT NULL DEFAULT 0;
+
+CREATE FUNCTION pg_temp.parse_key_commands(value TEXT) RETURNS JSONB AS $$
+BEGIN
+	IF jsonb_typeof(value::jsonb) = 'object' THEN
+		RETURN value::jsonb;
+	END IF;
+	RETURN NULL;
+EXCEPTION WHEN invalid_text_representation THEN
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+UPDATE users SET settings = jsonb_build_object(
+	'categories', COALESCE(to_jsonb(string_to_array(NULLIF(categories, ''), ',')), '[]'::jsonb),
+	'key_commands', COALESCE(pg_temp.parse_key_commands(NULLIF(key_commands, '')), '{}'::jsonb)
+);
+
+UPDATE users SET settings = settings || jsonb_build_object('invalid_key_commands', key_commands)
+WHERE NULLIF(key_commands, '') IS NOT NULL
+	AND pg_temp.parse_key_commands(key_commands) IS NULL;
+
+COMMIT;
\ No newline at end of file
@@ -0,0 +1,38 @@
+-- sessions keep the title, category and tags their task had when the day
+-- was rolled over, so history outlives edits and deletes of the task
+BEGIN;
+
+ALTER TABLE task_sessions
+	ADD COLUMN user_id 		TEXT,
+	ADD COLUMN title 		TEXT,
+	ADD COLUMN description 	TEXT,
+	ADD COLUMN category 	TEXT,
+	ADD COLUMN tags 		TEXT,
+	ADD COLUMN created_at 	TEXT;
+
+UPDATE task_sessions s SET
+	user_id = t.user_id,
+	title = t.title,
+	description = t.description,
+	category = t.category,
+	tags = t.tags,
+	created_at = t.created_at
+FROM (
+	SELECT id, user_id, title, description, category, tags, created_at FROM tasks
+	UNION ALL
+	SELECT id, user_id, title, description, category, tags, created_at FROM tasks_archive
+) t
+WHERE t.id = s.task_id;
+
+DELETE FROM task_sessions WHERE user_id IS NULL;
+
+ALTER TABLE task_sessions
+	ALTER COLUMN user_id SET NOT NULL,
+	ALTER COLUMN title SET NOT NULL,
+	ALTER COLUMN description SET NOT NULL,
+	ALTER COLUMN category SET NOT NULL,
+	ALTER COLUMN created_at SET NOT NULL;
+
+CREATE INDEX task_sessions_user_id_day ON task_sessions (user_id, day);
+
+COMMIT;
\ No newline at end of file
@@ -0,0 +1,37 @@
+-- every user numbers their own changes, the counter lives on the user row
+-- and is bumped by the insert, so a rolled back write leaves no hole in it
+BEGIN;
+
+ALTER TABLE users ADD COLUMN change_seq BIGINT NOT NULL DEFAULT 0;
+
+ALTER TABLE changes ADD COLUMN user_seq BIGINT NOT NULL DEFAULT 0;
+
+UPDATE changes SET user_seq = numbered.user_seq
+FROM (
+	SELECT seq, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY seq) AS user_seq
+	FROM changes
+) numbered
+WHERE changes.seq = numbered.seq;
+
+UPDATE users SET change_seq = counts.user_seq
+FROM (
+	SELECT user_id, MAX(user_seq) AS user_seq
+	FROM changes
+	GROUP BY user_id
+) counts
+WHERE users.id = counts.user_id;
+
+CREATE FUNCTION next_user_change_seq() RETURNS trigger AS $$
+BEGIN
+	UPDATE users SET change_seq = change_seq + 1
+	WHERE id = NEW.user_id
+	RETURNING change_seq INTO NEW.user_seq;
+	NEW.user_seq := COALESCE(NEW.user_seq, 0);
+	RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER changes_user_seq BEFORE INSERT ON changes
+FOR EACH ROW EXECUTE FUNCTION next_user_change_seq();
+
+COMMIT;
\ No newline at end of file
@@ -0,0 +1,9 @@
+CREATE TABLE task_sessions (
+	task_id 	TEXT NOT NULL,
+	day 		DATE NOT NULL,
+	duration_s  INTEGER NOT NULL,
+	PRIMARY KEY(task_id, day),
+	FOREIGN KEY(task_id) REFERENCES tasks(id)
+) WITHOUT ROWID;
+
+CREATE INDEX tasks_user_id_is_completed ON tasks (user_id, is_completed);
\ No newline at end of file
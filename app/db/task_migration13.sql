@@ -0,0 +1,33 @@
+-- sessions keep the title, category and tags their task had when the day
+-- was rolled over, so history outlives edits and deletes of the task
+BEGIN;
+
+CREATE TABLE task_sessions_copy (
+	task_id 	TEXT NOT NULL,
+	day 		DATE NOT NULL,
+	duration_s  INTEGER NOT NULL,
+	user_id 	TEXT NOT NULL,
+	title		TEXT NOT NULL,
+	description TEXT NOT NULL,
+	category    TEXT NOT NULL,
+	tags 		TEXT,
+	created_at   DATE NOT NULL,
+	PRIMARY KEY(task_id, day),
+	FOREIGN KEY(user_id) REFERENCES users(id)
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO task_sessions_copy
+SELECT s.task_id, s.day, s.duration_s, t.user_id, t.title, t.description, t.category, t.tags, t.created_at
+FROM task_sessions s
+JOIN (
+	SELECT id, user_id, title, description, category, tags, created_at FROM tasks
+	UNION ALL
+	SELECT id, user_id, title, description, category, tags, created_at FROM tasks_archive
+) t ON t.id = s.task_id;
+
+DROP TABLE task_sessions;
+ALTER TABLE task_sessions_copy RENAME TO task_sessions;
+
+CREATE INDEX task_sessions_user_id_day ON task_sessions (user_id, day);
+
+COMMIT;
\ No newline at end of file
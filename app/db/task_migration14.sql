@@ -0,0 +1,30 @@
+-- every user numbers their own changes, the counter lives on the user row
+-- and is bumped by the insert, so a rolled back write leaves no hole in it
+BEGIN;
+
+ALTER TABLE users ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE changes ADD COLUMN user_seq INTEGER NOT NULL DEFAULT 0;
+
+UPDATE changes SET user_seq = (
+	SELECT COUNT(*)
+	FROM changes older
+	WHERE older.user_id = changes.user_id AND older.seq <= changes.seq
+);
+
+UPDATE users SET change_seq = COALESCE(
+	(SELECT MAX(user_seq) FROM changes WHERE changes.user_id = users.id),
+	0
+);
+
+CREATE TRIGGER changes_user_seq AFTER INSERT ON changes
+BEGIN
+	UPDATE users SET change_seq = change_seq + 1 WHERE id = NEW.user_id;
+	UPDATE changes SET user_seq = COALESCE(
+		(SELECT change_seq FROM users WHERE id = NEW.user_id),
+		0
+	)
+	WHERE seq = NEW.seq;
+END;
+
+COMMIT;
\ No newline at end of file
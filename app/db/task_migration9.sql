@@ -0,0 +1,18 @@
+CREATE TABLE tasks_archive (
+	id 			TEXT PRIMARY KEY,
+	title		TEXT NOT NULL,
+	description TEXT NOT NULL,
+	created_at   DATE NOT NULL,
+	completed_at DATE,
+	duration 	TEXT NOT NULL,
+	category    TEXT NOT NULL,
+	tags 		TEXT,
+	toggled_at  INTEGER,
+	is_active   INTEGER NOT NULL,
+	is_completed INTEGER NOT NULL,
+	user_id 	TEXT NOT NULL,
+	last_modified_at INTEGER NOT NULL DEFAULT(0),
+	FOREIGN KEY(user_id) REFERENCES users(id)
+);
+
+CREATE INDEX tasks_archive_user_completed_at ON tasks_archive (user_id, completed_at);
\ No newline at end of file
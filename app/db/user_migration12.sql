@@ -0,0 +1,41 @@
+-- categories are split into a JSON array here rather than quoted by hand,
+-- so names with quotes, backslashes or control characters survive. Stored
+-- key_commands that aren't a JSON object start out empty, the raw value is
+-- kept under invalid_key_commands and in the key_commands column.
+BEGIN;
+
+ALTER TABLE users ADD COLUMN settings TEXT NOT NULL DEFAULT '{"categories":[],"key_commands":{}}';
+
+ALTER TABLE users ADD COLUMN settings_version INTEGER NOT NULL DEFAULT 0;
+
+WITH RECURSIVE split(id, position, item, rest) AS (
+	SELECT id, 0, '', categories || ','
+	FROM users
+	WHERE categories IS NOT NULL AND categories != ''
+	UNION ALL
+	SELECT id, position + 1, substr(rest, 1, instr(rest, ',') - 1), substr(rest, instr(rest, ',') + 1)
+	FROM split
+	WHERE rest != ''
+)
+UPDATE users SET settings = json_object(
+	'categories', json((
+		SELECT json_group_array(item)
+		FROM (
+			SELECT item
+			FROM split
+			WHERE split.id = users.id AND position > 0
+			ORDER BY position
+		)
+	)),
+	'key_commands', CASE
+		WHEN json_valid(key_commands) AND json_type(key_commands) = 'object' THEN json(key_commands)
+		ELSE json('{}')
+	END
+);
+
+UPDATE users SET settings = json_set(settings, '$.invalid_key_commands', key_commands)
+WHERE key_commands IS NOT NULL
+	AND key_commands != ''
+	AND NOT (json_valid(key_commands) AND json_type(key_commands) = 'object');
+
+COMMIT;
\ No newline at end of file
@@ -0,0 +1 @@
+ALTER TABLE users ADD COLUMN timezone TEXT NOT NULL DEFAULT "Europe/Bucharest"
\ No newline at end of file
@@ -0,0 +1 @@
+ALTER TABLE users ADD COLUMN last_rollover_day TEXT
\ No newline at end of file
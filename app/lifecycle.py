@@ -0,0 +1,112 @@
+import asyncio
+import hmac
+import os
+import random
+from functools import wraps
+
+# Seconds a drain waits for in-flight work and queued messages
+drain_timeout = 20.0
+
+# Clients are told to reconnect spread over this window, after a short
+# delay that gives the next instance time to come up
+reconnect_delay_ms = 2000
+reconnect_spread_ms = 10000
+
+# Token a POST /api/drain and a GET /api/monitor must send in the
+# X-Drain-Token header. Without one only requests from the host itself
+# may drain the instance or read its monitor.
+drain_token = os.environ.get("TASKBAR_DRAIN_TOKEN", "")
+local_hosts = ("127.0.0.1", "::1", "localhost")
+
+lifecycle_state = {
+    "draining": False,
+    "drained": None,
+    "in_flight": 0,
+    "idle": None,
+}
+
+
+def is_draining():
+    return lifecycle_state["draining"]
+
+
+def may_drain(token: str | None, host: str | None):
+    """
+    Checks a drain request, see drain_token
+
+    :params
+        token: string | None - the X-Drain-Token header
+        host: string | None - the address the request came from
+
+    :returns - boolean
+    """
+    if drain_token:
+        return hmac.compare_digest((token or "").encode(), drain_token.encode())
+    return host in local_hosts
+
+
+def tracked(func):
+    """
+    Decorator for socket handlers and scheduler jobs. Counts the calls in
+    progress so a drain can wait for their db work to finish.
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        if lifecycle_state["idle"] is None:
+            lifecycle_state["idle"] = asyncio.Event()
+        lifecycle_state["in_flight"] += 1
+        lifecycle_state["idle"].clear()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            lifecycle_state["in_flight"] -= 1
+            if lifecycle_state["in_flight"] == 0:
+                lifecycle_state["idle"].set()
+
+    return wrapper
+
+
+def start_draining():
+    """
+    Puts the server in drain mode
+
+    :returns - boolean, False if a drain was already started
+    """
+    if lifecycle_state["draining"]:
+        return False
+
+    lifecycle_state["draining"] = True
+    lifecycle_state["drained"] = asyncio.Event()
+    return True
+
+
+def finish_draining():
+    lifecycle_state["drained"].set()
+
+
+async def wait_drained():
+    await lifecycle_state["drained"].wait()
+
+
+async def wait_in_flight(timeout: float):
+    """
+    Waits up to timeout seconds for the tracked calls in progress
+
+    :returns - boolean, True if nothing is in flight anymore
+    """
+    if lifecycle_state["in_flight"] == 0:
+        return True
+    try:
+        await asyncio.wait_for(lifecycle_state["idle"].wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        print(f"{lifecycle_state['in_flight']} calls still in flight after {timeout}s")
+        return False
+
+
+def reconnect_after_ms(index: int, count: int):
+    """
+    Staggered, jittered reconnect delay of the index-th of count clients
+    """
+    spread = reconnect_spread_ms * index / max(count, 1)
+    return int(reconnect_delay_ms + spread + random.uniform(0, 250))
@@ -1,14 +1,21 @@
 import socketio
+import asyncio
 import json
-import time
+import random
 from datetime import datetime
-from zoneinfo import ZoneInfo
-from uuid import uuid4
-from fastapi import FastAPI
+from fastapi import FastAPI, Body, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from app.models import create_user, get_user_settings, update_user_categories, update_user_commands, get_non_completed_tasks, get_completed_tasks_by_uid, fetch_active_tasks_by_user, create_task, toggle_task, edit_task, complete_task, delete_task, init_db_conns, close_db_conns
-from app.utility import duration_str_to_int, duration_int_to_str
+from app.storage import get_user_snapshot, update_user_categories, update_user_commands, update_user_setting, update_user_timezone, get_non_completed_tasks, get_completed_tasks_by_uid, fetch_active_tasks_by_user, create_task, toggle_task, edit_task, complete_task, delete_task, apply_task_batch, init_db_conns, close_db_conns
+from app.rollover import scheduler, sync_rollover_jobs, ensure_user_rolled_over, is_valid_timezone, rollover_days
+from app.archive import schedule_compaction
+from app.timers import load_active_timers, record_toggle, record_create, record_operations, stop_timer, get_user_timers, get_timer_stats
+from app.task_timers import now_ms, compute_create
+from app.outbound import flush_queues, get_outbound_stats
+from app.realtime import active_connections, create_realtime_server, mount_realtime, parse_auth, ensure_user, register_connection, unregister_connection, emitter_to_associated_sids, search_associated_sid_by_id, emit_to_user, disconnect_all, get_realtime_stats
+from app.websockets_server import sio as test_sio
+from app.changefeed import notify_changes, start_dispatcher, stop_dispatcher, get_user_changes, get_changefeed_stats
+from app.lifecycle import tracked, may_drain, is_draining, start_draining, finish_draining, wait_drained, wait_in_flight, reconnect_after_ms, drain_timeout
+from app.monitor import monitored, start_monitor, stop_monitor, get_monitor_report
 
 # Create FastAPI app
 app = FastAPI()
@@ -23,121 +30,175 @@ app.add_middleware(
 )
 
 # Create a Socket.IO server
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+sio = create_realtime_server()
+
+mount_realtime(app, "/ws/taskbar", sio)
+# Different server for another app, sharing the connection registry
+mount_realtime(app, "/ws/test", test_sio)
+
+
+async def announce_changes(user_ids: set[str]):
+    """
+    Rollover callback, the rolled over tasks are in the change feed
+    already so the dispatcher only needs to be woken up
+    """
+    notify_changes()
+
+
+# Largest number of operations accepted in one tasks_batch call
+max_batch_operations = 500
+
+# Handshakes doing db work at the same time, and how many may wait for a
+# slot before new connections are refused with a retry hint
+max_concurrent_handshakes = 20
+max_pending_handshakes = 500
+handshake_retry_base_ms = 1000
+handshake_retry_max_ms = 30000
+handshake_slots = asyncio.Semaphore(max_concurrent_handshakes)
+handshake_state = {"pending": 0}
+
+
+def handshake_retry_after_ms():
+    """
+    Backoff hint for refused connections, growing with the queue and
+    jittered so the clients don't all come back at once
+    """
+    load = handshake_state["pending"] / max_concurrent_handshakes
+    retry_after_ms = handshake_retry_base_ms * (1 + load) * random.uniform(0.5, 1.5)
+    return int(min(retry_after_ms, handshake_retry_max_ms))
+
+
+async def handshake(sid: str, environ: dict):
+    """
+    Registers the connection, makes sure the user exists and sends the
+    device everything it needs in one socket_connected event
+    """
+    user = parse_auth(environ)
+    if user is None:
+        raise socketio.exceptions.ConnectionRefusedError("Missing user details")
+
+    # Create the user in the database, returning users are known already
+    if not await ensure_user(user):
+        raise socketio.exceptions.ConnectionRefusedError(
+            {"retry_after_ms": handshake_retry_after_ms()})
 
-app.mount("/ws/taskbar", socketio.ASGIApp(sio, socketio_path=""))
-""" Different server potentially for another app.
-sio2 = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', logger=True, engineio_logger=True)
-app.mount("/ws/test", socketio.ASGIApp(sio2, socketio_path=""))
-"""
-
-
-async def midnight_task_refresh():
-    user_ids = []
-    timezone = ZoneInfo("Europe/Bucharest")
-    now = datetime.now(timezone)
-    now_datetime_formated = now.strftime("%Y-%m-%d %H:%M:%S")
+    # Store connection details
+    register_connection(sio, sid, user)
+
+    await apply_lazy_rollover(sid)
+
+    was_fetched, snapshot = await get_user_snapshot(user["id"])
+    if not was_fetched:
+        await unregister_connection(sid)
+        raise socketio.exceptions.ConnectionRefusedError(
+            {"retry_after_ms": handshake_retry_after_ms()})
+
+    # queued right after the snapshot is read, so every change with a seq
+    # above the snapshot's is delivered after it
+    await emitter_to_associated_sids("socket_connected", [sid], {
+        "id": sid,
+        "seq": snapshot["seq"],
+        "settings": snapshot["settings"],
+        "categories": snapshot["categories"],
+        "key_commands": snapshot["key_commands"],
+        "timezone": snapshot["timezone"],
+        "tasks": snapshot["tasks"]
+    })
+
+
+async def apply_lazy_rollover(sid: str):
+    """
+    Rolls the user of the given connection over if their day changed since
+    the last event, the change feed tells all of their devices when it did.
+    """
+    uid = active_connections[sid]["id"]
+    if await ensure_user_rolled_over(uid):
+        notify_changes()
+
+
+async def run_tasks_batch(uid: str, operations, origin_sid: str | None = None):
+    """
+    Applies a batch of task operations for the given user, the change feed
+    sends the applied operations to the user's other devices.
+
+    :returns - dictionary {was_applied, message, results}
+    """
+    if not isinstance(operations, list) or len(operations) > max_batch_operations:
+        return {
+            "was_applied": False,
+            "message": f"Expected a list of at most {max_batch_operations} operations",
+            "results": []
+        }
 
-    # get all the tasks that are not completed from db
-    was_fetched, non_completed_tasks = await get_non_completed_tasks()
+    was_applied, err, results = await apply_task_batch(uid, operations, origin_sid)
+    if was_applied:
+        record_operations(uid, results)
+        notify_changes()
 
-    # get last epoch time
-    last_epoch_t = int(time.time() * 1000)
+    return {"was_applied": was_applied, "message": err, "results": results}
 
-    # for each task:
-    for t in non_completed_tasks:
-        # save the id of the user we must try to send a refresher to.
-        user_ids.append(t[11])
 
-        # calculate duration int
-        dur_int = duration_str_to_int(t[5])
+@app.get("/api/tasks")
+async def tasks():
+    was_fetched, data = await get_non_completed_tasks()
+    if was_fetched:
+        return json.dumps(data)
+    else:
+        return {"message": "Could not fetch"}
 
-        # exclude tasks that with total duration 0
-        if dur_int == 0 and t[8] == 0:
-            continue
 
-        duration = int(dur_int/1000)
+@app.post("/api/tasks/batch/{id}")
+@tracked
+async def tasks_batch_by_id(id: str, operations: list = Body(...), x_socket_id: str | None = Header(None)):
+    # the sid the server gave one of the user's connected devices proves
+    # the caller is that user, the id in the path alone doesn't
+    if x_socket_id is None or active_connections.get(x_socket_id, {}).get("id") != id:
+        raise HTTPException(status_code=403, detail="Not connected as this user")
+    if await ensure_user_rolled_over(id):
+        notify_changes()
+    return await run_tasks_batch(id, operations)
 
-        if t[8] > 0:
-            duration = int((dur_int + last_epoch_t - t[8])/1000)
 
-        # update current task to new duration, completed status, last_modified_at, completed_at
-        was_updated, err = await complete_task({
-            "duration": duration_int_to_str(duration),
-            "completed_at": now_datetime_formated,
-            "id": t[0],
-            "last_modified_at": last_epoch_t
-        })
+@app.get("/api/monitor")
+async def monitor_report(request: Request, x_drain_token: str | None = Header(None)):
+    # stack samples and profiles show the code, only operators may read them
+    if not may_drain(x_drain_token, request.client.host if request.client else None):
+        raise HTTPException(status_code=403, detail="Not allowed to read the monitor")
+    return get_monitor_report()
 
-        # insert a new task with the same properties with the exception of:
-        was_created, err = await create_task(t[11], {
-            "id": str(uuid4()),
-            "title": t[1],
-            "description": t[2],
-            "created_at": now_datetime_formated,
-            "completed_at": now_datetime_formated,
-            "duration": "00:00:00",
-            "category": t[6],
-            "tags": t[7],
-            "toggled_at": last_epoch_t if t[9] == 1 else 0,
-            "is_active": t[9],
-            "is_completed": 0,
-            "last_modified_at": last_epoch_t,
-        })
 
-    # emit a refresher to all conected devices
-    for sid in active_connections:
-        uid = active_connections[sid]["id"]
-        if (uid in user_ids):
-            was_fetched, tasks_list = await fetch_active_tasks_by_user(uid)
-            were_categories_fetched, categories = await get_user_settings(id)
+@app.get("/api/realtime")
+async def realtime():
+    return get_realtime_stats()
 
-            if was_fetched:
-                print(f"issuing refresher to user id {uid}")
-                await sio.emit("tasks_refresher", {
-                    "id": sid,
-                    "tasks": tasks_list,
-                    "categories": categories
-                }, to=sid)
-            else:
-                await sio.emit("tasks_refresher", {
-                    "id": sid,
-                    "tasks": [],
-                    "categories": categories
-                }, to=sid)
 
+@app.get("/api/changes")
+async def changes():
+    return get_changefeed_stats()
 
-romania_tz = ZoneInfo("Europe/Bucharest")
-scheduler = AsyncIOScheduler(timezone=romania_tz)
-scheduler.add_job(midnight_task_refresh, "cron", hour="23", minute="59")
-scheduler.start()
 
+@app.get("/api/changes/{id}")
+async def changes_by_id(id: str, after: int = 0):
+    was_fetched, data = await get_user_changes(id, after)
+    if was_fetched:
+        return data
+    else:
+        return {"error": data}
 
-# Dictionary to store active connections
-active_connections = {}
 
+@app.get("/api/outbound")
+async def outbound():
+    return get_outbound_stats()
 
-def search_associated_sid_by_id(sid: str):
-    related_sids = []
-    for c in active_connections:
-        if c != sid and active_connections[sid]["id"] == active_connections[c]["id"]:
-            related_sids.append(c)
 
-    return related_sids
+@app.get("/api/timers")
+async def timers():
+    return get_timer_stats()
 
 
-async def emitter_to_associated_sids(ev: str, sid_lst: list[str], data: dict):
-    for sid in sid_lst:
-        await sio.emit(ev, data, to=sid)
-
-
-@app.get("/api/tasks")
-async def tasks():
-    was_fetched, data = await get_non_completed_tasks()
-    if was_fetched:
-        return json.dumps(data)
-    else:
-        return {"message": "Could not fetch"}
+@app.get("/api/timers/{id}")
+async def timers_by_id(id: str):
+    return get_user_timers(id)
 
 
 @app.get("/api/tasks/by_id/{id}")
@@ -150,153 +211,170 @@ async def tasks_by_id(id: str):
 
 
 @sio.event
+@tracked
+@monitored
 async def connect(sid, environ):
-    query_string = environ.get("QUERY_STRING", "")
+    # a draining instance takes no new connections
+    if is_draining():
+        raise socketio.exceptions.ConnectionRefusedError(
+            {"retry_after_ms": reconnect_after_ms(random.randint(0, 99), 100)})
 
-    import urllib.parse
-    params = urllib.parse.parse_qs(query_string)
-
-    id = params["id"][0]
-    email = params["email"][0]
-    first_name = params["first_name"][0]
-    last_name = params["last_name"][0]
-
-    # Store connection details
-    active_connections[sid] = {
-        "sid": sid,
-        "id": id,
-        "email": email,
-        "first_name": first_name,
-        "last_name": last_name
-    }
-    # Create the user in the database
-    response = await create_user(id, email, first_name, last_name)
-    if not response:
-        await sio.disconnect(sid)
-        return
+    # under a reconnect storm, turn away connections that would wait too
+    # long for a handshake slot and tell them when to come back
+    if handshake_state["pending"] >= max_pending_handshakes:
+        raise socketio.exceptions.ConnectionRefusedError(
+            {"retry_after_ms": handshake_retry_after_ms()})
 
-    was_fetched, tasks_list = await fetch_active_tasks_by_user(id)
-    were_settings_fetched, settings = await get_user_settings(id)
-    print(settings)
-
-    if was_fetched:
-        print("issuing refresher for reconnect")
-        await sio.emit("socket_connected", {
-            "id": sid,
-            "categories": settings["categories"],
-            "key_commands": settings["key_commands"],
-            "tasks": tasks_list
-        }, to=sid)
-    else:
-        await sio.emit("socket_connected", {
-            "id": sid,
-            "categories": settings["categories"],
-            "key_commands": settings["key_commands"],
-            "tasks": []
-        }, to=sid)
+    handshake_state["pending"] += 1
+    try:
+        async with handshake_slots:
+            await handshake(sid, environ)
+    finally:
+        handshake_state["pending"] -= 1
 
 
 @sio.event
+@tracked
+@monitored
 async def disconnect(sid):
     # Find and remove the disconnected user
-    for user_id, conn in list(active_connections.items()):
-        if conn['sid'] == sid:
-            del active_connections[user_id]
-            break
+    conn = await unregister_connection(sid)
     print(f"{sid} - disconnected")
-    await sio.emit('user-disconnected', {'sid': sid})
+    # only the user's own devices care, not every connected client
+    if conn is not None:
+        await emit_to_user(conn["id"], 'user-disconnected', {'sid': sid}, sio=sio)
 
 
 @sio.event
+@tracked
+@monitored
 async def user_updated_categories(sid, data):
     data = json.loads(data)
     was_updated = await update_user_categories(
         active_connections[sid]["id"],
-        ",".join(data)
+        data,
+        origin=sid
     )
     if was_updated:
-        await emitter_to_associated_sids(
-            "related_updated_categories",
-            search_associated_sid_by_id(sid),
-            data
-        )
+        notify_changes()
+
+
+@sio.event
+@tracked
+@monitored
+async def user_updated_timezone(sid, data):
+    timezone = json.loads(data)
+    if not is_valid_timezone(timezone):
+        return {"was_updated": False, "message": f"Unknown timezone {timezone}"}
+
+    was_updated = await update_user_timezone(
+        active_connections[sid]["id"],
+        timezone,
+        origin=sid
+    )
+    if was_updated:
+        notify_changes()
+        rollover_days.pop(active_connections[sid]["id"], None)
+        # a timezone nobody used before needs its own rollover job
+        await sync_rollover_jobs(announce_changes)
+    return {"was_updated": was_updated, "message": ""}
 
 
 @sio.event
+@tracked
+@monitored
 async def task_completed(sid, data):
-    was_updated, err = await complete_task(json.loads(data))
-    response = {"was_updated": was_updated, "message": err}
+    await apply_lazy_rollover(sid)
+    # the stored timer decides the duration, not the client's
+    task = json.loads(data)
+    was_updated, err, saved = await complete_task(task, origin=sid)
+    response = {"was_updated": was_updated, "message": err, "task": saved or task}
 
     if was_updated:
-        await emitter_to_associated_sids(
-            "related_task_deleted",
-            search_associated_sid_by_id(sid),
-            data
-        )
+        stop_timer(task["id"])
+        notify_changes()
     return response
 
 
 @sio.event
+@tracked
+@monitored
 async def task_create(sid, data):
-    was_added, err = await create_task(active_connections[sid]["id"], json.loads(data))
-    response = {"was_addded": was_added, "message": err}
+    await apply_lazy_rollover(sid)
+    uid = active_connections[sid]["id"]
+    task = compute_create(json.loads(data), now_ms())
+    was_added, err = await create_task(uid, task, origin=sid)
+    response = {"was_addded": was_added, "message": err, "task": task}
     print("Creating new task")
 
     if was_added:
-        await emitter_to_associated_sids(
-            "new_task_created",
-            search_associated_sid_by_id(sid),
-            data
-        )
+        record_create(uid, task)
+        notify_changes()
 
     return response
 
 
 @sio.event
+@tracked
+@monitored
 async def task_toggle(sid, data):
-    was_toggled, err = await toggle_task(json.loads(data))
-    response = {"was_toggled": was_toggled, "message": err}
+    await apply_lazy_rollover(sid)
+    # the server's clock and the stored timer decide toggled_at and the
+    # duration, not the client's
+    task = json.loads(data)
+    was_toggled, err, saved = await toggle_task(task, origin=sid)
+    response = {"was_toggled": was_toggled, "message": err, "task": saved or task}
     if was_toggled:
-        await emitter_to_associated_sids(
-            "related_task_toggled",
-            search_associated_sid_by_id(sid),
-            data
-        )
+        record_toggle(active_connections[sid]["id"], saved)
+        notify_changes()
 
     return response
 
 
 @sio.event
+@tracked
+@monitored
 async def task_edit(sid, data):
-    was_edited, err = await edit_task(json.loads(data))
+    await apply_lazy_rollover(sid)
+    was_edited, err = await edit_task(json.loads(data), origin=sid)
     response = {"was_edited": was_edited, "message": err}
 
     if was_edited:
-        await emitter_to_associated_sids(
-            "related_task_edited",
-            search_associated_sid_by_id(sid),
-            data
-        )
+        notify_changes()
 
     return response
 
 
 @sio.event
+@tracked
+@monitored
 async def task_delete(sid, data):
+    await apply_lazy_rollover(sid)
     id = (json.loads(data))["id"]
-    was_deleted, err = await delete_task(id)
+    was_deleted, err = await delete_task(id, origin=sid)
     response = {"was_deleted": was_deleted, "message": err}
 
     if was_deleted:
-        await emitter_to_associated_sids(
-            "related_task_deleted",
-            search_associated_sid_by_id(sid),
-            data
-        )
+        stop_timer(id)
+        notify_changes()
     return response
 
 
 @sio.event
+@tracked
+@monitored
+async def tasks_batch(sid, data):
+    await apply_lazy_rollover(sid)
+    return await run_tasks_batch(
+        active_connections[sid]["id"],
+        json.loads(data),
+        origin_sid=sid
+    )
+
+
+@sio.event
+@tracked
+@monitored
 async def get_completed_tasks(sid, data):
     now = datetime.now()
     now_formatted_start = now.strftime("%Y-%m-%d 00:00:00")
@@ -335,57 +413,169 @@ async def get_completed_tasks(sid, data):
 
 
 @sio.event
+@tracked
+@monitored
 async def request_hard_refresh(sid, data):
+    await apply_lazy_rollover(sid)
     id = active_connections[sid]["id"]
-    was_fetched, tasks_list = await fetch_active_tasks_by_user(id)
-    were_settings_fetched, settings = await get_user_settings(id)
+    was_fetched, snapshot = await get_user_snapshot(id)
 
     if was_fetched:
         print("issuing hard refresh")
         return {
             "id": sid,
-            "categories": settings["categories"],
-            "key_commands": settings["key_commands"],
-            "tasks": tasks_list
+            "seq": snapshot["seq"],
+            "settings": snapshot["settings"],
+            "categories": snapshot["categories"],
+            "key_commands": snapshot["key_commands"],
+            "timezone": snapshot["timezone"],
+            "tasks": snapshot["tasks"]
         }
     else:
         return {
             "id": sid,
-            "categories": settings["categories"],
-            "key_commands": settings["key_commands"],
+            "seq": 0,
+            "settings": {"categories": [], "key_commands": {}, "version": 0},
+            "categories": "",
+            "key_commands": "{}",
+            "timezone": "",
             "tasks": []
         }
 
 
 @sio.event
+@tracked
+@monitored
+async def get_changes(sid, data):
+    """
+    Catch up for a device that was disconnected or got a resync, data is
+    the seq of the last change it applied. With gap set, changes it missed
+    were pruned and it must request_hard_refresh, with more set it asks
+    again from the last seq returned.
+    """
+    was_fetched, result = await get_user_changes(
+        active_connections[sid]["id"],
+        int(json.loads(data))
+    )
+    if not was_fetched:
+        return {"was_fetched": False, "changes": [], "gap": False, "more": False}
+    return {"was_fetched": True, **result}
+
+
+@sio.event
+@tracked
+@monitored
 async def new_command_added(sid, data):
     id = active_connections[sid]["id"]
-    was_updated = await update_user_commands(id, data)
+    was_updated = await update_user_commands(id, data, origin=sid)
     if was_updated:
+        # clients that predate related_settings_changed still wait for this
         await emitter_to_associated_sids(
             "related_added_command",
             search_associated_sid_by_id(sid),
             data
         )
+        notify_changes()
 
 
 @sio.event
+@tracked
+@monitored
 async def command_removed(sid, data):
     id = active_connections[sid]["id"]
-    was_updated = await update_user_commands(id, data)
+    was_updated = await update_user_commands(id, data, origin=sid)
     if was_updated:
+        # clients that predate related_settings_changed still wait for this
         await emitter_to_associated_sids(
             "related_removed_command",
             search_associated_sid_by_id(sid),
             data
         )
+        notify_changes()
+
+
+@sio.event
+@tracked
+@monitored
+async def settings_update(sid, data):
+    """
+    Adds or removes one category or command. data is a JSON object
+    {op, key, value, version}, see update_user_setting. Rejected updates
+    come back with the current settings so the device can resync.
+    """
+    update = json.loads(data)
+    if not isinstance(update, dict):
+        return {"was_updated": False, "message": "Expected an object", "settings": None}
+
+    was_updated, result = await update_user_setting(
+        active_connections[sid]["id"],
+        update.get("op"),
+        update.get("key"),
+        update.get("value"),
+        update.get("version"),
+        origin=sid
+    )
+    if was_updated:
+        notify_changes()
+        return {"was_updated": True, "message": "", "version": result["version"]}
+    return {"was_updated": False, **result}
+
+
+async def drain_server():
+    """
+    Drain mode for restarts: refuses new connections, stops the scheduler,
+    tells every client when to reconnect, lets handlers in flight and the
+    outbound queues finish and then disconnects everyone.
+    """
+    if not start_draining():
+        await wait_drained()
+        return
+
+    print("draining")
+    if scheduler.running:
+        scheduler.pause()
+
+    sids = list(active_connections)
+    for index, sid in enumerate(sids):
+        await emitter_to_associated_sids("server_restarting", [sid], {
+            "reconnect_after_ms": reconnect_after_ms(index, len(sids))
+        })
+
+    # rollover and compaction jobs are tracked too
+    await wait_in_flight(drain_timeout)
+    await stop_dispatcher(sio)
+    await flush_queues(drain_timeout)
+
+    await disconnect_all()
+
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+    print("drained")
+    finish_draining()
+
+
+@app.post("/api/drain")
+async def drain(request: Request, x_drain_token: str | None = Header(None)):
+    if not may_drain(x_drain_token, request.client.host if request.client else None):
+        raise HTTPException(status_code=403, detail="Not allowed to drain")
+    await drain_server()
+    return {"drained": True}
 
 
 @app.on_event("startup")
 async def startup():
     await init_db_conns()
+    await load_active_timers()
+    await start_dispatcher(sio)
+    start_monitor()
+    await sync_rollover_jobs(announce_changes)
+    schedule_compaction()
+    scheduler.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    await drain_server()
+    await stop_monitor()
     await close_db_conns()
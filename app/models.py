@@ -1,10 +1,91 @@
 import aiosqlite
 import asyncio
-from functools import reduce
+import json
+import time
+from app.monitor import monitored
+from app.batches import batch_task_id, timer_task_ids, validate_task_batch
+from app.task_timers import now_ms, stored_timers, compute_toggle, compute_complete
+from app.queries import statements, statement_cache_size, non_completed_tasks_by_user_ids_query, task_owners_query, task_timers_query, changes_by_seqs_query, archive_tasks_queries, completed_tasks_params
 
 db_path = "app/db.db"
 db_conns = []
 
+# Change feed event of each operation, the same events the single task
+# handlers used to fan out. Completed tasks leave the open list, so other
+# devices drop them like deleted ones.
+change_events = {
+    "create": "new_task_created",
+    "edit": "related_task_edited",
+    "toggle": "related_task_toggled",
+    "complete": "related_task_deleted",
+    "delete": "related_task_deleted",
+}
+
+# Single entry settings updates, op -> statement
+setting_operations = {
+    "add_category": "add_user_category",
+    "remove_category": "remove_user_category",
+    "set_command": "set_user_command",
+    "remove_command": "remove_user_command",
+}
+
+
+def parse_settings(settings: str, version: int):
+    """
+    Returns the settings JSON of a user as a dictionary
+
+    :returns - dictionary {categories: list, key_commands: dictionary, version: int}
+    """
+    settings = json.loads(settings) if settings else {}
+    return {
+        "categories": settings.get("categories", []),
+        "key_commands": settings.get("key_commands", {}),
+        "version": version,
+    }
+
+
+def validate_setting_update(op: str, key, value):
+    """
+    Checks a single entry settings update
+
+    :returns - string, the error or "" if the update is valid
+    """
+    if op not in setting_operations:
+        return "Unknown operation"
+    if not isinstance(key, str) or not key:
+        return "Missing key"
+    # devices that still read the comma joined categories would split it
+    if op == "add_category" and "," in key:
+        return "Categories can't contain commas"
+    if op == "set_command" and value is None:
+        return "Missing value"
+    return ""
+
+
+def make_change(event: str, data, origin: str | None, user_id: str | None = None, task_id: str | None = None):
+    """
+    Builds the params of a change feed row, written in the same transaction
+    as the mutation it describes. Rows about a task can leave out the user
+    id, add_task_change looks it up from the task.
+
+    :params
+        event: string - event name the change is pushed to clients as
+        data: the payload, stored as JSON
+        origin: string | None - sid of the device that made the change
+        user_id: string
+        task_id: string
+
+    :returns - dictionary
+    """
+    return {
+        "user_id": user_id,
+        "task_id": task_id,
+        "event": event,
+        "data": json.dumps(data),
+        "origin": origin,
+        "created_at": int(time.time() * 1000),
+    }
+
 
 async def init_db_conns(db_path="app/db.db", count=10):
     """
@@ -16,7 +97,8 @@ async def init_db_conns(db_path="app/db.db", count=10):
     for i in range(count):
         db_conns.append({
             "in_use": False,
-            "conn": await aiosqlite.connect(db_path),
+            "conn": await aiosqlite.connect(
+                db_path, cached_statements=statement_cache_size),
         })
 
 
@@ -26,76 +108,126 @@ async def close_db_conns():
     """
     for db in db_conns:
         await db["conn"].close()
+    db_conns.clear()
 
 
-def get_unused_db():
+async def get_unused_db():
     """
     Will loop the list of db connections and return one that's labeled as unused.
+    When all of them are in use it waits for one to be freed.
 
     returns:
         tuple({in_use: bool, conn: db_connection}, index: int)
     """
-    for i in range(len(db_conns)):
-        if not db_conns[i]["in_use"]:
-            db_conns[i]["in_use"] = True
-            return (db_conns[i], i)
-    asyncio.sleep(0.01)
-    return get_unused_db()
+    while True:
+        for i in range(len(db_conns)):
+            if not db_conns[i]["in_use"]:
+                db_conns[i]["in_use"] = True
+                return (db_conns[i], i)
+        await asyncio.sleep(0.01)
 
 
 def free_db(index: int):
     db_conns[index]["in_use"] = False
 
 
+@monitored
 async def create_user(id: str, email: str, first_name: str, last_name: str):
     """
-    Inserts a new user into the users table.
+    Inserts a new user into the users table, existing users are left as they are.
 
     :param user_id: User's unique ID (TEXT).
     :param first_name: User's first name (TEXT).
     :param last_name: User's last name (TEXT).
     :param email: User's email (TEXT).
+
+    :returns - boolean
     """
 
-    db_obj, db_index = get_unused_db()
+    db_obj, db_index = await get_unused_db()
 
     try:
-        async with db_obj["conn"].execute("""
-            INSERT INTO users (id, first_name, last_name, email)
-            VALUES (?, ?, ?, ?)
-          """, (id, first_name, last_name, email)) as cursor:
+        async with db_obj["conn"].execute(
+            statements["create_user"],
+            (id, first_name, last_name, email)
+        ) as cursor:
             await db_obj["conn"].commit()
-            return {id, email, first_name, last_name}
+            return True
 
     except Exception as e:
         print(f"An error occurred: {e}")
-        if str(e).find("UNIQUE constraint failed: users.id") != -1:
-            return True
         return False
 
     finally:
         free_db(db_index)
 
 
+@monitored
 async def get_user_settings(id: str):
     """
-    Queries the database for the categories saved for the user
+    Queries the database for the settings saved for the user
 
     :param - id: string
 
-    :returns - string of users categories
+    :returns - tuple(boolean, {categories, key_commands, version, timezone})
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-            SELECT categories, key_commands
-            FROM users
-            WHERE id = :id
-       """, {"id": id}) as cursor:
+        async with db_conn["conn"].execute(
+            statements["get_user_settings"],
+            {"id": id}
+        ) as cursor:
             data = await cursor.fetchone()
-            return (True, {"categories": data[0], "key_commands": data[1]})
+            return (True, {
+                **parse_settings(data[0], data[1]),
+                "timezone": data[2]
+            })
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def get_user_snapshot(id: str):
+    """
+    Queries the settings and the open tasks of the user in one statement,
+    everything a device needs when it connects or refreshes
+
+    :param - id: string
+
+    :returns - tuple(boolean, {settings, categories, key_commands, timezone, seq, tasks: list of tasks})
+        categories and key_commands are the comma joined and JSON string
+        versions of settings, for devices that don't read settings yet
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_user_snapshot"],
+            {"id": id}
+        ) as cursor:
+            data = await cursor.fetchall()
+            if not data:
+                return (False, "User not found")
+
+            settings = parse_settings(data[0][0], data[0][1])
+            return (True, {
+                "settings": settings,
+                "categories": ",".join(settings["categories"]),
+                "key_commands": json.dumps(settings["key_commands"]),
+                "timezone": data[0][2],
+                # changes up to this seq are already part of the snapshot
+                "seq": data[0][3] or 0,
+                # the left join gives one row without a task for users with no open tasks
+                "tasks": [row[4:] for row in data if row[4] is not None]
+            })
 
     except Exception as e:
         print(e)
@@ -105,58 +237,286 @@ async def get_user_settings(id: str):
         free_db(db_index)
 
 
-async def update_user_categories(id: str, categories: str):
+async def replace_user_setting(id: str, statement: str, name: str, value, origin: str | None):
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements[statement],
+            {"id": id, name: json.dumps(value)}
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if row is not None:
+            await db_conn["conn"].execute(
+                statements["add_change"],
+                make_change("related_settings_changed", {
+                    "op": f"set_{name}",
+                    "key": None,
+                    "value": value,
+                    "version": row[0],
+                }, origin, user_id=id)
+            )
+        await db_conn["conn"].commit()
+        return row is not None
+    except Exception as e:
+        print(e)
+        await db_conn["conn"].rollback()
+        return False
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def update_user_categories(id: str, categories: list, origin: str | None = None):
+    """
+    Replaces all categories of the given user
+
+    :params - id: string
+    :params - categories: [string]
+    :params - origin: string | None - sid the change came from
+
+    :returns - boolean
+    """
+    return await replace_user_setting(
+        id, "update_user_categories", "categories", categories, origin)
+
+
+@monitored
+async def update_user_commands(id: str, commands: str, origin: str | None = None):
+    """
+    Replaces all commands of the given user
+
+    :params - id: string
+    :params - commands: string - JSON object
+    :params - origin: string | None - sid the change came from
+
+    :returns - boolean
+    """
+    try:
+        commands = json.loads(commands)
+    except ValueError as e:
+        print(e)
+        return False
+
+    return await replace_user_setting(
+        id, "update_user_commands", "commands", commands, origin)
+
+
+@monitored
+async def update_user_setting(
+        id: str,
+        op: str,
+        key: str,
+        value=None,
+        version: int | None = None,
+        origin: str | None = None
+):
+    """
+    Adds or removes a single category or command of the given user in one
+    statement, other entries are left as they are. With a version the
+    update only applies if nobody changed the settings since the device
+    saw that version.
+
+    :params
+        id: string
+        op: string - add_category | remove_category | set_command | remove_command
+        key: string - the category or the command's key
+        value: the command, set_command only
+        version: int | None - settings version the device last saw
+        origin: string | None - sid the change came from
+
+    :returns - tuple(boolean, dictionary)
+        {version} of the updated settings, or
+        {message, settings} with the current settings if the update was rejected
+    """
+    error = validate_setting_update(op, key, value)
+    if error:
+        return (False, {"message": error, "settings": None})
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements[setting_operations[op]],
+            {"id": id, "key": key, "value": json.dumps(value), "version": version}
+        ) as cursor:
+            row = await cursor.fetchone()
+
+        if row is None:
+            await db_conn["conn"].rollback()
+            # a stale version, the device resyncs from the current settings
+            async with db_conn["conn"].execute(
+                statements["get_user_settings"],
+                {"id": id}
+            ) as cursor:
+                current = await cursor.fetchone()
+            return (False, {
+                "message": "Settings were changed by another device" if current else "User not found",
+                "settings": parse_settings(current[0], current[1]) if current else None
+            })
+
+        await db_conn["conn"].execute(
+            statements["add_change"],
+            make_change("related_settings_changed", {
+                "op": op,
+                "key": key,
+                "value": value,
+                "version": row[0],
+            }, origin, user_id=id)
+        )
+        await db_conn["conn"].commit()
+        return (True, {"version": row[0]})
+
+    except Exception as e:
+        print(e)
+        await db_conn["conn"].rollback()
+        return (False, {"message": str(e), "settings": None})
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def update_user_timezone(id: str, timezone: str, origin: str | None = None):
     """
-    Updates the categories properties of the given user
+    Updates the timezone the user's day boundary is computed in
 
     :params - id: string
-    :params - categories: string
+    :params - timezone: string - IANA name, e.g. Europe/Bucharest
+    :params - origin: string | None - sid the change came from
 
     :returns - boolean
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-            UPDATE users
-            SET
-                categories = :categories
-            WHERE
-                id = :id
-           """, {"id": id, "categories": categories}) as cursor:
+        async with db_conn["conn"].execute(
+            statements["update_user_timezone"],
+            {"id": id, "timezone": timezone}
+        ) as cursor:
+            await db_conn["conn"].execute(
+                statements["add_change"],
+                make_change("related_updated_timezone", timezone, origin, user_id=id)
+            )
             await db_conn["conn"].commit()
             return True
     except Exception as e:
         print(e)
+        await db_conn["conn"].rollback()
         return False
 
     finally:
         free_db(db_index)
 
 
-async def update_user_commands(id: str, commands: str):
+@monitored
+async def get_user_timezones():
+    """
+    Returns the distinct timezones users are registered in
+
+    :returns - tuple(boolean, list of strings)
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_user_timezones"]
+        ) as cursor:
+            data = await cursor.fetchall()
+            return (True, [row[0] for row in data])
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def get_user_ids_by_timezone(timezone: str):
+    """
+    Returns the ids of the users in the given timezone that have open tasks
+
+    :params - timezone: string
+
+    :returns - tuple(boolean, list of strings)
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_user_ids_by_timezone"],
+            {"timezone": timezone}
+        ) as cursor:
+            data = await cursor.fetchall()
+            return (True, [row[0] for row in data])
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def get_user_rollover_state(id: str):
     """
-    Updates the commands properties of the given user
+    Returns the timezone of the user and the day its open tasks belong to
 
     :params - id: string
-    :params - commands: string
 
-    :returns - boolean
+    :returns - tuple(boolean, {timezone: string, last_rollover_day: string | None})
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_user_rollover_state"],
+            {"id": id}
+        ) as cursor:
+            data = await cursor.fetchone()
+            return (True, {"timezone": data[0], "last_rollover_day": data[1]})
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def claim_user_rollover_day(id: str, stored_day: str | None, day: str):
+    """
+    Moves the user's rollover day from stored_day to day. Only one caller
+    can win the move, so concurrent connects won't roll over twice.
+
+    :params
+        id: string
+        stored_day: string | None - the day the caller read before
+        day: string - YYYY-MM-DD
+
+    :returns - boolean, True if this caller moved the day
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-            UPDATE users
-            SET
-                key_commands = :commands
-            WHERE
-                id = :id
-           """, {"id": id, "commands": commands}) as cursor:
+        async with db_conn["conn"].execute(
+            statements["claim_user_rollover_day"],
+            {"id": id, "stored_day": stored_day, "day": day}
+        ) as cursor:
             await db_conn["conn"].commit()
-            return True
+            return cursor.rowcount == 1
+
     except Exception as e:
         print(e)
         return False
@@ -165,6 +525,37 @@ async def update_user_commands(id: str, commands: str):
         free_db(db_index)
 
 
+@monitored
+async def set_users_rollover_day(user_ids: [str], day: str):
+    """
+    Sets the rollover day of all given users
+
+    :params
+        user_ids: [string]
+        day: string - YYYY-MM-DD
+
+    :returns - boolean
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        await db_conn["conn"].executemany(
+            statements["set_users_rollover_day"],
+            [{"id": id, "day": day} for id in user_ids]
+        )
+        await db_conn["conn"].commit()
+        return True
+
+    except Exception as e:
+        print(e)
+        return False
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
 async def get_tasks():
     """
     Will return all the tasks in the database
@@ -172,12 +563,10 @@ async def get_tasks():
     return list
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-                SELECT * FROM tasks
-            """) as cursor:
+        async with db_conn["conn"].execute(statements["get_tasks"]) as cursor:
             data = await cursor.fetchall()
             return (True, data)
     except Exception as e:
@@ -187,6 +576,7 @@ async def get_tasks():
         free_db(db_index)
 
 
+@monitored
 async def get_non_completed_tasks():
     """
     Will return a list of tasks that don't have is_completed=1
@@ -194,15 +584,41 @@ async def get_non_completed_tasks():
     returns: list
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_non_completed_tasks"]
+        ) as cursor:
+            data = await cursor.fetchall()
+            return (True, data)
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def get_non_completed_tasks_by_user_ids(user_ids: [str]):
+    """
+    Will return the tasks that don't have is_completed=1
+    for the given users only
+
+    :params - user_ids: [string]
+
+    :returns - tuple(boolean, list of tasks)
+    """
+
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-            SELECT *
-            FROM tasks
-            WHERE is_completed = 0
-            ORDER BY user_id
-               """) as cursor:
+        async with db_conn["conn"].execute(
+            non_completed_tasks_by_user_ids_query(len(user_ids)),
+            tuple(user_ids)
+        ) as cursor:
             data = await cursor.fetchall()
             return (True, data)
 
@@ -214,6 +630,7 @@ async def get_non_completed_tasks():
         free_db(db_index)
 
 
+@monitored
 async def get_completed_tasks_by_uid(
         id: str,
         start_date: str,
@@ -238,46 +655,19 @@ async def get_completed_tasks_by_uid(
         list of tasks
     """
 
-    tags_query = reduce(
-        lambda x, y: x + f"AND tags LIKE '%{y}%' ", tags, "")
-
-    search_query = ""
-    if search_key:
-        search_query = f"AND title LIKE '%{search_key}%'"
-
-    category_query = ""
-    if selected_category:
-        category_query = f"AND category = '{selected_category}'"
-
-    final_query = f"""
-                SELECT
-                    id,
-                    title,
-                    description,
-                    category,
-                    created_at,
-                    completed_at,
-                    duration,
-                    tags
-                FROM tasks
-                WHERE user_id = :uid
-                    AND is_completed = 1
-                    AND completed_at >= :start_date
-                    AND completed_at <= :end_date
-                   {tags_query}
-                    {search_query}
-                    {category_query}
-               """
-    print(final_query)
-
-    db_conn, db_index = get_unused_db()
+    final_query, params = completed_tasks_params(
+        id,
+        start_date,
+        end_date,
+        tags,
+        search_key,
+        selected_category
+    )
+
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute(final_query, {
-            "uid": id,
-            "start_date": start_date,
-            "end_date": end_date
-        }) as cursor:
+        async with db_conn["conn"].execute(final_query, params) as cursor:
             data = await cursor.fetchall()
             return (True, data)
 
@@ -289,6 +679,51 @@ async def get_completed_tasks_by_uid(
         free_db(db_index)
 
 
+@monitored
+async def get_running_tasks():
+    """
+    Returns the tasks whose timer is currently running
+
+    :returns - tuple(boolean, list of (id, user_id, duration, toggled_at))
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_running_tasks"]
+        ) as cursor:
+            data = await cursor.fetchall()
+            return (True, data)
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+async def read_task_timers(conn, task_ids: list):
+    """
+    Reads the stored timer of the given open tasks, call inside the
+    transaction that saves the computed timers
+
+    :params
+        conn: aiosqlite connection
+        task_ids: [string]
+
+    :returns - dictionary, from stored_timers
+    """
+    task_ids = list(set(task_ids))
+    if not task_ids:
+        return {}
+
+    async with conn.execute(task_timers_query(len(task_ids)), tuple(task_ids)) as cursor:
+        return stored_timers(await cursor.fetchall())
+
+
+@monitored
 async def fetch_active_tasks_by_user(id):
     """
     Queries the database and returns all active tasks of a given user.
@@ -298,14 +733,12 @@ async def fetch_active_tasks_by_user(id):
     :returns - list of tasks
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-            SELECT *
-            FROM tasks
-            WHERE user_id = :id AND is_completed = 0
-            """, {"id": id}
+        async with db_conn["conn"].execute(
+            statements["fetch_active_tasks_by_user"],
+            {"id": id}
         ) as cursor:
             data = await cursor.fetchall()
             return (True, data)
@@ -317,11 +750,13 @@ async def fetch_active_tasks_by_user(id):
         free_db(db_index)
 
 
-async def create_task(user_id, obj):
+@monitored
+async def create_task(user_id, obj, origin: str | None = None):
     """
     Insert a new task into the tasks table.
 
     :params - id - string.
+    :params - origin - string | None, sid the change came from
     :params - dictionary: {
         title: string
         description: string
@@ -338,61 +773,40 @@ async def create_task(user_id, obj):
     }
     """
 
-    db_obj, db_index = get_unused_db()
+    db_obj, db_index = await get_unused_db()
 
     try:
-        async with db_obj["conn"].execute("""
-        INSERT INTO tasks (
-        	id,
-            title,
-            description,
-            created_at,
-            completed_at,
-            duration,
-            category,
-            tags,
-            toggled_at,
-            is_active,
-            is_completed,
-            user_id,
-            last_modified_at
-        ) VALUES (
-                :id,
-                :title,
-                :description,
-                :created_at,
-                :completed_at,
-                :duration,
-                :category,
-                :tags,
-                :toggled_at,
-                :is_active,
-                :is_completed,
-                :user_id,
-                :last_modified_at
-            )
-        """, {
+        async with db_obj["conn"].execute(statements["create_task"], {
             "user_id": user_id,
             **obj
         }) as cursor:
+            await db_obj["conn"].execute(
+                statements["add_change"],
+                make_change("new_task_created", obj, origin, user_id=user_id)
+            )
             await db_obj["conn"].commit()
             return (True, "")
 
     except aiosqlite.IntegrityError as e:
         print(e)
+        await db_obj["conn"].rollback()
         return (False, str(e))
 
     except Exception as e:
         print(e)
+        await db_obj["conn"].rollback()
         return (False, str(e))
 
     finally:
         free_db(db_index)
 
 
-async def toggle_task(obj):
+@monitored
+async def toggle_task(obj, origin: str | None = None):
     """
-    Will toggle the given task to active
+    Will toggle the given task to active. The duration and toggled_at are
+    computed from the stored timer and the server's clock, the client's
+    are ignored.
 
     params: dictionary - {
         uuid: string,
@@ -401,38 +815,50 @@ async def toggle_task(obj):
         duration: string
         last_modified_at: integer
     }
+    origin: string | None - sid the change came from
+
+    :returns - tuple(boolean, string, dictionary | None - the saved task)
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-                UPDATE tasks SET
-                is_active = :is_active,
-                toggled_at =  :toggled_at,
-                duration = :duration,
-                last_modified_at = :last_modified_at
-                WHERE id = :uuid
-            """, obj
-                                           ) as cursor:
+        # the write lock keeps the timer from changing between the read
+        # and the update
+        await db_conn["conn"].execute("BEGIN IMMEDIATE")
+        timers = await read_task_timers(db_conn["conn"], [obj["uuid"]])
+        task = compute_toggle(obj, now_ms(), timers)
+        if task is None:
+            await db_conn["conn"].rollback()
+            return (False, "Task not found", None)
+
+        async with db_conn["conn"].execute(statements["toggle_task"], task) as cursor:
+            await db_conn["conn"].execute(
+                statements["add_task_change"],
+                make_change("related_task_toggled", task, origin, task_id=task["uuid"])
+            )
             await db_conn["conn"].commit()
-            print(f"task id: {obj['uuid']} was now toggled to {
-                  obj['is_active']}")
-            return (True, "")
+            print(f"task id: {task['uuid']} was now toggled to {
+                  task['is_active']}")
+            return (True, "", task)
     except aiosqlite.IntegrityError as e:
         print(e)
-        return (False, str(e))
+        await db_conn["conn"].rollback()
+        return (False, str(e), None)
 
     except Exception as e:
         print(e)
-        return (False, str(e))
+        await db_conn["conn"].rollback()
+        return (False, str(e), None)
     finally:
         free_db(db_index)
 
 
-async def complete_task(obj):
+@monitored
+async def complete_task(obj, origin: str | None = None):
     """
-    Will mark the given task as completed and
+    Will mark the given task as completed. The duration is computed
+    from the stored timer and the server's clock, the client's is ignored.
 
     :params - dict - {
         duration: string,
@@ -440,82 +866,472 @@ async def complete_task(obj):
         id: string,
         last_modified_at: integer
     }
+    :params - origin: string | None - sid the change came from
+
+    :returns - tuple(boolean, string, dictionary | None - the saved task)
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-            UPDATE tasks SET
-            is_active = 0,
-            is_completed = 1,
-            duration = :duration,
-            completed_at = :completed_at,
-            last_modified_at = :last_modified_at
-            WHERE id = :id
-            """, obj) as cursor:
+        await db_conn["conn"].execute("BEGIN IMMEDIATE")
+        timers = await read_task_timers(db_conn["conn"], [obj["id"]])
+        task = compute_complete(obj, now_ms(), timers)
+        if task is None:
+            await db_conn["conn"].rollback()
+            return (False, "Task not found", None)
+
+        async with db_conn["conn"].execute(statements["complete_task"], task) as cursor:
+            await db_conn["conn"].execute(
+                statements["add_task_change"],
+                make_change("related_task_deleted", task, origin, task_id=task["id"])
+            )
             await db_conn["conn"].commit()
-            return (True, "")
+            return (True, "", task)
     except Exception as e:
         print(e)
-        return (False, str(e))
+        await db_conn["conn"].rollback()
+        return (False, str(e), None)
 
     finally:
         free_db(db_index)
 
 
-async def edit_task(obj):
+def session_key(id: str):
+    """
+    Splits the id of a history entry of a rolled over day, task_id@YYYY-MM-DD,
+    see completed_tasks_query
+
+    :returns - dictionary {task_id, day} or None if the id isn't one
+    """
+    task_id, separator, day = id.rpartition("@")
+    if not separator or not task_id:
+        return None
+    return {"task_id": task_id, "day": day}
+
+
+@monitored
+async def edit_task(obj, origin: str | None = None):
     print(f"Object received on edit \n {obj}")
     """
-    Will update the given task to given parameters
+    Will update the given task to given parameters. Completed tasks may be
+    in the archive, and history entries of rolled over days are sessions.
 
     :params - dictionary - {
+        id: string
         title: string,
         description: string,
         category: string,
         tags: string,
         last_modified_at: integer
     }
+    :params - origin: string | None - sid the change came from
+
+    :returns - tuple(boolean, string)
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
 
     try:
-        async with db_conn["conn"].execute("""
-            UPDATE tasks SET
-                title = :title,
-                description = :description,
-                category = :category,
-                tags = :tags,
-                last_modified_at = :last_modified_at
-            WHERE id = :id
-            """, obj) as cursor:
-            await db_conn["conn"].commit()
-            return (True, "")
+        change = make_change("related_task_edited", obj, origin, task_id=obj["id"])
+        async with db_conn["conn"].execute(statements["edit_task"], obj) as cursor:
+            edited = cursor.rowcount
+        if edited == 0:
+            # completed tasks may have been moved to the archive
+            async with db_conn["conn"].execute(
+                statements["edit_archived_task"],
+                obj
+            ) as cursor:
+                edited = cursor.rowcount
+
+        if edited:
+            await db_conn["conn"].execute(statements["add_task_change"], change)
+        elif session := session_key(obj["id"]):
+            async with db_conn["conn"].execute(
+                statements["edit_task_session"],
+                {**obj, **session}
+            ) as cursor:
+                edited = cursor.rowcount
+            await db_conn["conn"].execute(
+                statements["add_session_change"],
+                {**change, **session}
+            )
+
+        if edited == 0:
+            await db_conn["conn"].rollback()
+            return (False, "Task not found")
+
+        await db_conn["conn"].commit()
+        return (True, "")
 
     except Exception as e:
         print(e)
+        await db_conn["conn"].rollback()
         return (False, str(e))
 
     finally:
         free_db(db_index)
 
 
-async def delete_task(uuid: str):
+@monitored
+async def delete_task(uuid: str, origin: str | None = None):
     """
-    Delete the given task by id
+    Delete the given task by id, from either tier, or the given history
+    entry of a rolled over day. Deleting a task keeps its sessions, the
+    days it was tracked on stay in the history.
 
     param: uuid: string
+    param: origin: string | None - sid the change came from
+
+    :returns - tuple(boolean, string)
+    """
+
+    db_conn, db_index = await get_unused_db()
+    try:
+        change = make_change("related_task_deleted", {"id": uuid}, origin, task_id=uuid)
+        # recorded first, the owner is looked up from the task
+        await db_conn["conn"].execute(statements["add_task_change"], change)
+        async with db_conn["conn"].execute(
+            statements["delete_task"],
+            {"uuid": uuid}
+        ) as cursor:
+            deleted = cursor.rowcount
+        if deleted == 0:
+            # completed tasks may have been moved to the archive
+            async with db_conn["conn"].execute(
+                statements["delete_archived_task"],
+                {"uuid": uuid}
+            ) as cursor:
+                deleted = cursor.rowcount
+
+        if deleted == 0 and (session := session_key(uuid)):
+            await db_conn["conn"].execute(
+                statements["add_session_change"],
+                {**change, **session}
+            )
+            async with db_conn["conn"].execute(
+                statements["delete_task_session"],
+                session
+            ) as cursor:
+                deleted = cursor.rowcount
+
+        if deleted == 0:
+            await db_conn["conn"].rollback()
+            return (False, "Task not found")
+
+        await db_conn["conn"].commit()
+        return (True, "")
+
+    except Exception as e:
+        print(e)
+        await db_conn["conn"].rollback()
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+def rollover_change(session: dict):
+    """
+    Change feed row telling the user's devices a task was rolled over
+    """
+    return make_change("related_task_rolled_over", {
+        "id": session["task_id"],
+        "day": session["day"],
+        "duration": "00:00:00",
+        "toggled_at": session["toggled_at"],
+        "last_modified_at": session["last_modified_at"],
+    }, None, user_id=session["user_id"])
+
+
+def batch_changes(user_id: str, results: list, origin: str | None):
+    """
+    Change feed rows of the applied operations of a batch, in the order
+    apply_task_batch applies them, the order they were sent
+    """
+    return [
+        make_change(change_events[r["op"]], r["task"], origin, user_id=user_id)
+        for r in results
+        if r["ok"]
+    ]
+
+
+@monitored
+async def add_task_sessions(sessions: list):
+    """
+    Records the time tracked on a day for each given task and resets the
+    task's duration for the next day, in one transaction.
+
+    :params - sessions: list of {
+        task_id: string
+        user_id: string
+        day: string - YYYY-MM-DD
+        duration_s: integer
+        toggled_at: integer - Epoch Unix Timestamp the timer restarts at, 0 if paused
+        last_modified_at: integer
+    }
+
+    :returns - tuple(boolean, string)
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        await db_conn["conn"].executemany(
+            statements["add_task_session"],
+            sessions
+        )
+        await db_conn["conn"].executemany(
+            statements["reset_rolled_over_task"],
+            sessions
+        )
+        await db_conn["conn"].executemany(
+            statements["add_change"],
+            [rollover_change(session) for session in sessions]
+        )
+        await db_conn["conn"].commit()
+        return (True, "")
+
+    except Exception as e:
+        print(e)
+        await db_conn["conn"].rollback()
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def archive_completed_tasks(cutoff: str, limit: int):
+    """
+    Moves up to limit completed tasks with completed_at before cutoff
+    from tasks into tasks_archive, in one transaction.
+
+    :params
+        cutoff: string - YYYY-MM-DD HH:MM:SS
+        limit: int
+
+    :returns - tuple(boolean, int | string) - number of tasks moved or the error
     """
 
-    db_conn, db_index = get_unused_db()
+    db_conn, db_index = await get_unused_db()
+
     try:
-        async with db_conn["conn"].execute("""
-            DELETE FROM tasks
-            WHERE id = :uuid
-            """, {"uuid": uuid}) as cursor:
+        async with db_conn["conn"].execute(
+            statements["get_archivable_task_ids"],
+            {"cutoff": cutoff, "limit": limit}
+        ) as cursor:
+            task_ids = tuple(row[0] for row in await cursor.fetchall())
+
+        if not task_ids:
+            return (True, 0)
+
+        insert_query, delete_query = archive_tasks_queries(len(task_ids))
+        await db_conn["conn"].execute(insert_query, task_ids)
+        await db_conn["conn"].execute(delete_query, task_ids)
+        await db_conn["conn"].commit()
+        return (True, len(task_ids))
+
+    except Exception as e:
+        print(e)
+        await db_conn["conn"].rollback()
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def apply_task_batch(user_id: str, operations: list, origin: str | None = None):
+    """
+    Applies a list of task operations of one user in a single transaction,
+    in the order they were sent, one executemany per run of operations of
+    the same type. Toggles and completes are computed from the stored
+    timers like toggle_task and complete_task. Invalid operations are
+    skipped and reported, if the transaction fails nothing is applied.
+
+    :params
+        user_id: string
+        operations: list of {
+            op: string - create | edit | toggle | complete | delete
+            data: dictionary - same as the matching single task function
+        }
+        origin: string | None - sid the batch came from
+
+    :returns - tuple(boolean, string, list of {index, op, id, ok, message, task})
+        task is the saved data of the ok operations
+    """
+
+    task_ids = list({batch_task_id(o) for o in operations} - {None})
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        await db_conn["conn"].execute("BEGIN IMMEDIATE")
+        owners = {}
+        archived_ids = set()
+        if task_ids:
+            async with db_conn["conn"].execute(
+                task_owners_query(len(task_ids)),
+                tuple(task_ids) * 2
+            ) as cursor:
+                for task_id, owner, is_archived in await cursor.fetchall():
+                    owners[task_id] = owner
+                    if is_archived:
+                        archived_ids.add(task_id)
+
+        timers = await read_task_timers(db_conn["conn"], timer_task_ids(operations))
+        results, runs = validate_task_batch(
+            user_id, operations, owners, timers, now_ms(), archived_ids)
+
+        for name, params in runs:
+            await db_conn["conn"].executemany(statements[name], params)
+        await db_conn["conn"].executemany(
+            statements["add_change"],
+            batch_changes(user_id, results, origin)
+        )
+        await db_conn["conn"].commit()
+        return (True, "", results)
+
+    except Exception as e:
+        print(e)
+        await db_conn["conn"].rollback()
+        return (False, str(e), [])
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def get_last_change_seq():
+    """
+    Returns the seq of the newest change in the change feed
+
+    :returns - tuple(boolean, int | string)
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_last_change_seq"]
+        ) as cursor:
+            data = await cursor.fetchone()
+            return (True, data[0])
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def get_first_change_seq():
+    """
+    Returns the seq of the oldest change still in the change feed, the
+    ones before it were pruned
+
+    :returns - tuple(boolean, int | None | string)
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_first_change_seq"]
+        ) as cursor:
+            data = await cursor.fetchone()
+            return (True, data[0])
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def get_changes(after_seq: int, limit: int, user_id: str | None = None):
+    """
+    Returns the changes after the given seq in order, of all users or
+    of one user only
+
+    :params
+        after_seq: int
+        limit: int
+        user_id: string | None
+
+    :returns - tuple(boolean, list of (seq, user_id, event, data, origin, user_seq))
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["get_user_changes" if user_id else "get_changes"],
+            {"after_seq": after_seq, "limit": limit, "user_id": user_id}
+        ) as cursor:
+            data = await cursor.fetchall()
+            return (True, data)
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def get_changes_by_seqs(seqs: [int]):
+    """
+    Returns the changes with the given seqs that exist, in order
+
+    :params - seqs: [int]
+
+    :returns - tuple(boolean, list of (seq, user_id, event, data, origin, user_seq))
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            changes_by_seqs_query(len(seqs)),
+            tuple(seqs)
+        ) as cursor:
+            data = await cursor.fetchall()
+            return (True, data)
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+    finally:
+        free_db(db_index)
+
+
+@monitored
+async def prune_changes(before: int):
+    """
+    Deletes the changes written before the given time
+
+    :params - before: int - epoch ms
+
+    :returns - tuple(boolean, int | string) - number of changes deleted or the error
+    """
+
+    db_conn, db_index = await get_unused_db()
+
+    try:
+        async with db_conn["conn"].execute(
+            statements["prune_changes"],
+            {"before": before}
+        ) as cursor:
             await db_conn["conn"].commit()
-            return (True, "")
+            return (True, cursor.rowcount)
 
     except Exception as e:
         print(e)
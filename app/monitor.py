@@ -0,0 +1,254 @@
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import types
+from collections import deque
+from datetime import datetime
+from functools import wraps
+
+# Opt-in: set TASKBAR_MONITOR=1 to enable the loop lag monitor and the
+# slow handler hook. TASKBAR_MONITOR_PROFILE=1 additionally runs slow
+# candidates under cProfile (expensive, use only while investigating).
+monitor_enabled = os.environ.get("TASKBAR_MONITOR", "0") == "1"
+profile_enabled = os.environ.get("TASKBAR_MONITOR_PROFILE", "0") == "1"
+
+# Seconds between loop heartbeats.
+lag_interval = float(os.environ.get("TASKBAR_MONITOR_INTERVAL", "0.1"))
+# Seconds of loop lag after which a stack sample of the loop thread is taken.
+lag_threshold = float(os.environ.get("TASKBAR_MONITOR_LAG_THRESHOLD", "0.25"))
+# Seconds a handler or model coroutine may keep the loop busy before it is
+# reported. Time spent awaiting I/O or other coroutines doesn't count.
+slow_threshold = float(os.environ.get("TASKBAR_MONITOR_SLOW_THRESHOLD", "0.5"))
+
+slow_events = deque(maxlen=100)
+lag_stats = {
+    "current": 0.0,
+    "max": 0.0,
+    "samples": 0,
+    "stalls": 0,
+}
+
+monitor_state = {
+    "task": None,
+    "watchdog": None,
+    "stop": None,
+    "heartbeat": 0.0,
+    "loop_thread_id": None,
+    "profiling": False,
+}
+
+
+def record_slow_event(kind: str, name: str, duration: float, details: str = ""):
+    """
+    Appends an entry to the ring buffer of recent slow events
+
+    :params
+        kind: string - "loop_stall", "handler" or "profile"
+        name: string - name of the coroutine or "event_loop"
+        duration: float - seconds
+        details: string - stack sample or profiler output
+    """
+    slow_events.append({
+        "kind": kind,
+        "name": name,
+        "duration": round(duration, 4),
+        "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "details": details,
+    })
+
+
+def get_monitor_report():
+    """
+    Returns the current lag statistics and the recent slow events
+
+    :returns - dictionary
+    """
+    return {
+        "enabled": monitor_enabled,
+        "lag": dict(lag_stats),
+        "slow_events": list(slow_events),
+    }
+
+
+async def loop_lag_probe():
+    """
+    Sleeps for lag_interval in a loop and measures how late it wakes up.
+    The difference is the time the event loop was busy with something else.
+    """
+    while True:
+        start = time.perf_counter()
+        monitor_state["heartbeat"] = start
+        await asyncio.sleep(lag_interval)
+        lag = max(0.0, time.perf_counter() - start - lag_interval)
+        monitor_state["heartbeat"] = time.perf_counter()
+
+        lag_stats["current"] = round(lag, 4)
+        lag_stats["max"] = max(lag_stats["max"], round(lag, 4))
+        lag_stats["samples"] += 1
+
+
+def loop_watchdog(stop: threading.Event):
+    """
+    Runs in a separate thread. While the loop is blocked the probe above
+    can't run, so the stack of the loop thread is sampled from here.
+    """
+    sampled_heartbeat = None
+
+    while not stop.wait(lag_interval):
+        heartbeat = monitor_state["heartbeat"]
+        blocked_for = time.perf_counter() - heartbeat - lag_interval
+
+        if blocked_for < lag_threshold or heartbeat == sampled_heartbeat:
+            continue
+
+        # only one sample per stall
+        sampled_heartbeat = heartbeat
+        lag_stats["stalls"] += 1
+        frame = sys._current_frames().get(monitor_state["loop_thread_id"])
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        print(f"event loop blocked for {blocked_for:.3f}s")
+        record_slow_event("loop_stall", "event_loop", blocked_for, stack)
+
+
+def start_monitor():
+    """
+    Starts the lag probe on the running loop and the watchdog thread.
+    Does nothing unless the monitor was enabled.
+    """
+    if not monitor_enabled or monitor_state["task"] is not None:
+        return
+
+    monitor_state["loop_thread_id"] = threading.get_ident()
+    monitor_state["heartbeat"] = time.perf_counter()
+    monitor_state["task"] = asyncio.get_running_loop().create_task(
+        loop_lag_probe())
+
+    stop = threading.Event()
+    watchdog = threading.Thread(
+        target=loop_watchdog, args=(stop,), name="loop-watchdog", daemon=True)
+    monitor_state["stop"] = stop
+    monitor_state["watchdog"] = watchdog
+    watchdog.start()
+
+
+async def stop_monitor():
+    """
+    Stops the lag probe and the watchdog thread if they were started
+    """
+    if monitor_state["task"] is None:
+        return
+
+    monitor_state["stop"].set()
+    monitor_state["task"].cancel()
+    try:
+        await monitor_state["task"]
+    except asyncio.CancelledError:
+        pass
+
+    monitor_state["task"] = None
+    monitor_state["watchdog"] = None
+    monitor_state["stop"] = None
+
+
+@types.coroutine
+def pass_through(future):
+    """
+    Hands a future a stepped coroutine waits on to the task running it
+    """
+    return (yield future)
+
+
+async def run_stepped(coro, profiler, timing: dict):
+    """
+    Runs a coroutine one step at a time, the stretches between two awaits,
+    with profiler enabled only while its own steps run. Other coroutines
+    run while it waits and stay out of the profile and the busy time.
+
+    :params
+        coro: the coroutine to run
+        profiler: cProfile.Profile | None
+        timing: dictionary - busy is set to the seconds the coroutine kept
+            the loop busy, also when it raises
+
+    :returns - the coroutine's result
+    """
+    value = None
+    error = None
+    while True:
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            if error is not None:
+                future = coro.throw(error)
+            else:
+                future = coro.send(value)
+        except StopIteration as e:
+            return e.value
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            timing["busy"] += time.perf_counter() - start
+
+        try:
+            value = await pass_through(future)
+            error = None
+        except BaseException as e:
+            value = None
+            error = e
+
+
+def monitored(func):
+    """
+    Decorator for socket handlers and model coroutines. Reports calls that
+    keep the loop busy longer than slow_threshold. When profiling is
+    enabled the call is also run under cProfile and the top entries are
+    kept with the event. Only the call's own steps are timed and profiled,
+    see run_stepped.
+
+    cProfile can't run nested, so while one call is being profiled others
+    are only timed.
+    """
+    if not monitor_enabled:
+        return func
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        profiler = None
+        if profile_enabled and not monitor_state["profiling"]:
+            monitor_state["profiling"] = True
+            profiler = cProfile.Profile()
+
+        timing = {"busy": 0.0}
+        start = time.perf_counter()
+        try:
+            return await run_stepped(func(*args, **kwargs), profiler, timing)
+        finally:
+            duration = timing["busy"]
+
+            if profiler is not None:
+                monitor_state["profiling"] = False
+
+            if duration >= slow_threshold:
+                details = f"wall time {time.perf_counter() - start:.3f}s\n"
+                if profiler is not None:
+                    out = io.StringIO()
+                    pstats.Stats(profiler, stream=out).sort_stats(
+                        "cumulative").print_stats(15)
+                    details += out.getvalue()
+
+                print(f"{func.__name__} kept the loop busy for {duration:.3f}s")
+                record_slow_event(
+                    "profile" if profiler else "handler",
+                    func.__name__,
+                    duration,
+                    details
+                )
+
+    return wrapper
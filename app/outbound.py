@@ -0,0 +1,245 @@
+import asyncio
+import json
+import os
+from collections import deque
+
+# Most messages waiting for one socket before the overflow policy applies.
+queue_size = int(os.environ.get("TASKBAR_OUTBOUND_QUEUE_SIZE", "100"))
+
+# What to do when a socket's queue is full:
+#   drop_oldest - drop the oldest queued message
+#   coalesce    - drop an older queued message of the same event about the
+#                 same task, which the new one supersedes, else the oldest
+#   disconnect  - disconnect the socket, it will resync with a hard refresh
+overflow_policy = os.environ.get("TASKBAR_OUTBOUND_POLICY", "coalesce")
+
+# Change feed batches are never dropped silently. A full queue merges a
+# new batch into the newest queued one, up to max_merged_changes changes.
+# When a batch has to be dropped after all, the socket gets resync_event
+# instead and catches up with get_changes or a hard refresh. The reason of
+# a resync is "overflow", or "gap" when the change feed itself lost track
+# of the user's changes and only a hard refresh helps, see app/changefeed.py.
+changes_event = "changes"
+resync_event = "resync"
+max_merged_changes = 1000
+
+# sid -> {queue: deque, ready: asyncio.Event, task: asyncio.Task, max_depth: int}
+outbound_queues = {}
+outbound_stats = {
+    "sent": 0,
+    "dropped": 0,
+    "coalesced": 0,
+    "disconnected": 0,
+    "resyncs": 0,
+    "failed": 0,
+}
+
+
+def open_queue(sio, sid: str):
+    """
+    Creates the send queue of a connection and the task draining it
+    """
+    if sid in outbound_queues:
+        return
+
+    outbound = {
+        "queue": deque(),
+        "ready": asyncio.Event(),
+        "task": None,
+        "max_depth": 0,
+    }
+    outbound_queues[sid] = outbound
+    outbound["task"] = asyncio.get_running_loop().create_task(
+        drain_queue(sio, sid, outbound))
+
+
+async def close_queue(sid: str):
+    """
+    Drops the queue of a closed connection and stops its drain task
+    """
+    outbound = outbound_queues.pop(sid, None)
+    if outbound is None:
+        return
+
+    outbound["task"].cancel()
+    try:
+        await outbound["task"]
+    except asyncio.CancelledError:
+        pass
+
+
+async def drain_queue(sio, sid: str, outbound: dict):
+    """
+    Sends the queued messages of one connection in order. A slow socket only
+    slows down its own task, never the handler that queued the message.
+    """
+    queue = outbound["queue"]
+    while True:
+        while queue:
+            ev, data = queue.popleft()
+            try:
+                await sio.emit(ev, data, to=sid)
+                outbound_stats["sent"] += 1
+            except Exception as e:
+                print(f"failed to emit {ev} to {sid}: {e}")
+                outbound_stats["failed"] += 1
+
+        outbound["ready"].clear()
+        await outbound["ready"].wait()
+
+
+def message_task_id(data):
+    """
+    Returns the task id a message is about, if any
+    """
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return None
+    if isinstance(data, dict):
+        return data.get("id") or data.get("uuid")
+    return None
+
+
+def merge_changes(queue: deque, data):
+    """
+    Appends the changes of a new batch to the newest queued batch
+
+    :returns - boolean, False if there is no batch to merge into or the
+        merged batch would be too large
+    """
+    for i in range(len(queue) - 1, -1, -1):
+        queued_ev, queued_data = queue[i]
+        if queued_ev != changes_event:
+            continue
+        merged = queued_data["changes"] + data["changes"]
+        if len(merged) > max_merged_changes:
+            return False
+        queue[i] = (queued_ev, {**queued_data, "changes": merged})
+        return True
+    return False
+
+
+def replace_changes_with_resync(queue: deque):
+    """
+    Drops every queued change feed batch and queues one resync message in
+    place of the first, the socket fetches the changes it missed itself.
+    Call after a batch was dropped from the front of the queue.
+    """
+    position = 0
+    reason = "overflow"
+    for i in range(len(queue) - 1, -1, -1):
+        queued_ev, queued_data = queue[i]
+        if queued_ev in (changes_event, resync_event):
+            if queued_ev == resync_event and queued_data["reason"] == "gap":
+                reason = "gap"
+            position = i
+            del queue[i]
+            outbound_stats["dropped"] += 1
+    queue.insert(position, (resync_event, {"reason": reason}))
+    outbound_stats["resyncs"] += 1
+
+
+def make_room(sio, sid: str, outbound: dict, ev: str, data):
+    """
+    Applies the overflow policy to a full queue
+
+    :returns - boolean, False if the message must not be queued
+    """
+    queue = outbound["queue"]
+
+    if overflow_policy == "disconnect":
+        print(f"{sid} is too slow, disconnecting")
+        outbound_stats["disconnected"] += 1
+        queue.clear()
+        asyncio.get_running_loop().create_task(sio.disconnect(sid))
+        return False
+
+    if ev == changes_event:
+        if merge_changes(queue, data):
+            outbound_stats["coalesced"] += 1
+            return False
+        if any(queued_ev in (changes_event, resync_event) for queued_ev, _ in queue):
+            # too many changes pending, the new batch is dropped too
+            outbound_stats["dropped"] += 1
+            replace_changes_with_resync(queue)
+            return False
+
+    if overflow_policy == "coalesce":
+        task_id = message_task_id(data)
+        if task_id is not None:
+            for i, (queued_ev, queued_data) in enumerate(queue):
+                if queued_ev == ev and message_task_id(queued_data) == task_id:
+                    del queue[i]
+                    outbound_stats["coalesced"] += 1
+                    return True
+
+    dropped_ev, dropped_data = queue.popleft()
+    outbound_stats["dropped"] += 1
+    if dropped_ev in (changes_event, resync_event):
+        replace_changes_with_resync(queue)
+        if len(queue) >= queue_size:
+            # the resync took the freed slot, drop the oldest other message
+            others = [i for i, (queued_ev, _) in enumerate(queue) if queued_ev != resync_event]
+            if not others:
+                return False
+            del queue[others[0]]
+            outbound_stats["dropped"] += 1
+    return True
+
+
+def enqueue(sio, sid: str, ev: str, data):
+    """
+    Queues a message for a connection without waiting for it to be sent
+
+    :params
+        sio: socketio.AsyncServer
+        sid: string
+        ev: string - event name
+        data: the payload
+    """
+    outbound = outbound_queues.get(sid)
+    if outbound is None:
+        return
+
+    if len(outbound["queue"]) >= queue_size and not make_room(sio, sid, outbound, ev, data):
+        return
+
+    outbound["queue"].append((ev, data))
+    outbound["max_depth"] = max(outbound["max_depth"], len(outbound["queue"]))
+    outbound["ready"].set()
+
+
+async def flush_queues(timeout: float):
+    """
+    Waits up to timeout seconds for every queue to be sent
+
+    :returns - boolean, True if all queues are empty
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while any(o["queue"] for o in outbound_queues.values()):
+        if loop.time() >= deadline:
+            print("outbound queues not flushed in time")
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+def get_outbound_stats():
+    """
+    Returns the queue depth metrics and the overflow counters
+
+    :returns - dictionary
+    """
+    depths = [len(o["queue"]) for o in outbound_queues.values()]
+    return {
+        "policy": overflow_policy,
+        "queue_size": queue_size,
+        "queues": len(depths),
+        "depth": sum(depths),
+        "max_depth": max(depths, default=0),
+        "max_depth_seen": max((o["max_depth"] for o in outbound_queues.values()), default=0),
+        **outbound_stats,
+    }
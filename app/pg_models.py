@@ -0,0 +1,798 @@
+import asyncpg
+import json
+import os
+from app.monitor import monitored
+from app.queries import statement_cache_size
+from app.pg_queries import statements, statement_args, rollover_session_columns, completed_tasks_params
+from app.batches import batch_task_id, timer_task_ids, validate_task_batch
+from app.task_timers import now_ms, stored_timers, compute_toggle, compute_complete
+from app.models import session_key, make_change, rollover_change, batch_changes, setting_operations, parse_settings, validate_setting_update
+
+# Postgres implementation of the storage functions, see app/storage.py.
+# Every function has the signature and return values of its SQLite version
+# in app/models.py, rows are returned as tuples in the same column order.
+# The schema is in app/db/pg_migration*.sql.
+pg_dsn = os.environ.get("TASKBAR_PG_DSN", "postgresql://localhost/taskbar")
+
+pool_state = {
+    "pool": None,
+}
+
+
+def rows_to_tuples(rows):
+    return [tuple(row) for row in rows]
+
+
+def affected_rows(status: str):
+    """
+    Returns the row count of a command status like "UPDATE 1"
+    """
+    return int(status.rsplit(" ", 1)[-1])
+
+
+async def write_changes(conn, name: str, changes: list):
+    """
+    Takes the change feed locks of the users the given changes are for and
+    writes them with the named statement, add_change, add_task_change or
+    add_session_change. Must run inside the transaction of the mutation,
+    as late in it as possible.
+    """
+    if not changes:
+        return
+    await conn.execute(
+        statements["lock_changes"],
+        list({change["user_id"] for change in changes if change["user_id"] is not None}),
+        list({change["task_id"] for change in changes if change["task_id"] is not None})
+    )
+    await conn.executemany(
+        statements[name],
+        [statement_args(name, change) for change in changes]
+    )
+
+
+async def init_db_conns(dsn=pg_dsn, count=10):
+    """
+    Will start a pool of connections to the Postgres server
+
+    :param dsn: string - connection string, default TASKBAR_PG_DSN
+    :param count: int - most connections the pool opens, default 10
+    """
+    pool_state["pool"] = await asyncpg.create_pool(
+        dsn,
+        min_size=1,
+        max_size=count,
+        statement_cache_size=statement_cache_size,
+    )
+
+
+async def close_db_conns():
+    """
+    Will close the pool and its connections
+    """
+    if pool_state["pool"] is not None:
+        await pool_state["pool"].close()
+        pool_state["pool"] = None
+
+
+@monitored
+async def create_user(id: str, email: str, first_name: str, last_name: str):
+    """
+    Inserts a new user into the users table, existing users are left as they are.
+
+    :returns - boolean
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            await conn.execute(statements["create_user"], id, first_name, last_name, email)
+            return True
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return False
+
+
+@monitored
+async def get_user_settings(id: str):
+    """
+    Queries the database for the categories saved for the user
+
+    :returns - tuple(boolean, {categories, key_commands, version, timezone})
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            data = await conn.fetchrow(statements["get_user_settings"], id)
+            return (True, {
+                **parse_settings(data[0], data[1]),
+                "timezone": data[2]
+            })
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def get_user_snapshot(id: str):
+    """
+    Queries the settings and the open tasks of the user in one statement
+
+    :returns - tuple(boolean, {settings, categories, key_commands, timezone, seq, tasks: list of tasks})
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            data = rows_to_tuples(await conn.fetch(statements["get_user_snapshot"], id))
+            if not data:
+                return (False, "User not found")
+
+            settings = parse_settings(data[0][0], data[0][1])
+            return (True, {
+                "settings": settings,
+                "categories": ",".join(settings["categories"]),
+                "key_commands": json.dumps(settings["key_commands"]),
+                "timezone": data[0][2],
+                "seq": data[0][3] or 0,
+                "tasks": [row[4:] for row in data if row[4] is not None]
+            })
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+async def update_user_field(statement: str, id: str, value: str, change: dict | None = None):
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(statements[statement], id, value)
+                await write_changes(conn, "add_change", [change] if change else [])
+            return True
+
+    except Exception as e:
+        print(e)
+        return False
+
+
+async def replace_user_setting(id: str, statement: str, name: str, value, origin: str | None):
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                version = await conn.fetchval(statements[statement], id, json.dumps(value))
+                if version is None:
+                    return False
+                await write_changes(conn, "add_change", [
+                    make_change("related_settings_changed", {
+                        "op": f"set_{name}",
+                        "key": None,
+                        "value": value,
+                        "version": version,
+                    }, origin, user_id=id)
+                ])
+            return True
+
+    except Exception as e:
+        print(e)
+        return False
+
+
+@monitored
+async def update_user_categories(id: str, categories: list, origin: str | None = None):
+    """
+    Replaces all categories of the given user
+
+    :returns - boolean
+    """
+    return await replace_user_setting(
+        id, "update_user_categories", "categories", categories, origin)
+
+
+@monitored
+async def update_user_commands(id: str, commands: str, origin: str | None = None):
+    """
+    Replaces all commands of the given user, commands is a JSON object
+
+    :returns - boolean
+    """
+    try:
+        commands = json.loads(commands)
+    except ValueError as e:
+        print(e)
+        return False
+
+    return await replace_user_setting(
+        id, "update_user_commands", "commands", commands, origin)
+
+
+@monitored
+async def update_user_setting(
+        id: str,
+        op: str,
+        key: str,
+        value=None,
+        version: int | None = None,
+        origin: str | None = None
+):
+    """
+    Adds or removes a single category or command of the given user,
+    see app.models.update_user_setting
+
+    :returns - tuple(boolean, dictionary)
+    """
+    error = validate_setting_update(op, key, value)
+    if error:
+        return (False, {"message": error, "settings": None})
+
+    name = setting_operations[op]
+    params = {"id": id, "key": key, "value": json.dumps(value), "version": version}
+
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                new_version = await conn.fetchval(
+                    statements[name], *statement_args(name, params))
+                if new_version is not None:
+                    await write_changes(conn, "add_change", [
+                        make_change("related_settings_changed", {
+                            "op": op,
+                            "key": key,
+                            "value": value,
+                            "version": new_version,
+                        }, origin, user_id=id)
+                    ])
+
+            if new_version is None:
+                # a stale version, the device resyncs from the current settings
+                current = await conn.fetchrow(statements["get_user_settings"], id)
+                return (False, {
+                    "message": "Settings were changed by another device" if current else "User not found",
+                    "settings": parse_settings(current[0], current[1]) if current else None
+                })
+            return (True, {"version": new_version})
+
+    except Exception as e:
+        print(e)
+        return (False, {"message": str(e), "settings": None})
+
+
+@monitored
+async def update_user_timezone(id: str, timezone: str, origin: str | None = None):
+    """
+    Updates the timezone the user's day boundary is computed in
+
+    :returns - boolean
+    """
+    return await update_user_field(
+        "update_user_timezone",
+        id,
+        timezone,
+        make_change("related_updated_timezone", timezone, origin, user_id=id)
+    )
+
+
+async def fetch_column(statement: str, *args):
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            data = await conn.fetch(statements[statement], *args)
+            return (True, [row[0] for row in data])
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+async def fetch_rows(statement: str, *args):
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            data = await conn.fetch(statements[statement], *args)
+            return (True, rows_to_tuples(data))
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def get_user_timezones():
+    """
+    Returns the distinct timezones users are registered in
+
+    :returns - tuple(boolean, list of strings)
+    """
+    return await fetch_column("get_user_timezones")
+
+
+@monitored
+async def get_user_ids_by_timezone(timezone: str):
+    """
+    Returns the ids of the users in the given timezone that have open tasks
+
+    :returns - tuple(boolean, list of strings)
+    """
+    return await fetch_column("get_user_ids_by_timezone", timezone)
+
+
+@monitored
+async def get_user_rollover_state(id: str):
+    """
+    Returns the timezone of the user and the day its open tasks belong to
+
+    :returns - tuple(boolean, {timezone: string, last_rollover_day: string | None})
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            data = await conn.fetchrow(statements["get_user_rollover_state"], id)
+            return (True, {"timezone": data[0], "last_rollover_day": data[1]})
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def claim_user_rollover_day(id: str, stored_day: str | None, day: str):
+    """
+    Moves the user's rollover day from stored_day to day. Only one caller
+    can win the move, so concurrent connects won't roll over twice.
+
+    :returns - boolean, True if this caller moved the day
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            status = await conn.execute(
+                statements["claim_user_rollover_day"], id, stored_day, day)
+            return affected_rows(status) == 1
+
+    except Exception as e:
+        print(e)
+        return False
+
+
+@monitored
+async def set_users_rollover_day(user_ids: [str], day: str):
+    """
+    Sets the rollover day of all given users
+
+    :returns - boolean
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            await conn.execute(statements["set_users_rollover_day"], list(user_ids), day)
+            return True
+
+    except Exception as e:
+        print(e)
+        return False
+
+
+@monitored
+async def get_tasks():
+    """
+    Will return all the tasks in the database
+    """
+    return await fetch_rows("get_tasks")
+
+
+@monitored
+async def get_non_completed_tasks():
+    """
+    Will return a list of tasks that don't have is_completed=1
+    """
+    return await fetch_rows("get_non_completed_tasks")
+
+
+@monitored
+async def get_non_completed_tasks_by_user_ids(user_ids: [str]):
+    """
+    Will return the tasks that don't have is_completed=1
+    for the given users only
+
+    :returns - tuple(boolean, list of tasks)
+    """
+    return await fetch_rows("get_non_completed_tasks_by_user_ids", list(user_ids))
+
+
+@monitored
+async def get_completed_tasks_by_uid(
+        id: str,
+        start_date: str,
+        end_date: str,
+        tags: [str],
+        search_key: str,
+        selected_category: str
+):
+    """
+    Queries the db for all completed tasks of a given user
+
+    :returns - tuple(boolean, list of tasks)
+    """
+    final_query, args = completed_tasks_params(
+        id,
+        start_date,
+        end_date,
+        tags,
+        search_key,
+        selected_category
+    )
+
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            data = await conn.fetch(final_query, *args)
+            return (True, rows_to_tuples(data))
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def get_running_tasks():
+    """
+    Returns the tasks whose timer is currently running
+
+    :returns - tuple(boolean, list of (id, user_id, duration, toggled_at))
+    """
+    return await fetch_rows("get_running_tasks")
+
+
+async def read_task_timers(conn, task_ids: list):
+    """
+    Reads and locks the stored timer of the given open tasks until the
+    transaction of conn ends, see app.models.read_task_timers
+
+    :returns - dictionary, from stored_timers
+    """
+    task_ids = list(set(task_ids))
+    if not task_ids:
+        return {}
+    return stored_timers(rows_to_tuples(
+        await conn.fetch(statements["lock_task_timers"], task_ids)))
+
+
+@monitored
+async def fetch_active_tasks_by_user(id):
+    """
+    Queries the database and returns all active tasks of a given user.
+
+    :returns - tuple(boolean, list of tasks)
+    """
+    return await fetch_rows("fetch_active_tasks_by_user", id)
+
+
+async def execute_task_statement(name: str, params: dict, change_statement: str, change: dict):
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(statements[name], *statement_args(name, params))
+                await write_changes(conn, change_statement, [change])
+            return (True, "")
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+async def execute_timer_statement(name: str, obj: dict, task_id: str, compute, event: str, origin: str | None):
+    """
+    Computes the timer of a toggle or complete from the stored one and
+    saves it in the same transaction, see app.models.toggle_task
+
+    :params
+        compute: compute_toggle | compute_complete
+
+    :returns - tuple(boolean, string, dictionary | None - the saved task)
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                timers = await read_task_timers(conn, [task_id])
+                task = compute(obj, now_ms(), timers)
+                if task is None:
+                    return (False, "Task not found", None)
+
+                await conn.execute(statements[name], *statement_args(name, task))
+                await write_changes(conn, "add_task_change", [
+                    make_change(event, task, origin, task_id=task_id)])
+            return (True, "", task)
+
+    except Exception as e:
+        print(e)
+        return (False, str(e), None)
+
+
+@monitored
+async def create_task(user_id, obj, origin: str | None = None):
+    """
+    Insert a new task into the tasks table, see app.models.create_task
+
+    :returns - tuple(boolean, string)
+    """
+    return await execute_task_statement(
+        "create_task",
+        {"user_id": user_id, **obj},
+        "add_change",
+        make_change("new_task_created", obj, origin, user_id=user_id)
+    )
+
+
+@monitored
+async def toggle_task(obj, origin: str | None = None):
+    """
+    Will toggle the given task to active, see app.models.toggle_task
+
+    :returns - tuple(boolean, string, dictionary | None - the saved task)
+    """
+    was_toggled, err, task = await execute_timer_statement(
+        "toggle_task",
+        obj,
+        obj["uuid"],
+        compute_toggle,
+        "related_task_toggled",
+        origin
+    )
+    if was_toggled:
+        print(f"task id: {task['uuid']} was now toggled to {task['is_active']}")
+    return (was_toggled, err, task)
+
+
+@monitored
+async def complete_task(obj, origin: str | None = None):
+    """
+    Will mark the given task as completed, see app.models.complete_task
+
+    :returns - tuple(boolean, string, dictionary | None - the saved task)
+    """
+    return await execute_timer_statement(
+        "complete_task",
+        obj,
+        obj["id"],
+        compute_complete,
+        "related_task_deleted",
+        origin
+    )
+
+
+@monitored
+async def edit_task(obj, origin: str | None = None):
+    """
+    Will update the given task to given parameters, falling back to the
+    archive and to the history entries of rolled over days
+
+    :returns - tuple(boolean, string)
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                change = make_change("related_task_edited", obj, origin, task_id=obj["id"])
+                edited = affected_rows(await conn.execute(
+                    statements["edit_task"], *statement_args("edit_task", obj)))
+                if edited == 0:
+                    edited = affected_rows(await conn.execute(
+                        statements["edit_archived_task"],
+                        *statement_args("edit_archived_task", obj)
+                    ))
+
+                if edited:
+                    await write_changes(conn, "add_task_change", [change])
+                elif session := session_key(obj["id"]):
+                    edited = affected_rows(await conn.execute(
+                        statements["edit_task_session"],
+                        *statement_args("edit_task_session", {**obj, **session})
+                    ))
+                    if edited:
+                        await write_changes(conn, "add_session_change", [{**change, **session}])
+
+                if edited == 0:
+                    return (False, "Task not found")
+            return (True, "")
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def delete_task(uuid: str, origin: str | None = None):
+    """
+    Delete the given task by id, from either tier, or the given history
+    entry of a rolled over day. The task's sessions are kept.
+
+    :returns - tuple(boolean, string)
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                change = make_change("related_task_deleted", {"id": uuid}, origin, task_id=uuid)
+                # recorded first, the owner is looked up from the task
+                await write_changes(conn, "add_task_change", [change])
+                deleted = affected_rows(await conn.execute(statements["delete_task"], uuid))
+                if deleted == 0:
+                    deleted = affected_rows(
+                        await conn.execute(statements["delete_archived_task"], uuid))
+
+                if deleted == 0 and (session := session_key(uuid)):
+                    await write_changes(conn, "add_session_change", [{**change, **session}])
+                    deleted = affected_rows(await conn.execute(
+                        statements["delete_task_session"],
+                        *statement_args("delete_task_session", session)
+                    ))
+
+                if deleted == 0:
+                    # leaving the block without an exception commits, the
+                    # change row written above must not be
+                    raise LookupError("Task not found")
+            return (True, "")
+
+    except LookupError as e:
+        return (False, str(e))
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def add_task_sessions(sessions: list):
+    """
+    Records the time tracked on a day for each given task and resets the
+    task's duration for the next day, in one transaction. The sessions are
+    sent with a single COPY, see app.models.add_task_sessions.
+
+    :returns - tuple(boolean, string)
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(statements["create_rollover_sessions"])
+                await conn.copy_records_to_table(
+                    "rollover_sessions",
+                    records=[
+                        tuple(s[c] for c in rollover_session_columns)
+                        for s in sessions
+                    ],
+                    columns=rollover_session_columns
+                )
+                await conn.execute(statements["add_rollover_sessions"])
+                await conn.execute(statements["reset_rolled_over_tasks"])
+                await write_changes(
+                    conn,
+                    "add_change",
+                    [rollover_change(session) for session in sessions]
+                )
+            return (True, "")
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def archive_completed_tasks(cutoff: str, limit: int):
+    """
+    Moves up to limit completed tasks with completed_at before cutoff
+    from tasks into tasks_archive, in one statement.
+
+    :returns - tuple(boolean, int | string) - number of tasks moved or the error
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            status = await conn.execute(
+                statements["archive_completed_tasks"], cutoff, limit)
+            return (True, affected_rows(status))
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def apply_task_batch(user_id: str, operations: list, origin: str | None = None):
+    """
+    Applies a list of task operations of one user in a single transaction,
+    see app.models.apply_task_batch.
+
+    :returns - tuple(boolean, string, list of {index, op, id, ok, message, task})
+    """
+    task_ids = list({batch_task_id(o) for o in operations} - {None})
+
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            async with conn.transaction():
+                owners = {}
+                archived_ids = set()
+                if task_ids:
+                    for task_id, owner, is_archived in await conn.fetch(
+                            statements["get_task_owners"], task_ids):
+                        owners[task_id] = owner
+                        if is_archived:
+                            archived_ids.add(task_id)
+
+                timers = await read_task_timers(conn, timer_task_ids(operations))
+                results, runs = validate_task_batch(
+                    user_id, operations, owners, timers, now_ms(), archived_ids)
+
+                for name, params in runs:
+                    await conn.executemany(
+                        statements[name],
+                        [statement_args(name, p) for p in params]
+                    )
+                await write_changes(
+                    conn,
+                    "add_change",
+                    batch_changes(user_id, results, origin)
+                )
+            return (True, "", results)
+
+    except Exception as e:
+        print(e)
+        return (False, str(e), [])
+
+
+@monitored
+async def get_last_change_seq():
+    """
+    Returns the seq of the newest change in the change feed
+
+    :returns - tuple(boolean, int | string)
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            return (True, await conn.fetchval(statements["get_last_change_seq"]))
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def get_first_change_seq():
+    """
+    Returns the seq of the oldest change still in the change feed
+
+    :returns - tuple(boolean, int | None | string)
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            return (True, await conn.fetchval(statements["get_first_change_seq"]))
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
+
+
+@monitored
+async def get_changes(after_seq: int, limit: int, user_id: str | None = None):
+    """
+    Returns the changes after the given seq in order, of all users or
+    of one user only
+
+    :returns - tuple(boolean, list of (seq, user_id, event, data, origin, user_seq))
+    """
+    if user_id:
+        return await fetch_rows("get_user_changes", after_seq, limit, user_id)
+    return await fetch_rows("get_changes", after_seq, limit)
+
+
+@monitored
+async def get_changes_by_seqs(seqs: [int]):
+    """
+    Returns the changes with the given seqs that exist, in order
+
+    :returns - tuple(boolean, list of (seq, user_id, event, data, origin, user_seq))
+    """
+    return await fetch_rows("get_changes_by_seqs", list(seqs))
+
+
+@monitored
+async def prune_changes(before: int):
+    """
+    Deletes the changes written before the given time
+
+    :returns - tuple(boolean, int | string) - number of changes deleted or the error
+    """
+    try:
+        async with pool_state["pool"].acquire() as conn:
+            status = await conn.execute(statements["prune_changes"], before)
+            return (True, affected_rows(status))
+
+    except Exception as e:
+        print(e)
+        return (False, str(e))
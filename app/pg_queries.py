@@ -0,0 +1,523 @@
+from functools import lru_cache
+from app.queries import escape_like
+
+# Postgres versions of the statements in app/queries.py, used by
+# app/pg_models.py. asyncpg only binds positional parameters, the names in
+# statement_params give the order the values of a params dictionary are
+# bound in. Lists of ids are bound as one array, so there is a single
+# statement text per query whatever the number of ids.
+statements = {
+    "create_user": """
+        INSERT INTO users (id, first_name, last_name, email)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (id) DO NOTHING
+    """,
+    "get_user_settings": """
+        SELECT settings, settings_version, timezone
+        FROM users
+        WHERE id = $1
+    """,
+    "get_user_snapshot": """
+        SELECT
+            users.settings,
+            users.settings_version,
+            users.timezone,
+            (SELECT MAX(seq) FROM changes WHERE changes.user_id = users.id),
+            tasks.*
+        FROM users
+        LEFT JOIN tasks ON tasks.user_id = users.id AND tasks.is_completed = 0
+        WHERE users.id = $1
+    """,
+    "update_user_categories": """
+        UPDATE users
+        SET
+            settings = jsonb_set(settings, '{categories}', $2::jsonb),
+            settings_version = settings_version + 1
+        WHERE
+            id = $1
+        RETURNING settings_version
+    """,
+    "update_user_commands": """
+        UPDATE users
+        SET
+            settings = jsonb_set(settings, '{key_commands}', $2::jsonb),
+            settings_version = settings_version + 1
+        WHERE
+            id = $1
+        RETURNING settings_version
+    """,
+    "add_user_category": """
+        UPDATE users
+        SET
+            settings = CASE
+                WHEN settings->'categories' ? $2 THEN settings
+                ELSE jsonb_set(settings, '{categories}', (settings->'categories') || to_jsonb($2::text))
+            END,
+            settings_version = settings_version + 1
+        WHERE
+            id = $1 AND ($3::integer IS NULL OR settings_version = $3)
+        RETURNING settings_version
+    """,
+    "remove_user_category": """
+        UPDATE users
+        SET
+            settings = jsonb_set(settings, '{categories}', (settings->'categories') - $2::text),
+            settings_version = settings_version + 1
+        WHERE
+            id = $1 AND ($3::integer IS NULL OR settings_version = $3)
+        RETURNING settings_version
+    """,
+    "set_user_command": """
+        UPDATE users
+        SET
+            settings = jsonb_set(settings, ARRAY['key_commands', $2::text], $3::jsonb),
+            settings_version = settings_version + 1
+        WHERE
+            id = $1 AND ($4::integer IS NULL OR settings_version = $4)
+        RETURNING settings_version
+    """,
+    "remove_user_command": """
+        UPDATE users
+        SET
+            settings = settings #- ARRAY['key_commands', $2::text],
+            settings_version = settings_version + 1
+        WHERE
+            id = $1 AND ($3::integer IS NULL OR settings_version = $3)
+        RETURNING settings_version
+    """,
+    "update_user_timezone": """
+        UPDATE users
+        SET
+            timezone = $2
+        WHERE
+            id = $1
+    """,
+    "get_user_timezones": """
+        SELECT DISTINCT timezone
+        FROM users
+    """,
+    "get_user_ids_by_timezone": """
+        SELECT id
+        FROM users
+        WHERE timezone = $1
+            AND EXISTS (
+                SELECT 1 FROM tasks
+                WHERE tasks.user_id = users.id AND is_completed = 0
+            )
+        ORDER BY id
+    """,
+    "get_user_rollover_state": """
+        SELECT timezone, last_rollover_day
+        FROM users
+        WHERE id = $1
+    """,
+    "claim_user_rollover_day": """
+        UPDATE users
+        SET
+            last_rollover_day = $3
+        WHERE
+            id = $1 AND last_rollover_day IS NOT DISTINCT FROM $2
+    """,
+    "set_users_rollover_day": """
+        UPDATE users
+        SET
+            last_rollover_day = $2
+        WHERE
+            id = ANY($1::text[])
+    """,
+    "get_tasks": """
+        SELECT * FROM tasks
+    """,
+    "get_non_completed_tasks": """
+        SELECT *
+        FROM tasks
+        WHERE is_completed = 0
+        ORDER BY user_id
+    """,
+    "get_non_completed_tasks_by_user_ids": """
+        SELECT *
+        FROM tasks
+        WHERE is_completed = 0
+            AND user_id = ANY($1::text[])
+        ORDER BY user_id
+    """,
+    "get_task_owners": """
+        SELECT id, user_id, 0
+        FROM tasks
+        WHERE id = ANY($1::text[])
+        UNION ALL
+        SELECT id, user_id, 1
+        FROM tasks_archive
+        WHERE id = ANY($1::text[])
+    """,
+    "lock_task_timers": """
+        SELECT id, duration, toggled_at, is_active
+        FROM tasks
+        WHERE id = ANY($1::text[]) AND is_completed = 0
+        ORDER BY id
+        FOR UPDATE
+    """,
+    "get_running_tasks": """
+        SELECT id, user_id, duration, toggled_at
+        FROM tasks
+        WHERE is_active = 1 AND is_completed = 0
+    """,
+    "fetch_active_tasks_by_user": """
+        SELECT *
+        FROM tasks
+        WHERE user_id = $1 AND is_completed = 0
+    """,
+    "create_task": """
+        INSERT INTO tasks (
+            id,
+            title,
+            description,
+            created_at,
+            completed_at,
+            duration,
+            category,
+            tags,
+            toggled_at,
+            is_active,
+            is_completed,
+            user_id,
+            last_modified_at
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
+    """,
+    "toggle_task": """
+        UPDATE tasks SET
+            is_active = $2,
+            toggled_at = $3,
+            duration = $4,
+            last_modified_at = $5
+        WHERE id = $1
+    """,
+    "complete_task": """
+        UPDATE tasks SET
+            is_active = 0,
+            is_completed = 1,
+            duration = $2,
+            completed_at = $3,
+            last_modified_at = $4
+        WHERE id = $1
+    """,
+    "edit_task": """
+        UPDATE tasks SET
+            title = $2,
+            description = $3,
+            category = $4,
+            tags = $5,
+            last_modified_at = $6
+        WHERE id = $1
+    """,
+    "delete_task": """
+        DELETE FROM tasks
+        WHERE id = $1
+    """,
+    "edit_task_session": """
+        UPDATE task_sessions SET
+            title = $3,
+            description = $4,
+            category = $5,
+            tags = $6
+        WHERE task_id = $1 AND day = $2
+    """,
+    "delete_task_session": """
+        DELETE FROM task_sessions
+        WHERE task_id = $1 AND day = $2
+    """,
+    "delete_archived_task": """
+        DELETE FROM tasks_archive
+        WHERE id = $1
+    """,
+    "edit_archived_task": """
+        UPDATE tasks_archive SET
+            title = $2,
+            description = $3,
+            category = $4,
+            tags = $5,
+            last_modified_at = $6
+        WHERE id = $1
+    """,
+    # rollover sessions are copied into a temporary table in one COPY and
+    # applied with two set based statements instead of two per task
+    "create_rollover_sessions": """
+        CREATE TEMPORARY TABLE rollover_sessions (
+            task_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            duration_s INTEGER NOT NULL,
+            toggled_at BIGINT NOT NULL,
+            last_modified_at BIGINT NOT NULL
+        ) ON COMMIT DROP
+    """,
+    "add_rollover_sessions": """
+        INSERT INTO task_sessions (
+            task_id,
+            day,
+            duration_s,
+            user_id,
+            title,
+            description,
+            category,
+            tags,
+            created_at
+        )
+        SELECT r.task_id, r.day, r.duration_s, t.user_id, t.title, t.description, t.category, t.tags, t.created_at
+        FROM (
+            SELECT task_id, day, sum(duration_s) AS duration_s
+            FROM rollover_sessions
+            GROUP BY task_id, day
+        ) r
+        JOIN tasks t ON t.id = r.task_id
+        ON CONFLICT (task_id, day) DO UPDATE SET
+            duration_s = task_sessions.duration_s + excluded.duration_s
+    """,
+    "reset_rolled_over_tasks": """
+        UPDATE tasks SET
+            duration = '00:00:00',
+            toggled_at = rollover_sessions.toggled_at,
+            last_modified_at = rollover_sessions.last_modified_at
+        FROM rollover_sessions
+        WHERE tasks.id = rollover_sessions.task_id
+    """,
+    # moves the tasks in one statement, SKIP LOCKED lets several workers
+    # compact at the same time without waiting on each other
+    "archive_completed_tasks": """
+        WITH moved AS (
+            DELETE FROM tasks
+            WHERE id IN (
+                SELECT id
+                FROM tasks
+                WHERE is_completed = 1
+                    AND completed_at < $1
+                LIMIT $2
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+        )
+        INSERT INTO tasks_archive
+        SELECT * FROM moved
+        ON CONFLICT (id) DO UPDATE SET
+            title = excluded.title,
+            description = excluded.description,
+            created_at = excluded.created_at,
+            completed_at = excluded.completed_at,
+            duration = excluded.duration,
+            category = excluded.category,
+            tags = excluded.tags,
+            toggled_at = excluded.toggled_at,
+            is_active = excluded.is_active,
+            is_completed = excluded.is_completed,
+            user_id = excluded.user_id,
+            last_modified_at = excluded.last_modified_at
+    """,
+    # change feed, see app/changefeed.py. Sequence values are handed out when
+    # the row is inserted, not when it commits, so every writer takes the
+    # lock of each user it writes changes for, $1 user ids and the owners of
+    # the $2 task ids, right before writing them. The changes of one user then
+    # commit in seq order while writers of different users don't wait on each
+    # other, the dispatcher picks up the seqs those commit late. Locks are
+    # taken in user id order so multi-user writers can't deadlock.
+    "lock_changes": """
+        SELECT pg_advisory_xact_lock(hashtext('changes:' || user_id))
+        FROM (
+            SELECT user_id FROM unnest($1::text[]) AS users(user_id)
+            UNION
+            SELECT user_id FROM tasks WHERE id = ANY($2::text[])
+            UNION
+            SELECT user_id FROM tasks_archive WHERE id = ANY($2::text[])
+            UNION
+            SELECT user_id FROM task_sessions WHERE task_id = ANY($2::text[])
+            ORDER BY user_id
+        ) owners
+    """,
+    "add_change": """
+        INSERT INTO changes (user_id, event, data, origin, created_at)
+        VALUES ($1, $2, $3, $4, $5)
+    """,
+    "add_task_change": """
+        INSERT INTO changes (user_id, event, data, origin, created_at)
+        SELECT user_id, $2, $3, $4, $5
+        FROM (
+            SELECT user_id FROM tasks WHERE id = $1
+            UNION ALL
+            SELECT user_id FROM tasks_archive WHERE id = $1
+        ) owners
+        LIMIT 1
+    """,
+    "add_session_change": """
+        INSERT INTO changes (user_id, event, data, origin, created_at)
+        SELECT user_id, $3, $4, $5, $6
+        FROM task_sessions
+        WHERE task_id = $1 AND day = $2
+    """,
+    "get_last_change_seq": """
+        SELECT COALESCE(MAX(seq), 0)
+        FROM changes
+    """,
+    "get_first_change_seq": """
+        SELECT MIN(seq)
+        FROM changes
+    """,
+    "get_changes": """
+        SELECT seq, user_id, event, data, origin, user_seq
+        FROM changes
+        WHERE seq > $1
+        ORDER BY seq
+        LIMIT $2
+    """,
+    "get_user_changes": """
+        SELECT seq, user_id, event, data, origin, user_seq
+        FROM changes
+        WHERE seq > $1 AND user_id = $3
+        ORDER BY seq
+        LIMIT $2
+    """,
+    "get_changes_by_seqs": """
+        SELECT seq, user_id, event, data, origin, user_seq
+        FROM changes
+        WHERE seq = ANY($1::bigint[])
+        ORDER BY seq
+    """,
+    "prune_changes": """
+        DELETE FROM changes
+        WHERE created_at < $1
+            AND seq < (SELECT MAX(seq) FROM changes)
+    """,
+}
+
+# Order the values of a params dictionary are bound in, for the statements
+# called with the same dictionaries as their SQLite versions
+statement_params = {
+    "create_task": ("id", "title", "description", "created_at", "completed_at", "duration",
+                    "category", "tags", "toggled_at", "is_active", "is_completed", "user_id",
+                    "last_modified_at"),
+    "toggle_task": ("uuid", "is_active", "toggled_at", "duration", "last_modified_at"),
+    "complete_task": ("id", "duration", "completed_at", "last_modified_at"),
+    "edit_task": ("id", "title", "description", "category", "tags", "last_modified_at"),
+    "edit_archived_task": ("id", "title", "description", "category", "tags", "last_modified_at"),
+    "delete_task": ("uuid",),
+    "edit_task_session": ("task_id", "day", "title", "description", "category", "tags"),
+    "delete_task_session": ("task_id", "day"),
+    "add_session_change": ("task_id", "day", "event", "data", "origin", "created_at"),
+    "delete_archived_task": ("uuid",),
+    "add_change": ("user_id", "event", "data", "origin", "created_at"),
+    "add_task_change": ("task_id", "event", "data", "origin", "created_at"),
+    "add_user_category": ("id", "key", "version"),
+    "remove_user_category": ("id", "key", "version"),
+    "set_user_command": ("id", "key", "value", "version"),
+    "remove_user_command": ("id", "key", "version"),
+}
+
+# Columns of the rollover_sessions COPY, in table order
+rollover_session_columns = ("task_id", "day", "duration_s", "toggled_at", "last_modified_at")
+
+
+def statement_args(name: str, params: dict):
+    """
+    Returns the positional arguments of the named statement from a params
+    dictionary. Clients send booleans for the integer flags, asyncpg doesn't
+    convert those by itself.
+
+    :params
+        name: string - key of statement_params
+        params: dictionary
+
+    :returns - tuple
+    """
+    return tuple(
+        int(params[p]) if isinstance(params[p], bool) else params[p]
+        for p in statement_params[name]
+    )
+
+
+@lru_cache(maxsize=64)
+def completed_tasks_query(tag_count: int, has_search: bool, has_category: bool):
+    """
+    Postgres version of app.queries.completed_tasks_query. The parameters
+    are numbered in the order completed_tasks_params binds them.
+
+    :params
+        tag_count: int
+        has_search: boolean
+        has_category: boolean
+
+    :returns - string
+    """
+    filters = []
+    index = 4
+    for i in range(tag_count):
+        filters.append(f"AND tags LIKE '%' || ${index}::text || '%' ESCAPE '\\'")
+        index += 1
+    if has_search:
+        filters.append(f"AND title LIKE '%' || ${index}::text || '%' ESCAPE '\\'")
+        index += 1
+    if has_category:
+        filters.append(f"AND category = ${index}")
+
+    filters_query = "\n            ".join(filters)
+
+    completed = [f"""
+        SELECT
+            id,
+            title,
+            description,
+            category,
+            created_at,
+            completed_at,
+            duration,
+            tags
+        FROM {table}
+        WHERE user_id = $1
+            AND is_completed = 1
+            AND completed_at >= $2
+            AND completed_at <= $3
+            {filters_query}
+    """ for table in ("tasks", "tasks_archive")]
+
+    sessions = f"""
+        SELECT
+            task_id || '@' || day,
+            title,
+            description,
+            category,
+            created_at,
+            day || ' 23:59:59',
+            lpad((duration_s / 3600)::text, 2, '0') || ':' ||
+                lpad((duration_s % 3600 / 60)::text, 2, '0') || ':' ||
+                lpad((duration_s % 60)::text, 2, '0'),
+            tags
+        FROM task_sessions
+        WHERE user_id = $1
+            AND day >= substr($2, 1, 10)
+            AND day <= substr($3, 1, 10)
+            {filters_query}
+    """
+
+    return "\n        UNION ALL\n".join(completed + [sessions])
+
+
+def completed_tasks_params(
+        id: str,
+        start_date: str,
+        end_date: str,
+        tags: [str],
+        search_key: str,
+        selected_category: str
+):
+    """
+    Builds the statement and positional arguments for the completed tasks history
+
+    :returns - tuple(string, list)
+    """
+    args = [id, start_date, end_date]
+    args.extend(escape_like(tag) for tag in tags)
+    if search_key:
+        args.append(escape_like(search_key))
+    if selected_category:
+        args.append(selected_category)
+
+    query = completed_tasks_query(
+        len(tags), bool(search_key), bool(selected_category))
+    return (query, args)
+
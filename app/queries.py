@@ -0,0 +1,553 @@
+from functools import lru_cache
+
+# Size of sqlite3's per-connection prepared statement cache. Statements are
+# cached by their exact text, so every query below is a fixed string and the
+# dynamic ones are built from a small, cached set of shapes.
+statement_cache_size = 256
+
+# Named statements used by app/models.py. Keep values bound as parameters,
+# never formatted into the text, or every call becomes a cache miss.
+statements = {
+    "create_user": """
+        INSERT INTO users (id, first_name, last_name, email)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (id) DO NOTHING
+    """,
+    "get_user_settings": """
+        SELECT settings, settings_version, timezone
+        FROM users
+        WHERE id = :id
+    """,
+    "get_user_snapshot": """
+        SELECT
+            users.settings,
+            users.settings_version,
+            users.timezone,
+            (SELECT MAX(seq) FROM changes WHERE changes.user_id = users.id),
+            tasks.*
+        FROM users
+        LEFT JOIN tasks ON tasks.user_id = users.id AND tasks.is_completed = 0
+        WHERE users.id = :id
+    """,
+    "update_user_categories": """
+        UPDATE users
+        SET
+            settings = json_set(settings, '$.categories', json(:categories)),
+            settings_version = settings_version + 1
+        WHERE
+            id = :id
+        RETURNING settings_version
+    """,
+    "update_user_commands": """
+        UPDATE users
+        SET
+            settings = json_set(settings, '$.key_commands', json(:commands)),
+            settings_version = settings_version + 1
+        WHERE
+            id = :id
+        RETURNING settings_version
+    """,
+    # single entry updates of the settings, see update_user_setting. They
+    # only apply when the version is the one the device last saw, or no
+    # version was given.
+    "add_user_category": """
+        UPDATE users
+        SET
+            settings = CASE
+                WHEN EXISTS (
+                    SELECT 1 FROM json_each(settings, '$.categories') WHERE value = :key
+                ) THEN settings
+                ELSE json_insert(settings, '$.categories[#]', :key)
+            END,
+            settings_version = settings_version + 1
+        WHERE
+            id = :id AND (:version IS NULL OR settings_version = :version)
+        RETURNING settings_version
+    """,
+    "remove_user_category": """
+        UPDATE users
+        SET
+            settings = json_set(settings, '$.categories', (
+                SELECT json_group_array(value)
+                FROM json_each(users.settings, '$.categories')
+                WHERE value != :key
+            )),
+            settings_version = settings_version + 1
+        WHERE
+            id = :id AND (:version IS NULL OR settings_version = :version)
+        RETURNING settings_version
+    """,
+    "set_user_command": """
+        UPDATE users
+        SET
+            settings = json_patch(
+                json_patch(settings, json_object('key_commands', json_object(:key, NULL))),
+                json_object('key_commands', json_object(:key, json(:value)))
+            ),
+            settings_version = settings_version + 1
+        WHERE
+            id = :id AND (:version IS NULL OR settings_version = :version)
+        RETURNING settings_version
+    """,
+    "remove_user_command": """
+        UPDATE users
+        SET
+            settings = json_patch(settings, json_object('key_commands', json_object(:key, NULL))),
+            settings_version = settings_version + 1
+        WHERE
+            id = :id AND (:version IS NULL OR settings_version = :version)
+        RETURNING settings_version
+    """,
+    "update_user_timezone": """
+        UPDATE users
+        SET
+            timezone = :timezone
+        WHERE
+            id = :id
+    """,
+    "get_user_timezones": """
+        SELECT DISTINCT timezone
+        FROM users
+    """,
+    "get_user_ids_by_timezone": """
+        SELECT id
+        FROM users
+        WHERE timezone = :timezone
+            AND EXISTS (
+                SELECT 1 FROM tasks
+                WHERE tasks.user_id = users.id AND is_completed = 0
+            )
+        ORDER BY id
+    """,
+    "get_user_rollover_state": """
+        SELECT timezone, last_rollover_day
+        FROM users
+        WHERE id = :id
+    """,
+    "claim_user_rollover_day": """
+        UPDATE users
+        SET
+            last_rollover_day = :day
+        WHERE
+            id = :id AND last_rollover_day IS :stored_day
+    """,
+    "set_users_rollover_day": """
+        UPDATE users
+        SET
+            last_rollover_day = :day
+        WHERE
+            id = :id
+    """,
+    "get_tasks": """
+        SELECT * FROM tasks
+    """,
+    "get_non_completed_tasks": """
+        SELECT *
+        FROM tasks
+        WHERE is_completed = 0
+        ORDER BY user_id
+    """,
+    "get_running_tasks": """
+        SELECT id, user_id, duration, toggled_at
+        FROM tasks
+        WHERE is_active = 1 AND is_completed = 0
+    """,
+    "fetch_active_tasks_by_user": """
+        SELECT *
+        FROM tasks
+        WHERE user_id = :id AND is_completed = 0
+    """,
+    "create_task": """
+        INSERT INTO tasks (
+            id,
+            title,
+            description,
+            created_at,
+            completed_at,
+            duration,
+            category,
+            tags,
+            toggled_at,
+            is_active,
+            is_completed,
+            user_id,
+            last_modified_at
+        ) VALUES (
+            :id,
+            :title,
+            :description,
+            :created_at,
+            :completed_at,
+            :duration,
+            :category,
+            :tags,
+            :toggled_at,
+            :is_active,
+            :is_completed,
+            :user_id,
+            :last_modified_at
+        )
+    """,
+    "toggle_task": """
+        UPDATE tasks SET
+            is_active = :is_active,
+            toggled_at = :toggled_at,
+            duration = :duration,
+            last_modified_at = :last_modified_at
+        WHERE id = :uuid
+    """,
+    "complete_task": """
+        UPDATE tasks SET
+            is_active = 0,
+            is_completed = 1,
+            duration = :duration,
+            completed_at = :completed_at,
+            last_modified_at = :last_modified_at
+        WHERE id = :id
+    """,
+    "edit_task": """
+        UPDATE tasks SET
+            title = :title,
+            description = :description,
+            category = :category,
+            tags = :tags,
+            last_modified_at = :last_modified_at
+        WHERE id = :id
+    """,
+    "delete_task": """
+        DELETE FROM tasks
+        WHERE id = :uuid
+    """,
+    # a session copies the task's details, the history of the day stays
+    # as it was when the task is edited or deleted later
+    "add_task_session": """
+        INSERT INTO task_sessions (
+            task_id,
+            day,
+            duration_s,
+            user_id,
+            title,
+            description,
+            category,
+            tags,
+            created_at
+        )
+        SELECT :task_id, :day, :duration_s, user_id, title, description, category, tags, created_at
+        FROM tasks
+        WHERE id = :task_id
+        ON CONFLICT (task_id, day) DO UPDATE SET
+            duration_s = duration_s + excluded.duration_s
+    """,
+    "edit_task_session": """
+        UPDATE task_sessions SET
+            title = :title,
+            description = :description,
+            category = :category,
+            tags = :tags
+        WHERE task_id = :task_id AND day = :day
+    """,
+    "delete_task_session": """
+        DELETE FROM task_sessions
+        WHERE task_id = :task_id AND day = :day
+    """,
+    "reset_rolled_over_task": """
+        UPDATE tasks SET
+            duration = '00:00:00',
+            toggled_at = :toggled_at,
+            last_modified_at = :last_modified_at
+        WHERE id = :task_id
+    """,
+    "delete_archived_task": """
+        DELETE FROM tasks_archive
+        WHERE id = :uuid
+    """,
+    "edit_archived_task": """
+        UPDATE tasks_archive SET
+            title = :title,
+            description = :description,
+            category = :category,
+            tags = :tags,
+            last_modified_at = :last_modified_at
+        WHERE id = :id
+    """,
+    "get_archivable_task_ids": """
+        SELECT id
+        FROM tasks
+        WHERE is_completed = 1
+            AND completed_at < :cutoff
+        LIMIT :limit
+    """,
+    # change feed, see app/changefeed.py
+    "add_change": """
+        INSERT INTO changes (user_id, event, data, origin, created_at)
+        VALUES (:user_id, :event, :data, :origin, :created_at)
+    """,
+    "add_task_change": """
+        INSERT INTO changes (user_id, event, data, origin, created_at)
+        SELECT user_id, :event, :data, :origin, :created_at
+        FROM (
+            SELECT user_id FROM tasks WHERE id = :task_id
+            UNION ALL
+            SELECT user_id FROM tasks_archive WHERE id = :task_id
+        )
+        LIMIT 1
+    """,
+    "add_session_change": """
+        INSERT INTO changes (user_id, event, data, origin, created_at)
+        SELECT user_id, :event, :data, :origin, :created_at
+        FROM task_sessions
+        WHERE task_id = :task_id AND day = :day
+    """,
+    "get_last_change_seq": """
+        SELECT COALESCE(MAX(seq), 0)
+        FROM changes
+    """,
+    "get_first_change_seq": """
+        SELECT MIN(seq)
+        FROM changes
+    """,
+    "get_changes": """
+        SELECT seq, user_id, event, data, origin, user_seq
+        FROM changes
+        WHERE seq > :after_seq
+        ORDER BY seq
+        LIMIT :limit
+    """,
+    "get_user_changes": """
+        SELECT seq, user_id, event, data, origin, user_seq
+        FROM changes
+        WHERE user_id = :user_id AND seq > :after_seq
+        ORDER BY seq
+        LIMIT :limit
+    """,
+    # the newest change is kept, the oldest one left tells devices catching
+    # up whether the changes they missed were pruned
+    "prune_changes": """
+        DELETE FROM changes
+        WHERE created_at < :before
+            AND seq < (SELECT MAX(seq) FROM changes)
+    """,
+}
+
+
+@lru_cache(maxsize=64)
+def non_completed_tasks_by_user_ids_query(user_count: int):
+    """
+    Returns the statement selecting the open tasks of user_count users.
+    The text only depends on the count, so it stays cacheable.
+
+    :params - user_count: int
+
+    :returns - string
+    """
+    placeholders = ", ".join("?" for _ in range(user_count))
+    return f"""
+        SELECT *
+        FROM tasks
+        WHERE is_completed = 0
+            AND user_id IN ({placeholders})
+        ORDER BY user_id
+    """
+
+
+@lru_cache(maxsize=64)
+def task_owners_query(task_count: int):
+    """
+    Returns the statement selecting the owner of task_count tasks by id
+    and whether the task was moved to tasks_archive. The ids are bound
+    once per table.
+
+    :params - task_count: int
+
+    :returns - string
+    """
+    placeholders = ", ".join("?" for _ in range(task_count))
+    return f"""
+        SELECT id, user_id, 0
+        FROM tasks
+        WHERE id IN ({placeholders})
+        UNION ALL
+        SELECT id, user_id, 1
+        FROM tasks_archive
+        WHERE id IN ({placeholders})
+    """
+
+
+@lru_cache(maxsize=64)
+def task_timers_query(task_count: int):
+    """
+    Returns the statement selecting the stored timer of task_count open
+    tasks by id
+
+    :params - task_count: int
+
+    :returns - string
+    """
+    placeholders = ", ".join("?" for _ in range(task_count))
+    return f"""
+        SELECT id, duration, toggled_at, is_active
+        FROM tasks
+        WHERE id IN ({placeholders}) AND is_completed = 0
+    """
+
+
+def changes_by_seqs_query(seq_count: int):
+    """
+    Returns the statement selecting the changes with seq_count given seqs,
+    see app.changefeed.dispatch_pending
+
+    :params - seq_count: int
+
+    :returns - string
+    """
+    placeholders = ", ".join("?" for _ in range(seq_count))
+    return f"""
+        SELECT seq, user_id, event, data, origin, user_seq
+        FROM changes
+        WHERE seq IN ({placeholders})
+        ORDER BY seq
+    """
+
+
+@lru_cache(maxsize=8)
+def archive_tasks_queries(task_count: int):
+    """
+    Returns the statements copying task_count tasks into tasks_archive
+    and removing them from tasks
+
+    :params - task_count: int
+
+    :returns - tuple(string, string)
+    """
+    placeholders = ", ".join("?" for _ in range(task_count))
+    columns = """
+            id,
+            title,
+            description,
+            created_at,
+            completed_at,
+            duration,
+            category,
+            tags,
+            toggled_at,
+            is_active,
+            is_completed,
+            user_id,
+            last_modified_at"""
+    return (f"""
+        INSERT OR REPLACE INTO tasks_archive ({columns}
+        )
+        SELECT {columns}
+        FROM tasks
+        WHERE id IN ({placeholders})
+    """, f"""
+        DELETE FROM tasks
+        WHERE id IN ({placeholders})
+    """)
+
+
+def escape_like(value: str):
+    """
+    Escapes the LIKE wildcards in a user supplied value
+
+    :params - value: string
+
+    :returns - string
+    """
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@lru_cache(maxsize=64)
+def completed_tasks_query(tag_count: int, has_search: bool, has_category: bool):
+    """
+    Returns the statement for the completed tasks history with the given
+    filters. Only the shape of the filters is part of the text, the values
+    are bound by completed_tasks_params.
+
+    :params
+        tag_count: int
+        has_search: boolean
+        has_category: boolean
+
+    :returns - string
+    """
+    filters = [
+        f"AND tags LIKE '%' || :tag{i} || '%' ESCAPE '\\'" for i in range(tag_count)]
+    if has_search:
+        filters.append("AND title LIKE '%' || :search_key || '%' ESCAPE '\\'")
+    if has_category:
+        filters.append("AND category = :category")
+
+    filters_query = "\n            ".join(filters)
+
+    # completed tasks live in the hot table until compaction moves them to
+    # tasks_archive, so both tiers are read
+    completed = [f"""
+        SELECT
+            id,
+            title,
+            description,
+            category,
+            created_at,
+            completed_at,
+            duration,
+            tags
+        FROM {table}
+        WHERE user_id = :uid
+            AND is_completed = 1
+            AND completed_at >= :start_date
+            AND completed_at <= :end_date
+            {filters_query}
+    """ for table in ("tasks", "tasks_archive")]
+
+    # each day a task was rolled over on is one session, listed like the
+    # completed copies rollover used to create. The id is made unique per
+    # day since the task itself lives on, see session_key.
+    sessions = f"""
+        SELECT
+            task_id || '@' || day,
+            title,
+            description,
+            category,
+            created_at,
+            day || ' 23:59:59',
+            printf('%02d:%02d:%02d', duration_s / 3600, duration_s % 3600 / 60, duration_s % 60),
+            tags
+        FROM task_sessions
+        WHERE user_id = :uid
+            AND day >= substr(:start_date, 1, 10)
+            AND day <= substr(:end_date, 1, 10)
+            {filters_query}
+    """
+
+    return "\n        UNION ALL\n".join(completed + [sessions])
+
+
+def completed_tasks_params(
+        id: str,
+        start_date: str,
+        end_date: str,
+        tags: [str],
+        search_key: str,
+        selected_category: str
+):
+    """
+    Builds the statement and bound parameters for the completed tasks history
+
+    :returns - tuple(string, dictionary)
+    """
+    params = {
+        "uid": id,
+        "start_date": start_date,
+        "end_date": end_date,
+    }
+    for i, tag in enumerate(tags):
+        params[f"tag{i}"] = escape_like(tag)
+    if search_key:
+        params["search_key"] = escape_like(search_key)
+    if selected_category:
+        params["category"] = selected_category
+
+    query = completed_tasks_query(
+        len(tags), bool(search_key), bool(selected_category))
+    return (query, params)
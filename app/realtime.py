@@ -0,0 +1,170 @@
+import socketio
+import urllib.parse
+from app.storage import create_user
+from app.outbound import open_queue, close_queue, enqueue
+
+# Shared by every Socket.IO server mounted in the app, so all of them see
+# the same connections and fan out through the same queues.
+
+# Dictionary to store active connections, sid -> connection details
+active_connections = {}
+# user id -> set of sids, so fan-out to a user's devices doesn't scan everyone
+user_sids = {}
+# sid -> the socketio.AsyncServer the connection belongs to
+connection_servers = {}
+# mount path -> socketio.AsyncServer
+mounted_servers = {}
+# Ids of the users that exist in the db, so reconnects skip the insert
+known_users = set()
+
+
+def create_realtime_server(**kwargs):
+    """
+    Creates a Socket.IO server with the settings every mounted app uses
+    """
+    return socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', **kwargs)
+
+
+def mount_realtime(app, path: str, sio):
+    """
+    Mounts a Socket.IO server on the FastAPI app at the given path
+    """
+    app.mount(path, socketio.ASGIApp(sio, socketio_path=""))
+    mounted_servers[path] = sio
+
+
+def parse_auth(environ: dict):
+    """
+    Reads the user details of a connection from the query string or,
+    for clients that can't set one, from the headers
+
+    :returns - dictionary {id, email, first_name, last_name} or None if incomplete
+    """
+    params = urllib.parse.parse_qs(environ.get("QUERY_STRING", ""))
+    user = {}
+    for field in ("id", "email", "first_name", "last_name"):
+        if field in params:
+            user[field] = params[field][0]
+        else:
+            user[field] = environ.get(f"HTTP_{field.upper()}", "")
+
+    if not user["id"]:
+        return None
+    return user
+
+
+async def ensure_user(user: dict):
+    """
+    Creates the user of a connection in the db unless it is known to exist
+
+    :returns - boolean
+    """
+    if user["id"] in known_users:
+        return True
+
+    if not await create_user(user["id"], user["email"], user["first_name"], user["last_name"]):
+        return False
+    known_users.add(user["id"])
+    return True
+
+
+def register_connection(sio, sid: str, user: dict):
+    """
+    Stores the connection details, indexes them by user and opens the
+    connection's outbound queue
+    """
+    active_connections[sid] = {"sid": sid, **user}
+    user_sids.setdefault(user["id"], set()).add(sid)
+    connection_servers[sid] = sio
+    open_queue(sio, sid)
+
+
+async def unregister_connection(sid: str):
+    """
+    Removes a closed connection from the registry
+
+    :returns - the connection details or None if it wasn't registered
+    """
+    conn = active_connections.pop(sid, None)
+    connection_servers.pop(sid, None)
+    await close_queue(sid)
+    if conn is None:
+        return None
+
+    sids = user_sids.get(conn["id"])
+    if sids is not None:
+        sids.discard(sid)
+        if not sids:
+            del user_sids[conn["id"]]
+    return conn
+
+
+def get_user_sids(user_id: str, exclude_sid: str | None = None, sio=None):
+    """
+    Returns the sids of the connected devices of a user
+
+    :params
+        user_id: string
+        exclude_sid: string - sid to leave out, usually the sender
+        sio: socketio.AsyncServer - only connections of this server, default all
+    """
+    return [
+        s for s in user_sids.get(user_id, ())
+        if s != exclude_sid and (sio is None or connection_servers.get(s) is sio)
+    ]
+
+
+def search_associated_sid_by_id(sid: str):
+    """
+    Returns the sids of the other devices of the user of the given
+    connection that are connected to the same server
+    """
+    return get_user_sids(
+        active_connections[sid]["id"],
+        exclude_sid=sid,
+        sio=connection_servers.get(sid)
+    )
+
+
+async def emitter_to_associated_sids(ev: str, sid_lst: list[str], data: dict):
+    # queued per socket, so a slow device can't delay the ack to this one
+    for sid in sid_lst:
+        sio = connection_servers.get(sid)
+        if sio is not None:
+            enqueue(sio, sid, ev, data)
+
+
+async def emit_to_user(user_id: str, ev: str, data, exclude_sid: str | None = None, sio=None):
+    """
+    Queues an event for the connected devices of a user, see get_user_sids
+    """
+    await emitter_to_associated_sids(ev, get_user_sids(user_id, exclude_sid, sio), data)
+
+
+async def disconnect_all():
+    """
+    Disconnects every registered connection from its server
+    """
+    for sid, sio in list(connection_servers.items()):
+        await sio.disconnect(sid)
+
+
+def get_realtime_stats():
+    """
+    Returns the number of connections and users per mounted server
+
+    :returns - dictionary
+    """
+    servers = {}
+    for path, sio in mounted_servers.items():
+        sids = [s for s, server in connection_servers.items() if server is sio]
+        servers[path] = {
+            "connections": len(sids),
+            "users": len({active_connections[s]["id"] for s in sids}),
+        }
+
+    return {
+        "connections": len(active_connections),
+        "users": len(user_sids),
+        "servers": servers,
+    }
@@ -0,0 +1,283 @@
+import asyncio
+import os
+import time
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from app.storage import get_user_timezones, get_user_ids_by_timezone, get_user_rollover_state, claim_user_rollover_day, set_users_rollover_day, get_non_completed_tasks_by_user_ids, add_task_sessions
+from app.utility import duration_str_to_int
+from app.timers import start_timer
+from app.lifecycle import tracked
+from app.monitor import monitored
+
+default_timezone = "Europe/Bucharest"
+
+# "scheduled" rolls every user over with a cron job at 23:59 local time.
+# "lazy" rolls a user over the next time one of their devices connects,
+# refreshes or changes a task, so idle users cost nothing.
+rollover_mode = os.environ.get("TASKBAR_ROLLOVER_MODE", "scheduled")
+
+# Users rolled over per batch and the pause between batches, so a timezone
+# with many users becomes many small jobs instead of one long one.
+batch_size = 50
+batch_pause = 0.05
+
+scheduler = AsyncIOScheduler(timezone=ZoneInfo(default_timezone))
+
+# Last rollover day seen per user id, so the lazy check doesn't query
+# the db on every event once a user is known to be up to date.
+rollover_days = {}
+
+
+def is_valid_timezone(name: str):
+    """
+    Checks that the given name is a timezone known to zoneinfo
+
+    :params - name: string
+
+    :returns - boolean
+    """
+    if not isinstance(name, str) or not name:
+        return False
+    try:
+        ZoneInfo(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+async def rollover_tasks(
+        non_completed_tasks,
+        now_datetime_formated: str,
+        closed_at: int | None = None,
+        reopened_at: int | None = None
+):
+    """
+    Records the time tracked on the given open tasks as a session of the
+    day that is ending and resets their duration for the next day. The
+    tasks themselves stay open and keep their ids.
+
+    :params
+        non_completed_tasks: list of task rows
+        now_datetime_formated: string - a time of the day that is ending
+        closed_at: int - epoch ms running timers are stopped at, default now
+        reopened_at: int - epoch ms running timers restart at, default now
+
+    :returns - tuple(boolean, set of user ids that were touched), False if
+        the sessions couldn't be saved
+    """
+    user_ids = set()
+    sessions = []
+    day = now_datetime_formated[:10]
+
+    # get last epoch time
+    last_epoch_t = int(time.time() * 1000)
+    closed_at = closed_at or last_epoch_t
+    reopened_at = reopened_at or last_epoch_t
+
+    for t in non_completed_tasks:
+        # save the id of the user we must try to send a refresher to.
+        user_ids.add(t[11])
+
+        # calculate duration int
+        dur_int = duration_str_to_int(t[5])
+
+        # exclude tasks that with total duration 0
+        if dur_int == 0 and t[8] == 0:
+            continue
+
+        duration = int(dur_int/1000)
+
+        if t[8] > 0:
+            duration = int((dur_int + max(0, closed_at - t[8]))/1000)
+
+        sessions.append({
+            "task_id": t[0],
+            "user_id": t[11],
+            "day": day,
+            "duration_s": duration,
+            "toggled_at": reopened_at if t[9] == 1 else 0,
+            "last_modified_at": last_epoch_t,
+        })
+
+    if not sessions:
+        return (True, user_ids)
+
+    was_added, err = await add_task_sessions(sessions)
+    if not was_added:
+        print(f"rollover of {len(user_ids)} users failed: {err}")
+        return (False, user_ids)
+
+    # running timers start counting the new day from zero
+    for session in sessions:
+        if session["toggled_at"]:
+            start_timer(
+                session["user_id"],
+                session["task_id"],
+                0,
+                session["toggled_at"]
+            )
+
+    return (True, user_ids)
+
+
+@tracked
+@monitored
+async def rollover_timezone(timezone: str, on_users_rolled):
+    """
+    Rolls over the open tasks of every user in the given timezone,
+    batch_size users at a time.
+
+    :params
+        timezone: string
+        on_users_rolled: coroutine function - called with the set of user
+            ids of each finished batch, used to refresh connected devices
+    """
+    now = datetime.now(ZoneInfo(timezone))
+    now_datetime_formated = now.strftime("%Y-%m-%d %H:%M:%S")
+    # the open tasks now belong to tomorrow, recorded so switching to
+    # the lazy mode later doesn't roll these users over a second time
+    next_day = (now.date() + timedelta(days=1)).isoformat()
+
+    were_fetched, user_ids = await get_user_ids_by_timezone(timezone)
+    if not were_fetched:
+        return
+
+    print(f"rolling over {len(user_ids)} users in {timezone}")
+
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        was_fetched, non_completed_tasks = await get_non_completed_tasks_by_user_ids(batch)
+
+        if was_fetched:
+            was_rolled, rolled_user_ids = await rollover_tasks(
+                non_completed_tasks, now_datetime_formated)
+            # a batch that failed keeps its day, the next run rolls it over
+            if was_rolled:
+                await set_users_rollover_day(batch, next_day)
+                for uid in batch:
+                    rollover_days[uid] = {"day": next_day, "timezone": ZoneInfo(timezone)}
+                await on_users_rolled(rolled_user_ids)
+
+        await asyncio.sleep(batch_pause)
+
+
+async def sync_rollover_jobs(on_users_rolled):
+    """
+    Makes sure there is exactly one 23:59 cron job for every timezone
+    that has users, running in that timezone. In lazy mode there are none.
+
+    :params - on_users_rolled: coroutine function, see rollover_timezone
+    """
+    timezones = []
+    if rollover_mode == "scheduled":
+        were_fetched, timezones = await get_user_timezones()
+        if not were_fetched:
+            return
+
+    job_ids = set()
+    for timezone in timezones:
+        if not is_valid_timezone(timezone):
+            print(f"skipping unknown timezone {timezone}")
+            continue
+
+        job_id = f"rollover:{timezone}"
+        job_ids.add(job_id)
+        if scheduler.get_job(job_id) is None:
+            scheduler.add_job(
+                rollover_timezone,
+                "cron",
+                hour="23",
+                minute="59",
+                timezone=ZoneInfo(timezone),
+                args=[timezone, on_users_rolled],
+                id=job_id,
+            )
+
+    for job in scheduler.get_jobs():
+        if job.id.startswith("rollover:") and job.id not in job_ids:
+            job.remove()
+
+
+async def release_rollover_day(user_id: str, stored_day: str, day: str):
+    """
+    Moves a claimed rollover day back after the rollover failed, so the
+    next event of the user tries again
+    """
+    if not await claim_user_rollover_day(user_id, day, stored_day):
+        print(f"couldn't release the rollover day of user id {user_id}")
+
+
+@monitored
+async def ensure_user_rolled_over(user_id: str):
+    """
+    Lazy mode only. Rolls the user's open tasks over if the day they
+    belong to is before the current day in the user's timezone.
+
+    Running timers are counted up to the end of the stored day and restart
+    at the start of today, so time on days nobody was connected for is
+    not counted.
+
+    :params - user_id: string
+
+    :returns - boolean, True if tasks were rolled over
+    """
+    if rollover_mode != "lazy":
+        return False
+
+    cached = rollover_days.get(user_id)
+    if cached and cached["day"] >= datetime.now(cached["timezone"]).date().isoformat():
+        return False
+
+    was_fetched, state = await get_user_rollover_state(user_id)
+    if not was_fetched:
+        return False
+
+    timezone = ZoneInfo(state["timezone"] if is_valid_timezone(
+        state["timezone"]) else default_timezone)
+    today = datetime.now(timezone).date()
+    today_str = today.isoformat()
+    stored_day = state["last_rollover_day"]
+
+    if stored_day is None or stored_day >= today_str:
+        # unknown users start counting from today
+        if stored_day is None:
+            await claim_user_rollover_day(user_id, None, today_str)
+        rollover_days[user_id] = {
+            "day": stored_day or today_str, "timezone": timezone}
+        return False
+
+    if not await claim_user_rollover_day(user_id, stored_day, today_str):
+        # another device or worker got here first
+        rollover_days[user_id] = {"day": today_str, "timezone": timezone}
+        return False
+
+    was_fetched, non_completed_tasks = await get_non_completed_tasks_by_user_ids([user_id])
+    if not was_fetched:
+        await release_rollover_day(user_id, stored_day, today_str)
+        return False
+
+    rollover_days[user_id] = {"day": today_str, "timezone": timezone}
+    if not non_completed_tasks:
+        return False
+
+    end_of_stored_day = datetime.combine(
+        date.fromisoformat(stored_day) + timedelta(days=1),
+        datetime.min.time(),
+        tzinfo=timezone
+    )
+    start_of_today = datetime.combine(today, datetime.min.time(), tzinfo=timezone)
+
+    was_rolled, rolled_user_ids = await rollover_tasks(
+        non_completed_tasks,
+        f"{stored_day} 23:59:59",
+        closed_at=int(end_of_stored_day.timestamp() * 1000),
+        reopened_at=int(start_of_today.timestamp() * 1000)
+    )
+    if not was_rolled:
+        rollover_days.pop(user_id, None)
+        await release_rollover_day(user_id, stored_day, today_str)
+        return False
+
+    print(f"lazily rolled user id {user_id} over from {stored_day}")
+    return True
@@ -0,0 +1,109 @@
+import importlib
+import os
+
+# Which module persists the data:
+#   sqlite   - app/models.py, aiosqlite on a local file, one host only
+#   postgres - app/pg_models.py, asyncpg pool, see TASKBAR_PG_DSN
+storage_backend = os.environ.get("TASKBAR_STORAGE", "sqlite")
+
+backend_modules = {
+    "sqlite": "app.models",
+    "postgres": "app.pg_models",
+}
+
+# Every function a backend module must implement, with the same signature and
+# return values as the SQLite implementation in app/models.py. The rest of
+# the app imports these from here, never from a backend module directly.
+storage_functions = (
+    "init_db_conns",
+    "close_db_conns",
+    "create_user",
+    "get_user_settings",
+    "get_user_snapshot",
+    "update_user_categories",
+    "update_user_commands",
+    "update_user_setting",
+    "update_user_timezone",
+    "get_user_timezones",
+    "get_user_ids_by_timezone",
+    "get_user_rollover_state",
+    "claim_user_rollover_day",
+    "set_users_rollover_day",
+    "get_tasks",
+    "get_non_completed_tasks",
+    "get_non_completed_tasks_by_user_ids",
+    "get_completed_tasks_by_uid",
+    "get_running_tasks",
+    "fetch_active_tasks_by_user",
+    "create_task",
+    "toggle_task",
+    "complete_task",
+    "edit_task",
+    "delete_task",
+    "add_task_sessions",
+    "archive_completed_tasks",
+    "apply_task_batch",
+    "get_last_change_seq",
+    "get_first_change_seq",
+    "get_changes",
+    "get_changes_by_seqs",
+    "prune_changes",
+)
+
+
+def load_backend(name: str):
+    """
+    Imports the backend module with the given name and checks that it
+    implements every storage function
+
+    :params - name: string - sqlite | postgres
+
+    :returns - module
+    """
+    if name not in backend_modules:
+        raise ValueError(f"Unknown storage backend {name}")
+
+    backend = importlib.import_module(backend_modules[name])
+    missing = [f for f in storage_functions if not hasattr(backend, f)]
+    if missing:
+        raise ImportError(
+            f"Storage backend {name} is missing: {', '.join(missing)}")
+    return backend
+
+
+backend = load_backend(storage_backend)
+
+# named one by one so imports from this module can be checked statically
+init_db_conns = backend.init_db_conns
+close_db_conns = backend.close_db_conns
+create_user = backend.create_user
+get_user_settings = backend.get_user_settings
+get_user_snapshot = backend.get_user_snapshot
+update_user_categories = backend.update_user_categories
+update_user_commands = backend.update_user_commands
+update_user_setting = backend.update_user_setting
+update_user_timezone = backend.update_user_timezone
+get_user_timezones = backend.get_user_timezones
+get_user_ids_by_timezone = backend.get_user_ids_by_timezone
+get_user_rollover_state = backend.get_user_rollover_state
+claim_user_rollover_day = backend.claim_user_rollover_day
+set_users_rollover_day = backend.set_users_rollover_day
+get_tasks = backend.get_tasks
+get_non_completed_tasks = backend.get_non_completed_tasks
+get_non_completed_tasks_by_user_ids = backend.get_non_completed_tasks_by_user_ids
+get_completed_tasks_by_uid = backend.get_completed_tasks_by_uid
+get_running_tasks = backend.get_running_tasks
+fetch_active_tasks_by_user = backend.fetch_active_tasks_by_user
+create_task = backend.create_task
+toggle_task = backend.toggle_task
+complete_task = backend.complete_task
+edit_task = backend.edit_task
+delete_task = backend.delete_task
+add_task_sessions = backend.add_task_sessions
+archive_completed_tasks = backend.archive_completed_tasks
+apply_task_batch = backend.apply_task_batch
+get_last_change_seq = backend.get_last_change_seq
+get_first_change_seq = backend.get_first_change_seq
+get_changes = backend.get_changes
+get_changes_by_seqs = backend.get_changes_by_seqs
+prune_changes = backend.prune_changes
@@ -0,0 +1,102 @@
+import time
+from app.utility import duration_str_to_int, duration_int_to_str
+
+# Timer math shared by the storage backends. Toggles, completes and batches
+# are computed from the timer stored in the db, read in the transaction that
+# saves the result, so the client's duration and clock are never saved and
+# two devices toggling the same task can't both start from the same value.
+# Tasks without a stored timer aren't open, their toggles and completes fail.
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def elapsed_ms(timer, now: int):
+    """
+    Total time tracked on a running timer up to now, in ms
+    """
+    return timer["duration_ms"] + max(0, now - timer["toggled_at"])
+
+
+def stored_timers(rows):
+    """
+    Returns the timers of the given task rows
+
+    :params - rows: list of (id, duration, toggled_at, is_active)
+
+    :returns - dictionary, task id -> {is_active: boolean, toggled_at: ms, duration_ms: ms}
+    """
+    return {
+        task_id: {
+            "is_active": bool(is_active) and bool(toggled_at),
+            "toggled_at": toggled_at or 0,
+            "duration_ms": duration_str_to_int(duration),
+        }
+        for task_id, duration, toggled_at, is_active in rows
+    }
+
+
+def tracked_ms(timer: dict, now: int):
+    """
+    Total time tracked on a stored timer up to now, in whole seconds
+    """
+    total = elapsed_ms(timer, now) if timer["is_active"] else timer["duration_ms"]
+    return total // 1000 * 1000
+
+
+def compute_toggle(data: dict, now: int, timers: dict):
+    """
+    Replaces the client's toggled_at and duration of a task_toggle payload
+    with the values of the server's clock and the stored timer.
+
+    Starting keeps the duration the task already has. Stopping adds the
+    time since the timer was started.
+
+    :params
+        data: dictionary - task_toggle payload {uuid, is_active, toggled_at, duration, last_modified_at}
+        now: int - epoch ms
+        timers: dictionary - from stored_timers, updated with the result so
+            the next operation of a batch sees it
+
+    :returns - dictionary, the payload to save and fan out, or None if the
+        task has no stored timer because it isn't open
+    """
+    timer = timers.get(data["uuid"])
+    if timer is None:
+        return None
+
+    toggled_at = now if data["is_active"] else 0
+    duration_ms = tracked_ms(timer, now)
+    timers[data["uuid"]] = {
+        "is_active": bool(data["is_active"]),
+        "toggled_at": toggled_at,
+        "duration_ms": duration_ms,
+    }
+    return {
+        **data,
+        "toggled_at": toggled_at,
+        "duration": duration_int_to_str(duration_ms // 1000),
+    }
+
+
+def compute_complete(data: dict, now: int, timers: dict):
+    """
+    Same as compute_toggle for a task_completed payload
+    {id, duration, completed_at, last_modified_at}
+    """
+    timer = timers.pop(data["id"], None)
+    if timer is None:
+        return None
+
+    return {**data, "duration": duration_int_to_str(tracked_ms(timer, now) // 1000)}
+
+
+def compute_create(data: dict, now: int):
+    """
+    Same as compute_toggle for a task_create payload, tasks created
+    running start at the server's time
+    """
+    if not data.get("is_active"):
+        return data
+    return {**data, "toggled_at": now}
@@ -0,0 +1,128 @@
+from app.storage import get_running_tasks
+from app.task_timers import now_ms, elapsed_ms
+from app.utility import duration_str_to_int, duration_int_to_str
+
+# Toggles, completes and batches compute durations from the timer stored
+# in the db, which every worker shares, see app/task_timers.py. The index
+# below only has the timers this process saw start, so with several
+# workers it can miss or hold stale timers. It serves /api/timers and
+# nothing that is saved.
+
+# Running timers, user id -> {task id -> {toggled_at: ms, duration_ms: ms}}.
+# duration_ms is the time tracked before the timer was last started.
+active_timers = {}
+# task id -> user id of every running timer
+timer_owners = {}
+
+
+async def load_active_timers():
+    """
+    Fills the index from the tasks that are marked as active in the db
+    """
+    was_fetched, running_tasks = await get_running_tasks()
+    if not was_fetched:
+        return
+
+    active_timers.clear()
+    timer_owners.clear()
+    for task_id, user_id, duration, toggled_at in running_tasks:
+        start_timer(user_id, task_id, duration_str_to_int(duration), toggled_at or now_ms())
+
+
+def start_timer(user_id: str, task_id: str, duration_ms: int, toggled_at: int):
+    active_timers.setdefault(user_id, {})[task_id] = {
+        "toggled_at": toggled_at,
+        "duration_ms": duration_ms,
+    }
+    timer_owners[task_id] = user_id
+
+
+def stop_timer(task_id: str):
+    """
+    Removes the timer of the given task from the index
+
+    :returns - the removed timer or None if it wasn't running
+    """
+    user_id = timer_owners.pop(task_id, None)
+    if user_id is None:
+        return None
+
+    user_timers = active_timers.get(user_id, {})
+    timer = user_timers.pop(task_id, None)
+    if not user_timers:
+        active_timers.pop(user_id, None)
+    return timer
+
+
+def get_timer(task_id: str):
+    user_id = timer_owners.get(task_id)
+    if user_id is None:
+        return None
+    return active_timers[user_id][task_id]
+
+
+def record_toggle(user_id: str, data: dict):
+    """
+    Updates the index with a saved task_toggle payload
+    """
+    if data["is_active"]:
+        start_timer(
+            user_id,
+            data["uuid"],
+            duration_str_to_int(data["duration"]),
+            data["toggled_at"]
+        )
+    else:
+        stop_timer(data["uuid"])
+
+
+def record_create(user_id: str, data: dict):
+    """
+    Updates the index with a saved task_create payload
+    """
+    if data.get("is_active"):
+        start_timer(
+            user_id,
+            data["id"],
+            duration_str_to_int(data["duration"]),
+            data["toggled_at"]
+        )
+
+
+def record_operations(user_id: str, results: list):
+    """
+    Updates the index with the operations of a batch that were applied
+    """
+    for result in results:
+        if not result["ok"]:
+            continue
+
+        op = result["op"]
+        data = result["task"]
+        if op == "toggle":
+            record_toggle(user_id, data)
+        elif op == "create":
+            record_create(user_id, data)
+        elif op in ("complete", "delete"):
+            stop_timer(data["id"])
+
+
+def get_user_timers(user_id: str):
+    """
+    Returns the running timers of a user with the time tracked so far
+
+    :returns - list of {id, toggled_at, duration}
+    """
+    now = now_ms()
+    return [{
+        "id": task_id,
+        "toggled_at": timer["toggled_at"],
+        "duration": duration_int_to_str(elapsed_ms(timer, now) // 1000),
+    } for task_id, timer in active_timers.get(user_id, {}).items()]
+
+
+def get_timer_stats():
+    return {
+        "users": len(active_timers),
+        "running": len(timer_owners),
+    }
@@ -1,62 +1,56 @@
+import random
 import socketio
 import uuid
-from app.models import create_user
+from app.lifecycle import is_draining, reconnect_after_ms
+from app.realtime import create_realtime_server, parse_auth, ensure_user, register_connection, unregister_connection, search_associated_sid_by_id, emitter_to_associated_sids, emit_to_user
 
-# Create a Socket.IO server
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+# Create a Socket.IO server, it shares the connection registry and the
+# outbound queues of the realtime core with the taskbar server
+sio = create_realtime_server()
 app = socketio.ASGIApp(sio)
 
-# Dictionary to store active connections
-active_connections = {}
-
 
 @sio.event
 async def connect(sid, environ):
-    headers = environ.get('headers', {})
-    id = headers.get(b'id', b'').decode('utf-8')
-    email = headers.get(b'email', b'').decode('utf-8')
-    first_name = headers.get(b'first_name', b'').decode('utf-8')
-    last_name = headers.get(b'last_name', b'').decode('utf-8')
+    # a draining instance takes no new connections
+    if is_draining():
+        raise socketio.exceptions.ConnectionRefusedError(
+            {"retry_after_ms": reconnect_after_ms(random.randint(0, 99), 100)})
+
+    user = parse_auth(environ)
+    if user is None:
+        raise socketio.exceptions.ConnectionRefusedError("Missing user details")
 
     # Generate a random ID
     random_id = str(uuid.uuid4())
 
-    # Store connection details
-    active_connections[id] = {
-        'sid': sid,
-        'email': email,
-        'first_name': first_name,
-        'last_name': last_name
-    }
-
     # Create the user in the database
-    response = await create_user(id, email, first_name, last_name)
-    if not response:
-        await sio.disconnect(sid)
-        return
+    if not await ensure_user(user):
+        raise socketio.exceptions.ConnectionRefusedError("User could not be created")
+
+    # Store connection details
+    register_connection(sio, sid, user)
 
     # Send confirmation message
-    await sio.emit('socket-connected', {'id': random_id}, room=sid)
+    await emitter_to_associated_sids('socket-connected', [sid], {'id': random_id})
 
 
 @sio.event
 async def disconnect(sid):
     # Find and remove the disconnected user
-    for user_id, conn in list(active_connections.items()):
-        if conn['sid'] == sid:
-            del active_connections[user_id]
-            break
-    await sio.emit('user-disconnected', {'sid': sid})
+    conn = await unregister_connection(sid)
+    if conn is not None:
+        await emit_to_user(conn["id"], 'user-disconnected', {'sid': sid}, sio=sio)
 
 
 @sio.event
 async def message(sid, data):
-    # Broadcast the received message to all clients
+    # Relay the received message to the sender's other devices
     print(f'Message received from {sid}: {data}')
-    await sio.emit('message', {'message': data})
+    await emitter_to_associated_sids('message', search_associated_sid_by_id(sid), {'message': data})
 
-# Broadcast messages to all active connections
+# Send messages to all devices of one user
 
 
-async def send_message_to_all(message: str):
-    await sio.emit('broadcast', {'message': message})
+async def send_message_to_user(user_id: str, message: str):
+    await emit_to_user(user_id, 'broadcast', {'message': message}, sio=sio)
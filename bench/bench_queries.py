@@ -0,0 +1,116 @@
+"""
+Microbenchmark of the per-call overhead of the completed tasks history query.
+
+Compares the old approach (filters formatted into the SQL text with
+f-strings and reduce, so every distinct filter value is a new statement
+that sqlite has to parse) with app/queries.py (fixed statement shapes and
+bound parameters, served from the per-connection statement cache).
+
+Run from the repository root:
+    python bench/bench_queries.py
+"""
+import glob
+import os
+import re
+import sqlite3
+import sys
+import timeit
+from functools import reduce
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.queries import completed_tasks_params, statement_cache_size  # noqa: E402
+
+calls = 5000
+user_count = 50
+tasks_per_user = 20
+
+
+def create_db():
+    conn = sqlite3.connect(":memory:", cached_statements=statement_cache_size)
+    # the pg_migration*.sql files are the Postgres schema
+    db_dir = os.path.join(os.path.dirname(__file__), "..", "app", "db")
+    migrations = sorted(
+        glob.glob(os.path.join(db_dir, "task_*.sql")) + glob.glob(os.path.join(db_dir, "user_*.sql")),
+        key=lambda f: int(re.search(r"(\d+)\.sql$", f).group(1))
+    )
+    for migration in migrations:
+        conn.executescript(open(migration).read())
+
+    conn.executemany(
+        "INSERT INTO users (id, first_name, last_name, email) VALUES (?, 'f', 'l', 'e')",
+        [(f"user{u}",) for u in range(user_count)]
+    )
+    conn.executemany("""
+        INSERT INTO tasks (id, title, description, created_at, completed_at, duration,
+            category, tags, toggled_at, is_active, is_completed, user_id, last_modified_at)
+        VALUES (?, ?, '', '2024-01-01 00:00:00', ?, '00:10:00', 'work', ?, 0, 0, 1, ?, 0)
+    """, [
+        (f"task{u}-{t}", f"title {t}", f"2024-01-{(t % 28) + 1:02d} 12:00:00",
+         f"tag{t % 5},tag{t % 7}", f"user{u}")
+        for u in range(user_count) for t in range(tasks_per_user)
+    ])
+    conn.commit()
+    return conn
+
+
+def old_query(id, start_date, end_date, tags, search_key, selected_category):
+    tags_query = reduce(
+        lambda x, y: x + f"AND tags LIKE '%{y}%' ", tags, "")
+
+    search_query = ""
+    if search_key:
+        search_query = f"AND title LIKE '%{search_key}%'"
+
+    category_query = ""
+    if selected_category:
+        category_query = f"AND category = '{selected_category}'"
+
+    final_query = f"""
+                SELECT
+                    id,
+                    title,
+                    description,
+                    category,
+                    created_at,
+                    completed_at,
+                    duration,
+                    tags
+                FROM tasks
+                WHERE user_id = :uid
+                    AND is_completed = 1
+                    AND completed_at >= :start_date
+                    AND completed_at <= :end_date
+                   {tags_query}
+                    {search_query}
+                    {category_query}
+               """
+    return (final_query, {"uid": id, "start_date": start_date, "end_date": end_date})
+
+
+def run(conn, build, i):
+    query, params = build(
+        f"user{i % user_count}",
+        "2024-01-01 00:00:00",
+        "2024-01-31 23:59:59",
+        [f"tag{i % 5}"],
+        str(i),
+        "work"
+    )
+    return conn.execute(query, params).fetchall()
+
+
+def main():
+    conn = create_db()
+
+    for i in range(50):
+        assert sorted(run(conn, old_query, i)) == sorted(run(conn, completed_tasks_params, i))
+
+    for name, build in (("f-string + reduce", old_query), ("bound parameters", completed_tasks_params)):
+        counter = iter(range(calls))
+        seconds = timeit.timeit(lambda: run(conn, build, next(counter)), number=calls)
+        print(f"{name:20} {seconds / calls * 1e6:8.1f} us/call")
+
+
+if __name__ == "__main__":
+    main()
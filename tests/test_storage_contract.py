@@ -0,0 +1,463 @@
+import asyncio
+import glob
+import os
+import re
+import time
+import pytest
+from app.storage import load_backend, storage_functions
+
+# Every storage backend must behave the same for the functions listed in
+# app/storage.py. These tests run against each backend with an empty
+# schema built from its migrations.
+#
+# The postgres run needs asyncpg and TASKBAR_TEST_PG_DSN. It drops and
+# recreates the public schema of that database, never point it at real data.
+test_pg_dsn = os.environ.get("TASKBAR_TEST_PG_DSN")
+db_dir = os.path.join(os.path.dirname(__file__), "..", "app", "db")
+
+
+def migrations(*prefixes: str):
+    files = [f for prefix in prefixes for f in glob.glob(os.path.join(db_dir, f"{prefix}*.sql"))]
+    return sorted(files, key=lambda f: int(re.search(r"(\d+)\.sql$", f).group(1)))
+
+
+async def create_sqlite_db(path: str):
+    import aiosqlite
+
+    async with aiosqlite.connect(path) as conn:
+        for migration in migrations("task_", "user_"):
+            await conn.executescript(open(migration).read())
+        await conn.commit()
+    return path
+
+
+async def create_pg_db(dsn: str):
+    import asyncpg
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public")
+        for migration in migrations("pg_"):
+            await conn.execute(open(migration).read())
+    finally:
+        await conn.close()
+    return dsn
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def storage(request, tmp_path):
+    """
+    Returns a function running a test coroutine against a fresh database of
+    the backend, inside one event loop since the connections are bound to it
+    """
+    if request.param == "postgres":
+        if not test_pg_dsn:
+            pytest.skip("TASKBAR_TEST_PG_DSN is not set")
+        pytest.importorskip("asyncpg")
+
+    backend = load_backend(request.param)
+
+    def run(test):
+        async def main():
+            if request.param == "sqlite":
+                target = await create_sqlite_db(str(tmp_path / "db.db"))
+            else:
+                target = await create_pg_db(test_pg_dsn)
+
+            await backend.init_db_conns(target, 2)
+            try:
+                await test(backend)
+            finally:
+                await backend.close_db_conns()
+
+        asyncio.run(main())
+
+    return run
+
+
+def make_task(id: str, **fields):
+    return {
+        "id": id,
+        "title": "task",
+        "description": "",
+        "created_at": "2026-01-01 10:00:00",
+        "completed_at": "",
+        "duration": "00:00:00",
+        "category": "work",
+        "tags": "a,b",
+        "toggled_at": 0,
+        "is_active": 0,
+        "is_completed": 0,
+        "last_modified_at": 1,
+        **fields,
+    }
+
+
+def task_ids(rows):
+    return sorted(row[0] for row in rows)
+
+
+def test_backends_implement_every_function():
+    import app.storage
+
+    backend = load_backend("sqlite")
+    assert all(callable(getattr(backend, f)) for f in storage_functions)
+    # every storage function is assigned by name in app/storage.py
+    assert all(getattr(app.storage, f) is getattr(backend, f) for f in storage_functions)
+
+
+def test_users_and_settings(storage):
+    async def test(db):
+        assert await db.create_user("u1", "e", "f", "l")
+        # existing users are left as they are
+        assert await db.create_user("u1", "other", "f", "l")
+
+        was_fetched, settings = await db.get_user_settings("u1")
+        assert was_fetched
+        assert settings["categories"] == []
+        assert settings["key_commands"] == {}
+        assert settings["version"] == 0
+
+        assert await db.update_user_categories("u1", ["a", "b"])
+        assert await db.update_user_commands("u1", '{"k": "v"}')
+        was_fetched, settings = await db.get_user_settings("u1")
+        assert settings["categories"] == ["a", "b"]
+        assert settings["key_commands"] == {"k": "v"}
+        assert settings["version"] == 2
+
+        was_updated, data = await db.update_user_setting("u1", "add_category", "c", version=2)
+        assert was_updated and data["version"] == 3
+        was_updated, data = await db.update_user_setting("u1", "remove_category", "a", version=2)
+        assert not was_updated
+        assert data["settings"]["categories"] == ["a", "b", "c"]
+        was_updated, data = await db.update_user_setting("u1", "set_command", "x", "y")
+        assert was_updated and data["version"] == 4
+        was_updated, data = await db.update_user_setting("missing", "add_category", "c")
+        assert not was_updated and data["settings"] is None
+
+        was_fetched, snapshot = await db.get_user_snapshot("u1")
+        assert was_fetched
+        assert snapshot["settings"]["key_commands"] == {"k": "v", "x": "y"}
+        assert snapshot["categories"] == "a,b,c"
+        assert snapshot["tasks"] == []
+        assert snapshot["seq"] > 0
+        assert await db.get_user_snapshot("missing") == (False, "User not found")
+
+    storage(test)
+
+
+def test_timezones_and_rollover_days(storage):
+    async def test(db):
+        await db.create_user("u1", "e", "f", "l")
+        await db.create_user("u2", "e", "f", "l")
+        assert await db.update_user_timezone("u1", "Asia/Tokyo")
+
+        was_fetched, timezones = await db.get_user_timezones()
+        assert was_fetched and "Asia/Tokyo" in timezones
+
+        # only users with open tasks are rolled over
+        assert await db.get_user_ids_by_timezone("Asia/Tokyo") == (True, [])
+        await db.create_task("u1", make_task("t1"))
+        assert await db.get_user_ids_by_timezone("Asia/Tokyo") == (True, ["u1"])
+
+        was_fetched, state = await db.get_user_rollover_state("u1")
+        assert was_fetched
+        assert state == {"timezone": "Asia/Tokyo", "last_rollover_day": None}
+
+        assert await db.claim_user_rollover_day("u1", None, "2026-01-02")
+        # a second caller that read the same day loses
+        assert not await db.claim_user_rollover_day("u1", None, "2026-01-02")
+        assert await db.claim_user_rollover_day("u1", "2026-01-02", "2026-01-03")
+
+        assert await db.set_users_rollover_day(["u1", "u2"], "2026-01-05")
+        for user_id in ("u1", "u2"):
+            was_fetched, state = await db.get_user_rollover_state(user_id)
+            assert state["last_rollover_day"] == "2026-01-05"
+
+    storage(test)
+
+
+def test_task_lifecycle(storage, monkeypatch):
+    async def test(db):
+        clock = [1000]
+        monkeypatch.setattr(db, "now_ms", lambda: clock[0])
+        await db.create_user("u1", "e", "f", "l")
+        await db.create_user("u2", "e", "f", "l")
+        assert await db.create_task("u1", make_task("t1", duration="00:01:00")) == (True, "")
+        assert await db.create_task("u1", make_task("t2")) == (True, "")
+        assert await db.create_task("u2", make_task("t3")) == (True, "")
+        was_created, _ = await db.create_task("u1", make_task("t1"))
+        assert not was_created
+
+        was_fetched, tasks = await db.get_tasks()
+        assert was_fetched and task_ids(tasks) == ["t1", "t2", "t3"]
+        was_fetched, tasks = await db.get_non_completed_tasks_by_user_ids(["u1"])
+        assert task_ids(tasks) == ["t1", "t2"]
+
+        # the stored timer and the server's clock win over the client's
+        toggle = {
+            "uuid": "t1",
+            "is_active": 1,
+            "toggled_at": 5,
+            "duration": "09:00:00",
+            "last_modified_at": 2,
+        }
+        assert await db.toggle_task(toggle) == (True, "", {
+            **toggle, "toggled_at": 1000, "duration": "00:01:00"})
+        was_fetched, running = await db.get_running_tasks()
+        assert was_fetched
+        assert [tuple(row) for row in running] == [("t1", "u1", "00:01:00", 1000)]
+        assert await db.toggle_task({**toggle, "uuid": "missing"}) == (False, "Task not found", None)
+
+        assert await db.edit_task({
+            "id": "t2",
+            "title": "renamed",
+            "description": "d",
+            "category": "home",
+            "tags": "c",
+            "last_modified_at": 3,
+        }) == (True, "")
+        was_fetched, tasks = await db.fetch_active_tasks_by_user("u1")
+        assert was_fetched
+        assert {row[0]: row[1] for row in tasks} == {"t1": "task", "t2": "renamed"}
+
+        clock[0] = 61000
+        complete = {
+            "id": "t1",
+            "duration": "09:00:00",
+            "completed_at": "2026-01-01 12:00:00",
+            "last_modified_at": 4,
+        }
+        assert await db.complete_task(complete) == (True, "", {**complete, "duration": "00:02:00"})
+        # completed tasks have no timer left to stop
+        assert await db.complete_task(complete) == (False, "Task not found", None)
+        was_fetched, tasks = await db.get_non_completed_tasks()
+        assert task_ids(tasks) == ["t2", "t3"]
+        was_fetched, completed = await db.get_completed_tasks_by_uid(
+            "u1", "2026-01-01 00:00:00", "2026-01-01 23:59:59", [], "", "")
+        assert was_fetched
+        assert [(row[0], row[6]) for row in completed] == [("t1", "00:02:00")]
+
+        assert await db.delete_task("t2") == (True, "")
+        assert await db.delete_task("t2") == (False, "Task not found")
+        was_edited, _ = await db.edit_task({
+            "id": "missing",
+            "title": "x",
+            "description": "",
+            "category": "",
+            "tags": "",
+            "last_modified_at": 5,
+        })
+        assert not was_edited
+        was_fetched, tasks = await db.fetch_active_tasks_by_user("u1")
+        assert tasks == []
+
+    storage(test)
+
+
+def test_sessions_outlive_their_task(storage):
+    async def test(db):
+        await db.create_user("u1", "e", "f", "l")
+        await db.create_task("u1", make_task("t1", duration="00:10:00"))
+
+        assert await db.add_task_sessions([{
+            "task_id": "t1",
+            "user_id": "u1",
+            "day": "2026-01-01",
+            "duration_s": 600,
+            "toggled_at": 0,
+            "last_modified_at": 2,
+        }]) == (True, "")
+        was_fetched, tasks = await db.get_non_completed_tasks_by_user_ids(["u1"])
+        # the open task starts the next day from zero
+        assert [(row[0], row[5]) for row in tasks] == [("t1", "00:00:00")]
+
+        assert await db.delete_task("t1") == (True, "")
+        was_fetched, history = await db.get_completed_tasks_by_uid(
+            "u1", "2026-01-01 00:00:00", "2026-01-01 23:59:59", [], "", "")
+        assert was_fetched
+        assert [(row[0], row[1], row[6]) for row in history] == [
+            ("t1@2026-01-01", "task", "00:10:00")]
+
+        # history entries are edited and deleted by their own id
+        assert await db.edit_task({
+            "id": "t1@2026-01-01",
+            "title": "renamed",
+            "description": "",
+            "category": "work",
+            "tags": "",
+            "last_modified_at": 3,
+        }) == (True, "")
+        was_fetched, history = await db.get_completed_tasks_by_uid(
+            "u1", "2026-01-01 00:00:00", "2026-01-01 23:59:59", [], "", "")
+        assert [row[1] for row in history] == ["renamed"]
+        assert await db.delete_task("t1@2026-01-01") == (True, "")
+        assert await db.delete_task("t1@2026-01-01") == (False, "Task not found")
+
+    storage(test)
+
+
+def test_archived_tasks(storage):
+    async def test(db):
+        await db.create_user("u1", "e", "f", "l")
+        await db.create_task("u1", make_task(
+            "old", is_completed=1, completed_at="2025-01-01 10:00:00"))
+        await db.create_task("u1", make_task(
+            "new", is_completed=1, completed_at="2026-01-01 10:00:00"))
+        await db.create_task("u1", make_task("open"))
+
+        assert await db.archive_completed_tasks("2025-06-01 00:00:00", 10) == (True, 1)
+        assert await db.archive_completed_tasks("2025-06-01 00:00:00", 10) == (True, 0)
+        was_fetched, tasks = await db.get_tasks()
+        assert task_ids(tasks) == ["new", "open"]
+
+        # archived tasks are still listed, edited and deleted
+        was_fetched, completed = await db.get_completed_tasks_by_uid(
+            "u1", "2025-01-01 00:00:00", "2026-12-31 23:59:59", [], "", "")
+        assert task_ids(completed) == ["new", "old"]
+        assert await db.edit_task({
+            "id": "old",
+            "title": "renamed",
+            "description": "",
+            "category": "work",
+            "tags": "",
+            "last_modified_at": 2,
+        }) == (True, "")
+        assert await db.delete_task("old") == (True, "")
+        was_fetched, completed = await db.get_completed_tasks_by_uid(
+            "u1", "2025-01-01 00:00:00", "2026-12-31 23:59:59", [], "", "")
+        assert task_ids(completed) == ["new"]
+
+    storage(test)
+
+
+def test_task_batch(storage, monkeypatch):
+    async def test(db):
+        monkeypatch.setattr(db, "now_ms", lambda: 7000)
+        await db.create_user("u1", "e", "f", "l")
+        await db.create_user("u2", "e", "f", "l")
+        await db.create_task("u1", make_task("t1"))
+        await db.create_task("u2", make_task("other"))
+
+        was_applied, message, results = await db.apply_task_batch("u1", [
+            {"op": "create", "data": make_task("t2")},
+            {"op": "toggle", "data": {
+                "uuid": "t2",
+                "is_active": 1,
+                "toggled_at": 1000,
+                "duration": "00:00:00",
+                "last_modified_at": 2,
+            }},
+            {"op": "edit", "data": {
+                "id": "t1",
+                "title": "renamed",
+                "description": "",
+                "category": "",
+                "tags": "",
+                "last_modified_at": 2,
+            }},
+            {"op": "delete", "data": {"id": "other"}},
+            {"op": "delete", "data": {"id": 5}},
+            {"op": "unknown", "data": {}},
+        ])
+        assert was_applied and message == ""
+        assert [result["ok"] for result in results] == [True, True, True, False, False, False]
+        assert results[3]["message"] == "Task not found"
+        assert results[4]["message"] == "Invalid task id"
+        assert results[1]["task"]["toggled_at"] == 7000
+
+        was_fetched, tasks = await db.fetch_active_tasks_by_user("u1")
+        assert {row[0]: row[1] for row in tasks} == {"t1": "renamed", "t2": "task"}
+        was_fetched, running = await db.get_running_tasks()
+        assert [row[0] for row in running] == ["t2"]
+        was_fetched, tasks = await db.get_tasks()
+        assert "other" in task_ids(tasks)
+
+    storage(test)
+
+
+def test_task_batch_applies_operations_in_order(storage, monkeypatch):
+    async def test(db):
+        clock = [1000]
+        monkeypatch.setattr(db, "now_ms", lambda: clock[0])
+        await db.create_user("u1", "e", "f", "l")
+        await db.create_task("u1", make_task("t1", duration="00:01:00"))
+
+        def toggle(is_active: int, duration: str):
+            return {"op": "toggle", "data": {
+                "uuid": "t1",
+                "is_active": is_active,
+                "toggled_at": 1000 if is_active else 0,
+                "duration": duration,
+                "last_modified_at": 2,
+            }}
+
+        was_applied, message, results = await db.apply_task_batch("u1", [
+            toggle(1, "00:01:00"),
+            toggle(0, "00:02:00"),
+            {"op": "complete", "data": {
+                "id": "t1",
+                "duration": "00:03:00",
+                "completed_at": "2026-01-01 12:00:00",
+                "last_modified_at": 3,
+            }},
+            toggle(1, "00:04:00"),
+        ])
+        assert was_applied
+        assert [result["ok"] for result in results] == [True, True, True, False]
+        assert results[3]["message"] == "Task not found"
+        # one clock reading per batch, the client's durations are ignored
+        assert [result["task"]["duration"] for result in results[:3]] == ["00:01:00"] * 3
+        assert results[0]["task"]["toggled_at"] == 1000
+        was_fetched, tasks = await db.get_tasks()
+        # duration, is_active, is_completed
+        assert [(row[5], row[9], row[10]) for row in tasks] == [("00:01:00", 0, 1)]
+
+        # stopping a running timer adds the time since it was started
+        await db.create_task("u1", make_task("t2", duration="00:01:00", is_active=1, toggled_at=1000))
+        clock[0] = 31000
+        was_applied, message, results = await db.apply_task_batch("u1", [
+            {"op": "toggle", "data": {**toggle(0, "00:00:00")["data"], "uuid": "t2"}},
+        ])
+        assert results[0]["ok"] and results[0]["task"]["duration"] == "00:01:30"
+
+    storage(test)
+
+
+def test_change_feed(storage):
+    async def test(db):
+        await db.create_user("u1", "e", "f", "l")
+        await db.create_user("u2", "e", "f", "l")
+        assert await db.get_last_change_seq() == (True, 0)
+        assert await db.get_first_change_seq() == (True, None)
+
+        await db.create_task("u1", make_task("t1"), "sid1")
+        await db.create_task("u2", make_task("t2"))
+        await db.delete_task("t1")
+
+        was_fetched, last_seq = await db.get_last_change_seq()
+        assert was_fetched and last_seq > 0
+        was_fetched, changes = await db.get_changes(0, 10)
+        assert was_fetched
+        assert [(row[1], row[2], row[4]) for row in changes] == [
+            ("u1", "new_task_created", "sid1"),
+            ("u2", "new_task_created", None),
+            ("u1", "related_task_deleted", None),
+        ]
+        assert changes[-1][0] == last_seq
+        # every user numbers their own changes
+        assert [(row[1], row[5]) for row in changes] == [("u1", 1), ("u2", 1), ("u1", 2)]
+        was_fetched, changes = await db.get_changes(0, 10, "u1")
+        assert [row[2] for row in changes] == ["new_task_created", "related_task_deleted"]
+        was_fetched, by_seqs = await db.get_changes_by_seqs([changes[1][0], changes[0][0], 10 ** 9])
+        assert was_fetched and by_seqs == changes
+        was_fetched, changes = await db.get_changes(0, 1, "u1")
+        assert len(changes) == 1
+
+        # the newest change is kept so the feed never looks empty
+        was_pruned, count = await db.prune_changes(int(time.time() * 1000) + 1000)
+        assert was_pruned and count == 2
+        assert await db.get_first_change_seq() == (True, last_seq)
+        assert await db.get_last_change_seq() == (True, last_seq)
+
+    storage(test)